@@ -1,6 +1,6 @@
 import paho.mqtt.client as mqtt
 from pymongo import MongoClient
-import json
+from pymongo.errors import BulkWriteError
 import argparse
 import logging
 import os
@@ -10,16 +10,32 @@ import sys
 import platform
 import time
 
+# Shared ingest helpers live next to the UART scripts
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'python'))
+from batch_writer import DEFAULT_BATCH_BYTES, BatchWriter
+from indexes import provision
+from dedup import RecentIds, split_write_errors
+from mqtt_batch import decode_message, dictionary_id, load_dictionary
+
 class MQTTMongoSubscriber:
     def __init__(self, mqtt_broker="localhost", mqtt_port=1883,
                  mqtt_topic="admin/reader", mqtt_username=None, mqtt_password=None,
                  mongo_uri="mongodb://localhost:27017/",
-                 log_level="info"):
-        """Initialize MQTT subscriber with MongoDB connection"""
+                 log_level="info", batch_size=500, batch_bytes=DEFAULT_BATCH_BYTES,
+                 batch_latency=1.0, dictionary=None):
+        """Initialize MQTT subscriber with MongoDB connection
+
+        Messages are written with one unordered insert_many per batch of
+        batch_size documents, batch_bytes (estimated) or batch_latency seconds.
+        Batch messages from publish.py are split into their buffers; dictionary
+        is the preset compression dictionary file the publisher uses.
+        """
         self.running = True
         self.mqtt_topic = mqtt_topic
         self.messages_received = 0
         self.devices_processed = 0
+        self.payload_formats = {}  # Messages received per payload format
+        self.dictionary = load_dictionary(dictionary)
         
         # Add signal handlers based on platform
         signal.signal(signal.SIGTERM, self.signal_handler)
@@ -46,6 +62,16 @@ class MQTTMongoSubscriber:
         except Exception as e:
             self.logger.error(f"Error connecting to MongoDB: {e}")
             raise
+        self._provision_indexes()
+        if self.dictionary:
+            self.logger.info(f"Using compression dictionary {dictionary_id(self.dictionary):08x}")
+        # Buffer ids stored recently, QoS 1 redeliveries are dropped before MongoDB
+        self.recent_ids = RecentIds()
+
+        # Batches messages into insert_many calls, flushed by size or age
+        self.writer = BatchWriter(self._insert_documents, max_count=batch_size,
+                                  max_bytes=batch_bytes, max_latency=batch_latency,
+                                  name='mongo-batch-writer').start()
 
         # Setup MQTT Client with Version 2 API
         try:
@@ -96,6 +122,51 @@ class MQTTMongoSubscriber:
         
         self.logger.info(f"Script started: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
 
+    def _provision_indexes(self):
+        """Create missing indexes and log the plans of the hot queries"""
+        try:
+            report, plans = provision(self.collection, timeseries=False, encoding='standard')
+        except Exception as e:
+            self.logger.warning(f"Could not check indexes: {e}")
+            return
+        for name, status in report:
+            if status == 'created':
+                self.logger.info(f"Index {name} created on {self.collection.name}")
+            elif status != 'exists':
+                self.logger.warning(f"Index {name} on {self.collection.name}: {status}")
+        for name, plan in plans.items():
+            if 'error' in plan:
+                self.logger.warning(f"Could not explain query {name}: {plan['error']}")
+            elif plan['slow']:
+                self.logger.warning(f"Query {name} is not using an index: {plan['plan']}")
+            else:
+                self.logger.debug(f"Query {name}: {plan['plan']}")
+
+    def _insert_documents(self, documents):
+        """Insert a batch of documents, returns how many were stored (duplicates
+        of stored buffers count as stored)"""
+        fresh = self.recent_ids.filter(documents)
+        if not fresh:
+            return len(documents)
+        failed = set()
+        try:
+            result = self.collection.insert_many(fresh, ordered=False)
+            self.logger.debug(f"Stored {len(result.inserted_ids)} messages in MongoDB")
+        except BulkWriteError as e:
+            # Unordered insert: only the failed documents are missing
+            duplicates, failed = split_write_errors(e.details)
+            self.recent_ids.reject(len(duplicates))
+            if failed:
+                errors = [error for error in e.details.get('writeErrors', [])
+                          if error['index'] in failed]
+                self.logger.error(f"Error storing batch in MongoDB: {errors[:1]}")
+        except Exception as e:
+            self.logger.error(f"Error storing batch in MongoDB: {e}")
+            return 0
+        self.recent_ids.add([document for index, document in enumerate(fresh)
+                             if index not in failed])
+        return len(documents) - len(failed)
+
     def on_subscribe(self, client, userdata, mid, reason_codes, properties):
         """Callback when subscription is confirmed"""
         self.logger.info(f"Subscription confirmed with reason codes: {reason_codes}")
@@ -121,44 +192,46 @@ class MQTTMongoSubscriber:
             self.logger.info(f"Received message on topic: {msg.topic}")
             self.messages_received += 1
             
-            # Parse the JSON message
-            payload = json.loads(msg.payload.decode())
-            self.logger.debug(f"Raw message payload: {msg.payload.decode()[:200]}...")  # Log first 200 chars
-            
-            # Convert ISO format timestamp string back to datetime
-            payload['timestamp'] = datetime.fromisoformat(payload['timestamp'])
+            # Decode the JSON, binary or batch payload (timestamps back to datetime)
+            payload_format, payloads = decode_message(msg.payload, self.dictionary)
+            self.payload_formats[payload_format] = self.payload_formats.get(payload_format, 0) + 1
+            self.logger.debug(f"Raw message payload ({payload_format}): {msg.payload[:200]}...")  # Log first 200 bytes
             
             # Log message details
-            self.logger.info(
-                f"Message #{self.messages_received} - "
-                f"Sequence: {payload.get('sequence', 'N/A')}, "
-                f"Devices: {len(payload.get('devices', []))}, "
-                f"N_ADV_RAW: {payload.get('n_adv_raw', 'N/A')}"
-            )
+            for payload in payloads:
+                self.logger.info(
+                    f"Message #{self.messages_received} - "
+                    f"Sequence: {payload.get('sequence', 'N/A')}, "
+                    f"Devices: {len(payload.get('devices', []))}, "
+                    f"N_ADV_RAW: {payload.get('n_adv_raw', 'N/A')}"
+                )
             
-            # Store in MongoDB
-            result = self.collection.insert_one(payload)
+            # Store in MongoDB (batched, flushed by size or age)
+            self.writer.add_many(payloads)
             
             # Update devices count and log details
-            n_devices = len(payload.get('devices', []))
-            self.devices_processed += n_devices
+            for payload in payloads:
+                n_devices = len(payload.get('devices', []))
+                self.devices_processed += n_devices
+                
+                # Log some device details
+                for i, device in enumerate(payload.get('devices', []), 1):
+                    self.logger.debug(
+                        f"Device {i}/{n_devices} - "
+                        f"MAC: {device.get('mac', 'N/A')}, "
+                        f"RSSI: {device.get('rssi', 'N/A')}"
+                    )
             
             self.logger.info(
-                f"Stored in MongoDB - ID: {result.inserted_id}, "
+                f"Queued for MongoDB - "
                 f"Total messages: {self.messages_received}, "
                 f"Total devices: {self.devices_processed}"
             )
-            
-            # Log some device details
-            for i, device in enumerate(payload.get('devices', []), 1):
-                self.logger.debug(
-                    f"Device {i}/{n_devices} - "
-                    f"MAC: {device.get('mac', 'N/A')}, "
-                    f"RSSI: {device.get('rssi', 'N/A')}"
-                )
                 
-        except json.JSONDecodeError as e:
-            self.logger.error(f"Error decoding JSON message: {e}")
+        except ValueError as e:
+            # Invalid JSON, unknown envelope or payload version, corrupt frame,
+            # dictionary mismatch
+            self.logger.error(f"Error decoding message: {e}")
             self.logger.error(f"Raw message: {msg.payload}")
         except Exception as e:
             self.logger.error(f"Error processing message: {e}")
@@ -177,9 +250,23 @@ class MQTTMongoSubscriber:
         # Keep the main thread running and log stats periodically
         try:
             while self.running:
+                stats = self.writer.stats()
                 self.logger.info(
                     f"Status - Messages received: {self.messages_received}, "
-                    f"Devices processed: {self.devices_processed}"
+                    f"Devices processed: {self.devices_processed}, "
+                    f"Formats: {self.payload_formats}, "
+                    f"Stored: {stats['stored']}, Failed: {stats['failed']}, "
+                    f"Pending: {stats['pending']}"
+                )
+                self.logger.info(
+                    f"Writes - {stats['flushes']} insert_many, {stats['avg_flush']} docs avg "
+                    f"(max {stats['max_flush']}), {stats['avg_flush_ms']:.1f} ms avg "
+                    f"(max {stats['max_flush_ms']:.1f} ms)"
+                )
+                duplicates = self.recent_ids.stats()
+                self.logger.info(
+                    f"Duplicates - {duplicates['skipped']} skipped in memory, "
+                    f"{duplicates['rejected']} rejected by MongoDB"
                 )
                 time.sleep(10)  # Log stats every 10 seconds
         except KeyboardInterrupt:
@@ -196,6 +283,10 @@ class MQTTMongoSubscriber:
             self.mqtt_client.disconnect()
             self.logger.info("MQTT connection closed")
             
+            # Write what is still batched before closing MongoDB
+            self.writer.close()
+            self.logger.info(f"Write stats: {self.writer.stats()}")
+            
             self.mongo_client.close()
             self.logger.info("MongoDB connection closed")
             
@@ -225,6 +316,16 @@ if __name__ == "__main__":
                       choices=['info', 'debug'],
                       default='info',
                       help='Logging level (default: info)')
+    parser.add_argument('--batch-size', type=int, default=500,
+                      help='Documents per insert_many (default: 500)')
+    parser.add_argument('--batch-bytes', type=int, default=DEFAULT_BATCH_BYTES,
+                      help=f'Estimated batch size in bytes that triggers an insert_many '
+                           f'(default: {DEFAULT_BATCH_BYTES})')
+    parser.add_argument('--batch-latency', type=float, default=1.0,
+                      help='Longest a message waits for its batch in seconds, '
+                           '0 to write every message right away (default: 1.0)')
+    parser.add_argument('--dictionary', type=str,
+                      help='Preset compression dictionary of the publisher (optional)')
     
     args = parser.parse_args()
     
@@ -236,7 +337,11 @@ if __name__ == "__main__":
             mqtt_username=args.mqtt_username,
             mqtt_password=args.mqtt_password,
             mongo_uri=args.mongo_uri,
-            log_level=args.log_level
+            log_level=args.log_level,
+            batch_size=args.batch_size,
+            batch_bytes=args.batch_bytes,
+            batch_latency=args.batch_latency,
+            dictionary=args.dictionary
         )
         subscriber.start()
     except Exception as e:
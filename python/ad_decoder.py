@@ -0,0 +1,101 @@
+"""BLE advertising data (AD structure) decoding.
+
+The scanner forwards up to 31 bytes of raw advertising data per device:
+a sequence of [length][AD type][length - 1 bytes] structures (Core Spec
+Supplement, Part A). decode_ad() turns them into typed fields that are
+stored next to the raw hex, so analyses do not re-parse hex per row.
+
+Devices repeat the same payload in every buffer, so results are memoized
+per distinct payload and each one is only decoded once.
+"""
+import functools
+import uuid
+
+# AD types (Bluetooth Assigned Numbers, "Common Data Types")
+AD_FLAGS = 0x01
+AD_UUID16_INCOMPLETE = 0x02
+AD_UUID16_COMPLETE = 0x03
+AD_UUID32_INCOMPLETE = 0x04
+AD_UUID32_COMPLETE = 0x05
+AD_UUID128_INCOMPLETE = 0x06
+AD_UUID128_COMPLETE = 0x07
+AD_NAME_SHORT = 0x08
+AD_NAME_COMPLETE = 0x09
+AD_TX_POWER = 0x0A
+AD_SERVICE_DATA16 = 0x16
+AD_APPEARANCE = 0x19
+AD_MANUFACTURER = 0xFF
+
+# UUID list types -> bytes per UUID
+UUID_SIZES = {
+    AD_UUID16_INCOMPLETE: 2, AD_UUID16_COMPLETE: 2,
+    AD_UUID32_INCOMPLETE: 4, AD_UUID32_COMPLETE: 4,
+    AD_UUID128_INCOMPLETE: 16, AD_UUID128_COMPLETE: 16,
+}
+
+# Distinct payloads kept; a scanner sees a few thousand devices and most
+# of them advertise one or two fixed payloads
+AD_CACHE_SIZE = 16384
+
+
+def _format_uuid(value):
+    """Little-endian UUID bytes as '180f', '0000fe2c' or the canonical 128-bit form"""
+    if len(value) == 16:
+        return str(uuid.UUID(bytes=value[::-1]))
+    return value[::-1].hex()
+
+
+@functools.lru_cache(maxsize=AD_CACHE_SIZE)
+def decode_ad(payload):
+    """
+    Decode the AD structures of one advertising payload
+
+    Args:
+        payload (bytes): Advertising data, data_len bytes
+
+    Returns:
+        dict: Fields found among flags, local_name, tx_power, appearance,
+        company_id and service_uuids (tuple). Shared between calls, do not
+        modify. ad_malformed is set when a structure overruns the payload.
+    """
+    fields = {}
+    uuids = []
+    offset = 0
+    while offset < len(payload):
+        length = payload[offset]
+        if length == 0:
+            break  # Early termination / zero padding
+        end = offset + 1 + length
+        if end > len(payload):
+            fields['ad_malformed'] = True
+            break
+        ad_type = payload[offset + 1]
+        value = payload[offset + 2:end]
+        offset = end
+
+        if ad_type == AD_FLAGS and value:
+            fields['flags'] = value[0]
+        elif ad_type in UUID_SIZES:
+            size = UUID_SIZES[ad_type]
+            uuids.extend(_format_uuid(value[i:i + size])
+                         for i in range(0, len(value) - size + 1, size))
+        elif ad_type == AD_NAME_COMPLETE or (ad_type == AD_NAME_SHORT and 'local_name' not in fields):
+            fields['local_name'] = value.decode('utf-8', errors='replace')
+        elif ad_type == AD_TX_POWER and value:
+            fields['tx_power'] = value[0] - 256 if value[0] > 127 else value[0]
+        elif ad_type == AD_SERVICE_DATA16 and len(value) >= 2:
+            uuids.append(_format_uuid(value[:2]))
+        elif ad_type == AD_APPEARANCE and len(value) >= 2:
+            fields['appearance'] = int.from_bytes(value[:2], 'little')
+        elif ad_type == AD_MANUFACTURER and len(value) >= 2:
+            fields['company_id'] = int.from_bytes(value[:2], 'little')
+
+    if uuids:
+        fields['service_uuids'] = tuple(dict.fromkeys(uuids))
+    return fields
+
+
+def cache_stats():
+    """Hits, misses and size of the payload cache"""
+    info = decode_ad.cache_info()
+    return {'hits': info.hits, 'misses': info.misses, 'size': info.currsize}
@@ -4,6 +4,9 @@ from datetime import datetime, timedelta
 from flask_compress import Compress
 from flask_cors import CORS
 from collections import defaultdict
+from timeseries import count_buffers, find_buffers, latest_buffer
+from indexes import provision
+from rollups import chart_points, merge, read_rollups, rollup_names
 import psutil  # For battery info
 import subprocess  # For WiFi info
 
@@ -11,7 +14,7 @@ app = Flask(__name__)
 Compress(app)
 CORS(app)
 
-# MongoDB setup
+# MongoDB setup (portfinal or its time-series counterpart portfinal_ts, see --collection)
 client = MongoClient('mongodb://localhost:27017/')
 db = client.tracking_data
 collection = db.portfinal
@@ -54,6 +57,14 @@ def calculate_devices_per_buffer(data, max_points=13):
     
     return buffer_stats
 
+def parse_time_range(time_range):
+    """timedelta of a dashboard time range ('5m', '6h', '30d'), 5 minutes if invalid"""
+    units = {'m': 'minutes', 'h': 'hours', 'd': 'days'}
+    value, unit = time_range[:-1], time_range[-1:]
+    if not value.isdigit() or unit not in units:
+        return timedelta(minutes=5)
+    return timedelta(**{units[unit]: int(value)})
+
 def get_system_info():
     """Get WiFi and battery information for Windows"""
     try:
@@ -114,21 +125,41 @@ def get_data():
     try:
         time_range = request.args.get('timeRange', '5m')
         print(f"\nReceived request for timeRange: {time_range}")
-        
-        # Get all records from MongoDB with sorting
-        print("Fetching all available records from database...")
-        data = list(collection.find(
-            {},  # Empty query to get all records
-            {"_id": 0}
-        ).sort("timestamp", -1))  # Sort by timestamp in descending order
-        
-        print(f"Found {len(data)} total records in database")
+        since = datetime.now() - parse_time_range(time_range)
+
+        # BLE stats and chart from the rollups when they account for every
+        # stored buffer; then only the map's time range and the buffers
+        # received after the newest rollup are read raw
+        total_buffers = count_buffers(collection)
+        rollups = {period: db[name] for period, name in rollup_names(collection.name).items()}
+        hours = read_rollups(rollups['hour'])
+        totals = merge(hours) if hours else None
+        tail = []
+        if totals:
+            received = totals['received'] or totals['last']
+            tail = [d for d in find_buffers(collection, start=totals['last'], sort=-1)
+                    if d['timestamp'] > received]
+            if totals['buffers'] + len(tail) < total_buffers:
+                # Buffers stored while --rollups was off: python rollups.py --rebuild
+                print(f"Rollups cover {totals['buffers'] + len(tail)} of {total_buffers} buffers, "
+                      f"reading all of them")
+                totals = None
+
+        if totals:
+            data = None
+            recent = find_buffers(collection, start=since, sort=-1)
+        else:
+            print("Fetching all available records from database...")
+            # Buffer documents for either layout, newest first
+            data = find_buffers(collection, sort=-1)
+            print(f"Found {len(data)} total records in database")
+            recent = [d for d in data if d['timestamp'] >= since]
 
         # Process GPS points and buffer locations
         gps_points = []
         buffer_points = []
         
-        for d in data:
+        for d in recent:
             # Process GPS data for trail
             if 'gps_data' in d and isinstance(d['gps_data'], dict):
                 gps_data = d['gps_data']
@@ -185,12 +216,13 @@ def get_data():
         print(f"Buffer points: {len(buffer_points)}")
 
         # Calculate BLE stats
-        unique_macs = set()
-        total_advertisements = 0
-        # Get total count of documents in collection
-        total_buffers = collection.count_documents({})
-
-        for d in data:
+        if totals:
+            unique_macs = set(totals['macs'])
+            total_advertisements = totals['advertisements']
+        else:
+            unique_macs = set()
+            total_advertisements = 0
+        for d in tail if totals else data:
             if 'devices' in d and isinstance(d['devices'], list):
                 for device in d['devices']:
                     if isinstance(device, dict):
@@ -199,23 +231,29 @@ def get_data():
                         if 'n_adv' in device:
                             total_advertisements += device['n_adv']
 
-        last_timestamp = max([d["timestamp"] for d in data]) if data else datetime.utcnow()
-        
-        # Get the latest sequence number correctly
-        latest_doc = collection.find_one(
-            {"sequence": {"$exists": True}},
-            sort=[("timestamp", -1)]
-        )
+        # Get the latest buffer (sequence, time and position)
+        latest_doc = latest_buffer(collection)
         last_sequence = latest_doc.get('sequence', 0) if latest_doc else 0
+        last_timestamp = latest_doc['timestamp'] if latest_doc else datetime.utcnow()
 
         # Calculate chart data
-        chart_data = calculate_devices_per_buffer(data)
+        if totals:
+            chart_data = chart_points(rollups['minute'])
+            if tail:
+                # Buffers not rolled up yet, as one last point
+                chart_data.append({
+                    'buffer': totals['buffers'] + len(tail),
+                    'devices': round(sum(len(d.get('devices', [])) for d in tail) / len(tail), 1),
+                    'timestamp': tail[0]['timestamp'],
+                })
+        else:
+            chart_data = calculate_devices_per_buffer(data)
         
         # Get system info
         system_info = get_system_info()
         
         # Get last record safely
-        last_record = data[-1] if data else None
+        last_record = latest_doc
         last_gps = last_record.get('gps_data', {}) if last_record else {}
         last_coordinates = last_gps.get('coordinates', {}) if isinstance(last_gps, dict) else {}
         
@@ -270,27 +308,43 @@ def get_data():
         }), 500
 
 if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Flask BLE GPS Tracker Server')
+    parser.add_argument('--host', type=str, default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=5000)
+    parser.add_argument('--collection', type=str, default='portfinal',
+                        help='Buffer collection or its time-series counterpart (e.g. portfinal_ts)')
+    
+    args = parser.parse_args()
+    collection = db[args.collection]
+
     # Test MongoDB connection
     try:
         print("\nTesting MongoDB connection...")
-        count = collection.count_documents({})
-        print(f"Connected successfully. Found {count} documents in collection")
+        count = count_buffers(collection)
+        print(f"Connected successfully. Found {count} buffers in collection")
         
         # Print a sample document
-        sample = collection.find_one()
+        sample = latest_buffer(collection)
         if sample:
             print("\nSample document structure:")
             for key, value in sample.items():
                 print(f"{key}: {type(value)}")
     except Exception as e:
         print(f"MongoDB connection error: {e}")
-    
-    import argparse
-    parser = argparse.ArgumentParser(description='Flask BLE GPS Tracker Server')
-    parser.add_argument('--host', type=str, default='0.0.0.0')
-    parser.add_argument('--port', type=int, default=5000)
-    
-    args = parser.parse_args()
+
+    # Create missing indexes and show how the dashboard queries run
+    try:
+        report, plans = provision(collection)
+        for name, status in report:
+            print(f"Index {name}: {status}")
+        for name, plan in plans.items():
+            if 'error' in plan:
+                print(f"Query {name}: error {plan['error']}")
+            else:
+                print(f"Query {name}: {'SLOW ' if plan['slow'] else ''}{plan['plan']}")
+    except Exception as e:
+        print(f"Index check failed: {e}")
     
     print(f"\nServer started!")
     print(f"Access from local network devices:")
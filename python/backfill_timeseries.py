@@ -0,0 +1,132 @@
+"""Backfill a buffer collection (portfinal, session3, ...) into a time-series collection.
+
+Reads the source in (timestamp, _id) order and writes each buffer's
+devices as observations (see timeseries.py). Buffer _ids are hashes
+(dedup.py) and do not follow insertion order, so progress is the timestamp
+and _id of the last buffer written, kept in the _backfill collection: an
+interrupted run resumes after the last batch written, and re-running over a
+finished source only copies buffers stamped after it. A receiver still
+draining its queue or journal can store a buffer stamped before that
+checkpoint, so re-run once the receivers have flushed. The order is served
+by a (timestamp, _id) index on the source, created if missing.
+
+    python backfill_timeseries.py --db tracking_data --source portfinal
+    python backfill_timeseries.py --db ble_scanner --source session3 --target session3_ts
+"""
+import argparse
+import time
+
+from pymongo import ASCENDING, MongoClient
+
+from indexes import ensure_indexes
+from timeseries import COLLECTION_SUFFIX, GRANULARITY, ObservationWriter, is_timeseries
+
+PROGRESS_COLLECTION = '_backfill'
+# Read order of the source, one index scan without an in-memory sort
+ORDER = [('timestamp', ASCENDING), ('_id', ASCENDING)]
+ORDER_INDEX = {'timestamp_id': (ORDER, {})}
+
+
+def resume_query(state, source):
+    """
+    Filter for the buffers after a saved checkpoint
+
+    Args:
+        state (dict): Progress document, None to start from the first buffer
+        source: pymongo Collection, to place checkpoints saved as a bare
+            last_id by earlier versions
+
+    Returns:
+        dict: find() filter
+    """
+    if not state:
+        return {}
+    last_id = state['last_id']
+    last_timestamp = state.get('last_timestamp')
+    if last_timestamp is None:
+        document = source.find_one({'_id': last_id}, {'timestamp': 1})
+        if not document or 'timestamp' not in document:
+            return {}
+        last_timestamp = document['timestamp']
+    return {'$or': [{'timestamp': {'$gt': last_timestamp}},
+                    {'timestamp': last_timestamp, '_id': {'$gt': last_id}}]}
+
+
+def backfill(db, source, target, batch_size=500, granularity=GRANULARITY, restart=False):
+    """
+    Copy the buffers of source into the time-series collection target
+
+    Args:
+        db: pymongo Database
+        source (str): Buffer collection
+        target (str): Time-series collection, created if missing
+        batch_size (int): Buffers per insert_many
+        granularity (str): Time-series granularity of a new target
+        restart (bool): Ignore the saved progress and start from the first buffer
+
+    Returns:
+        dict: Buffers copied and failed in this run
+    """
+    if is_timeseries(db[source]):
+        raise ValueError(f"{source} is already a time-series collection")
+    writer = ObservationWriter(db, target, granularity)
+    progress = db[PROGRESS_COLLECTION]
+    key = {'_id': f'{source}->{target}'}
+    for name, status in ensure_indexes(db[source], ORDER_INDEX):
+        if status != 'exists':
+            print(f"Index {name} on {source}: {status}")
+    state = None if restart else progress.find_one(key)
+    query = resume_query(state, db[source])
+
+    copied = failed = 0
+    batch = []
+    start = time.time()
+
+    def write():
+        nonlocal copied, failed
+        stored = writer.insert(batch)
+        copied += stored
+        failed += len(batch) - stored
+        last = batch[-1]
+        progress.update_one(key, {'$set': {'last_id': last['_id'], 'last_timestamp': last['timestamp'],
+                                           'updated': time.time()},
+                                  '$inc': {'copied': stored, 'failed': len(batch) - stored}},
+                            upsert=True)
+        batch.clear()
+        print(f"{copied} buffers copied ({copied / (time.time() - start):.0f}/s)")
+
+    for document in db[source].find(query).sort(ORDER).batch_size(batch_size):
+        if 'timestamp' not in document:
+            failed += 1
+            continue
+        batch.append(document)
+        if len(batch) >= batch_size:
+            write()
+    if batch:
+        write()
+    return {'copied': copied, 'failed': failed}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Backfill a buffer collection into a time-series collection')
+    parser.add_argument('--mongo-uri', type=str, default='mongodb://localhost:27017/')
+    parser.add_argument('--db', type=str, default='tracking_data')
+    parser.add_argument('--source', type=str, default='portfinal',
+                        help='Buffer collection to convert')
+    parser.add_argument('--target', type=str, default=None,
+                        help=f'Time-series collection (default: <source>{COLLECTION_SUFFIX})')
+    parser.add_argument('--batch-size', type=int, default=500)
+    parser.add_argument('--granularity', type=str, choices=['seconds', 'minutes', 'hours'],
+                        default=GRANULARITY)
+    parser.add_argument('--restart', action='store_true',
+                        help='Ignore saved progress (observations already copied are duplicated)')
+    args = parser.parse_args()
+
+    db = MongoClient(args.mongo_uri)[args.db]
+    target = args.target or args.source + COLLECTION_SUFFIX
+    result = backfill(db, args.source, target, args.batch_size, args.granularity, args.restart)
+    print(f"{args.source} -> {target}: {result['copied']} buffers copied, {result['failed']} failed")
+
+
+if __name__ == '__main__':
+    main()
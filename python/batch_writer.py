@@ -0,0 +1,185 @@
+"""Batched MongoDB writes.
+
+BatchWriter accumulates documents and hands them to an insert_many style
+callable when the batch reaches max_count documents, max_bytes (estimated
+BSON size) or when its oldest document has waited max_latency seconds.
+One unordered insert_many per batch replaces a round-trip per buffer.
+
+The size/count checks run in add(); the latency check needs someone to call
+flush_due(), either the owner's loop (SinkPipeline workers) or the optional
+background flush thread started with start().
+"""
+import threading
+import time
+
+# Estimated BSON size of a buffer document: fixed fields plus one device
+# document each (measured ~190 B for v2/v3 devices with hex data)
+DOCUMENT_BYTES = 256
+DEVICE_BYTES = 192
+# Devices in the compact encoding (encoding.py: binary data, int MAC, short names)
+COMPACT_DEVICE_BYTES = 80
+
+DEFAULT_BATCH_BYTES = 4 * 1024 * 1024
+
+
+def estimate_size(document):
+    """Approximate BSON size of a buffer document, without encoding it"""
+    if 'devices' not in document:
+        return DOCUMENT_BYTES + COMPACT_DEVICE_BYTES * len(document.get('dv', ()))
+    return DOCUMENT_BYTES + DEVICE_BYTES * len(document['devices'])
+
+
+class BatchWriter:
+    """Accumulates documents and flushes them with one insert_many call"""
+
+    def __init__(self, insert, max_count=500, max_bytes=DEFAULT_BATCH_BYTES, max_latency=1.0,
+                 size=estimate_size, name='batch-writer'):
+        """
+        Args:
+            insert: Callable taking a list of documents, returns how many were
+                stored (exceptions count the whole batch as failed)
+            max_count (int): Flush once this many documents are pending
+            max_bytes (int): Flush once the pending documents reach this size
+            max_latency (float): Longest a document waits before a flush, in
+                seconds (0 flushes on every flush_due() call)
+            size: Callable estimating the size of a document in bytes
+            name (str): Name of the background flush thread
+        """
+        self.insert = insert
+        self.max_count = max_count
+        self.max_bytes = max_bytes
+        self.max_latency = max_latency
+        self.size = size
+        self.name = name
+
+        self._pending = []
+        self._pending_bytes = 0
+        self._oldest = None             # time.monotonic() of the oldest pending document
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()  # One insert at a time keeps batches in order
+        self._wake = threading.Event()
+        self._closing = False
+        self._thread = None
+
+        # Metrics
+        self.stored = 0
+        self.failed = 0
+        self.flushes = 0
+        self.flushed_bytes = 0
+        self.max_flush = 0
+        self.flush_reasons = {'count': 0, 'bytes': 0, 'latency': 0, 'close': 0}
+        self.last_flush_s = 0.0
+        self.max_flush_s = 0.0
+        self.total_flush_s = 0.0
+
+    def __len__(self):
+        with self._lock:
+            return len(self._pending)
+
+    def add(self, document):
+        """Queue one document, flushing in the calling thread if the batch is full"""
+        self.add_many([document])
+
+    def add_many(self, documents):
+        """Queue documents, flushing in the calling thread if the batch is full"""
+        reason = None
+        with self._lock:
+            if self._oldest is None and documents:
+                self._wake.set()  # Let the flush thread time the new batch
+            for document in documents:
+                if self._oldest is None:
+                    self._oldest = time.monotonic()
+                self._pending.append(document)
+                self._pending_bytes += self.size(document)
+            if len(self._pending) >= self.max_count:
+                reason = 'count'
+            elif self._pending_bytes >= self.max_bytes:
+                reason = 'bytes'
+        if reason:
+            self.flush(reason)
+
+    def time_to_flush(self):
+        """Seconds until the oldest pending document is due, None when empty"""
+        with self._lock:
+            if self._oldest is None:
+                return None
+            return max(0.0, self._oldest + self.max_latency - time.monotonic())
+
+    def flush_due(self):
+        """Flush if the oldest pending document has waited max_latency"""
+        wait = self.time_to_flush()
+        if wait is not None and wait <= 0:
+            return self.flush('latency')
+        return 0
+
+    def flush(self, reason='close'):
+        """
+        Write every pending document with one insert call
+
+        Returns:
+            int: Documents stored by this flush
+        """
+        with self._flush_lock:
+            with self._lock:
+                documents, self._pending = self._pending, []
+                size, self._pending_bytes = self._pending_bytes, 0
+                self._oldest = None
+            if not documents:
+                return 0
+
+            start = time.perf_counter()
+            try:
+                stored = self.insert(documents)
+            except Exception:
+                stored = 0
+            elapsed = time.perf_counter() - start
+
+            self.stored += stored
+            self.failed += len(documents) - stored
+            self.flushes += 1
+            self.flushed_bytes += size
+            self.max_flush = max(self.max_flush, len(documents))
+            self.flush_reasons[reason] = self.flush_reasons.get(reason, 0) + 1
+            self.last_flush_s = elapsed
+            self.max_flush_s = max(self.max_flush_s, elapsed)
+            self.total_flush_s += elapsed
+            return stored
+
+    def _run(self):
+        while not self._closing:
+            wait = self.time_to_flush()
+            self._wake.wait(wait if wait is None else max(wait, 0.001))
+            self._wake.clear()
+            self.flush_due()
+
+    def start(self):
+        """Flush on max_latency from a background thread"""
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+            self._thread.start()
+        return self
+
+    def close(self):
+        """Stop the flush thread and write what is pending"""
+        self._closing = True
+        self._wake.set()
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+        return self.flush('close')
+
+    def stats(self):
+        """Flush counts, sizes and insert latencies"""
+        return {
+            'pending': len(self),
+            'stored': self.stored,
+            'failed': self.failed,
+            'flushes': self.flushes,
+            'avg_flush': round((self.stored + self.failed) / self.flushes, 1) if self.flushes else 0.0,
+            'max_flush': self.max_flush,
+            'flushed_bytes': self.flushed_bytes,
+            'reasons': dict(self.flush_reasons),
+            'last_flush_ms': round(self.last_flush_s * 1000, 2),
+            'avg_flush_ms': round(self.total_flush_s / self.flushes * 1000, 2) if self.flushes else 0.0,
+            'max_flush_ms': round(self.max_flush_s * 1000, 2),
+        }
@@ -0,0 +1,5 @@
+"""Parser and pipeline micro-benchmarks.
+
+Run from the python/ directory:
+    python -m benchmarks --output results.json --baseline benchmarks/baseline.json
+"""
@@ -0,0 +1,65 @@
+import argparse
+import json
+import platform
+import sys
+from datetime import datetime
+
+import numpy as np
+
+from benchmarks.suite import CASES, N_MAC_VALUES, compare, run_suite
+from protocol import PROTOCOLS
+
+
+def main():
+    parser = argparse.ArgumentParser(description='BLE scanner ingest benchmarks')
+    parser.add_argument('--protocols', type=str, default=','.join(PROTOCOLS),
+                        help=f'Comma-separated layouts (default: {",".join(PROTOCOLS)})')
+    parser.add_argument('--n-mac', type=str, default=','.join(map(str, N_MAC_VALUES)),
+                        help='Comma-separated devices per buffer (default: 1,50,255,1024)')
+    parser.add_argument('--cases', type=str, default=','.join(CASES),
+                        help='Comma-separated cases (default: all)')
+    parser.add_argument('--min-time', type=float, default=0.2,
+                        help='Seconds measured per case (default: 0.2)')
+    parser.add_argument('--output', type=str,
+                        help='Write results as JSON to this file')
+    parser.add_argument('--baseline', type=str,
+                        help='Baseline JSON to compare against')
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help='Relative slowdown reported as regression (default: 0.2)')
+    args = parser.parse_args()
+
+    results = run_suite(
+        protocols=args.protocols.split(','),
+        n_mac_values=[int(n) for n in args.n_mac.split(',')],
+        cases=args.cases.split(','),
+        min_time=args.min_time
+    )
+    report = {
+        'meta': {
+            'date': datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'platform': platform.platform(),
+            'machine': platform.machine(),
+        },
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"Results written to {args.output}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.threshold)
+        for result, base, ratio in regressions:
+            print(f"REGRESSION {result['case']} {result['protocol']} n_mac={result['n_mac']}: "
+                  f"{result['frames_per_s']:.1f} vs {base:.1f} frames/s ({ratio:.0%})")
+        if regressions:
+            sys.exit(1)
+        print(f"No regressions beyond {args.threshold:.0%} against {args.baseline}")
+
+
+if __name__ == "__main__":
+    main()
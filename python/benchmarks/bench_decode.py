@@ -0,0 +1,89 @@
+"""Benchmark batch NumPy decoding against the original per-record parsing loop
+
+Usage:
+    python benchmarks/bench_decode.py [--repeat 200]
+"""
+import argparse
+import os
+import random
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from device_batch import decode_devices
+
+DEVICE_LENGTH = 42
+
+
+def parse_device(data):
+    """Original UARTReceiver._parse_device, kept as the per-record baseline"""
+    device = {}
+    device['mac'] = ':'.join(f'{b:02X}' for b in data[0:6])
+    device['addr_type'] = data[6]
+    device['adv_type'] = data[7]
+    rssi_byte = data[8]
+    device['rssi'] = -(256 - rssi_byte) if rssi_byte > 127 else -rssi_byte
+    device['data_len'] = data[9]
+    device['data'] = data[10:41]
+    device['n_adv'] = data[41]
+    return device
+
+
+def make_payload(n_mac, device_length=DEVICE_LENGTH):
+    """Random device records in the 42-byte layout"""
+    rng = random.Random(n_mac)
+    return bytes(rng.getrandbits(8) for _ in range(n_mac * device_length))
+
+
+def loop_decode(payload, n_mac):
+    """Original path: one parse_device dict per record, then the stored document"""
+    documents = []
+    for i in range(n_mac):
+        offset = i * DEVICE_LENGTH
+        device = parse_device(payload[offset:offset + DEVICE_LENGTH])
+        documents.append({
+            'mac': device['mac'],
+            'addr_type': device['addr_type'],
+            'adv_type': device['adv_type'],
+            'rssi': device['rssi'],
+            'data_len': device['data_len'],
+            'data': device['data'].hex(),
+            'n_adv': device['n_adv']
+        })
+    return documents
+
+
+def batch_columns(payload, n_mac):
+    """Batch path, columnar consumer (no per-device objects)"""
+    batch = decode_devices(payload, n_mac)
+    return batch['rssi'].mean() if n_mac else 0, int(batch['n_adv'].sum())
+
+
+def batch_documents(payload, n_mac):
+    """Batch path, building the stored documents"""
+    return decode_devices(payload, n_mac).to_documents()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Device decoding benchmark')
+    parser.add_argument('--repeat', type=int, default=200,
+                        help='Buffers decoded per measurement (default: 200)')
+    args = parser.parse_args()
+
+    print(f"{'n_mac':>6} {'loop buf/s':>12} {'batch docs buf/s':>17} "
+          f"{'batch cols buf/s':>17} {'speedup docs':>13} {'speedup cols':>13}")
+    for n_mac in (1, 50, 255, 1024):
+        payload = make_payload(n_mac)
+        loop = min(timeit.repeat(lambda: loop_decode(payload, n_mac),
+                                 number=args.repeat, repeat=3))
+        docs = min(timeit.repeat(lambda: batch_documents(payload, n_mac),
+                                 number=args.repeat, repeat=3))
+        cols = min(timeit.repeat(lambda: batch_columns(payload, n_mac),
+                                 number=args.repeat, repeat=3))
+        print(f"{n_mac:>6} {args.repeat / loop:>12.0f} {args.repeat / docs:>17.0f} "
+              f"{args.repeat / cols:>17.0f} {loop / docs:>12.1f}x {loop / cols:>12.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+"""Compare the standard and compact (encoding.py) storage encodings
+
+For simulated v2 buffers, reports per buffer:
+    BSON bytes     - document size: network transfer, uncompressed storage
+                     and the WiredTiger cache (working set) footprint
+    zlib bytes     - a batch of documents compressed together, standing in
+                     for block compression of the collection on disk
+    mac index      - key bytes of a multikey index on the device MACs
+    build / expand - time to build the documents and to expand compact ones
+                     back to the standard layout
+
+Usage:
+    python benchmarks/bench_encoding.py [--buffers 200]
+"""
+import argparse
+import os
+import sys
+import timeit
+import zlib
+from datetime import datetime
+
+import bson
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from encoding import COMPACT_VERSION, DEVICES_FIELD, ENCODING_FIELD, compact_devices, expand_documents
+from protocol import PROTOCOLS
+from simulator import ScannerSimulator
+
+
+def make_batches(n_mac, buffers, protocol='v2'):
+    """DeviceBatches of simulated buffers with n_mac devices each"""
+    layout = PROTOCOLS[protocol]
+    simulator = ScannerSimulator(protocol, devices=n_mac, presence=1.0, seed=n_mac)
+    return [layout.decode_devices(simulator.make_frame()) for _ in range(buffers)]
+
+
+def buffer_fields(index):
+    return {'timestamp': datetime.now(), 'scanner': '/dev/ttyUSB0', 'sequence': index,
+            'n_adv_raw': 0, 'n_mac': 0, 'buffer_index': index, 'epoch': 0}
+
+
+def standard_documents(batches):
+    return [{**buffer_fields(i), 'devices': batch.to_documents()} for i, batch in enumerate(batches)]
+
+
+def compact_documents(batches):
+    return [{**buffer_fields(i), ENCODING_FIELD: COMPACT_VERSION, DEVICES_FIELD: compact_devices(batch)}
+            for i, batch in enumerate(batches)]
+
+
+def mac_key_bytes(value):
+    """BSON bytes of one index key holding value"""
+    return len(bson.encode({'': value})) - 5
+
+
+def measure(documents, devices_field, mac_field):
+    encoded = [bson.encode(document) for document in documents]
+    keys = sum(mac_key_bytes(device[mac_field])
+               for document in documents for device in document[devices_field])
+    buffers = len(documents)
+    return {
+        'bson': sum(map(len, encoded)) / buffers,
+        'zlib': len(zlib.compress(b''.join(encoded), 6)) / buffers,
+        'index': keys / buffers,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Storage encoding benchmark')
+    parser.add_argument('--buffers', type=int, default=200,
+                        help='Buffers simulated per n_mac (default: 200)')
+    args = parser.parse_args()
+
+    print(f"{'n_mac':>6} {'encoding':>9} {'BSON B':>10} {'zlib B':>10} {'mac idx B':>10} "
+          f"{'build ms':>9} {'expand ms':>10}")
+    for n_mac in (1, 50, 255):
+        batches = make_batches(n_mac, args.buffers)
+        standard = standard_documents(batches)
+        compact = compact_documents(batches)
+        results = {
+            'standard': measure(standard, 'devices', 'mac'),
+            'compact': measure(compact, DEVICES_FIELD, 'm'),
+        }
+        times = {
+            'standard': (min(timeit.repeat(lambda: standard_documents(batches), number=1, repeat=3)), None),
+            'compact': (min(timeit.repeat(lambda: compact_documents(batches), number=1, repeat=3)),
+                        min(timeit.repeat(lambda: expand_documents(compact), number=1, repeat=3))),
+        }
+        for encoding, result in results.items():
+            build, expand = times[encoding]
+            print(f"{n_mac:>6} {encoding:>9} {result['bson']:>10.0f} {result['zlib']:>10.0f} "
+                  f"{result['index']:>10.0f} {build / args.buffers * 1000:>9.3f} "
+                  f"{expand / args.buffers * 1000 if expand else 0:>10.3f}")
+        saved = {key: 1 - results['compact'][key] / results['standard'][key] for key in results['compact']}
+        print(f"{'':>6} {'saved':>9} {saved['bson']:>10.0%} {saved['zlib']:>10.0%} {saved['index']:>10.0%}")
+
+
+if __name__ == "__main__":
+    main()
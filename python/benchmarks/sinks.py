@@ -0,0 +1,150 @@
+"""In-memory stand-ins for MongoDB and MQTT used by the benchmarks"""
+import logging
+import os
+import shutil
+import signal
+import tempfile
+from types import SimpleNamespace
+
+# Signals publish.py takes over in its constructor
+SIGNALS = [getattr(signal, name) for name in ('SIGTERM', 'SIGINT', 'SIGHUP', 'SIGQUIT')
+           if hasattr(signal, name)]
+
+
+class MemoryCollection:
+    """Collects documents like a pymongo collection would store them"""
+
+    def __init__(self, database=None, name='memory'):
+        self.database = database
+        self.name = name
+        self.documents = []
+        self.indexes = {'_id_': {'key': [('_id', 1)]}}
+
+    def insert_one(self, document):
+        self.documents.append(document)
+        return SimpleNamespace(inserted_id=len(self.documents))
+
+    def insert_many(self, documents, ordered=True):
+        start = len(self.documents)
+        self.documents.extend(documents)
+        return SimpleNamespace(inserted_ids=list(range(start + 1, len(self.documents) + 1)))
+
+    def index_information(self):
+        return self.indexes
+
+    def create_index(self, keys, name=None, **options):
+        self.indexes[name] = {'key': list(keys)}
+        return name
+
+
+class MemoryDatabase:
+    """Database of MemoryCollections, by attribute or item like pymongo"""
+
+    def __init__(self, name):
+        self.name = name
+        self.collections = {}
+
+    def __getitem__(self, name):
+        if name not in self.collections:
+            self.collections[name] = MemoryCollection(self, name)
+        return self.collections[name]
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return self[name]
+
+    def command(self, command, value=None, **kwargs):
+        if command == 'explain':
+            return {'queryPlanner': {'winningPlan': {'stage': 'EOF'}}}
+        return {'ok': 1.0}
+
+
+class MemoryMongoClient:
+    """pymongo MongoClient whose databases live in memory"""
+
+    def __init__(self):
+        self.databases = {}
+
+    def __getitem__(self, name):
+        if name not in self.databases:
+            self.databases[name] = MemoryDatabase(name)
+        return self.databases[name]
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return self[name]
+
+    def server_info(self):
+        return {'version': 'memory'}
+
+    def close(self):
+        pass
+
+
+class MemoryMQTTClient:
+    """Collects published payloads like paho's publish(), never connects"""
+
+    def __init__(self):
+        self.messages = []
+
+    def publish(self, topic, payload=None, qos=0, retain=False, properties=None):
+        self.messages.append(payload)
+        return SimpleNamespace(rc=0, mid=len(self.messages))
+
+    def username_pw_set(self, username, password=None):
+        pass
+
+    def max_inflight_messages_set(self, inflight):
+        pass
+
+    def connect(self, host, port=1883, keepalive=60):
+        return 0
+
+    def connect_async(self, host, port=1883, keepalive=60):
+        pass
+
+    def loop_start(self):
+        pass
+
+    def loop_stop(self):
+        pass
+
+    def disconnect(self):
+        pass
+
+
+def make_receiver(cls, port, protocol, **options):
+    """
+    Build a receiver through its constructor on port, with memory clients
+
+    MongoDB receivers get a MemoryMongoClient, the publisher a
+    MemoryMQTTClient. The constructor runs in a scratch directory with
+    logging disabled, so it leaves no log files and prints nothing; its
+    handlers are then swapped for a NullHandler at INFO, the level the
+    receivers log at by default. Ctrl-C keeps stopping the benchmarks.
+    """
+    if hasattr(cls, '_publish_buffer'):
+        options.setdefault('mqtt_client', MemoryMQTTClient())
+    else:
+        options.setdefault('mongo_client', MemoryMongoClient())
+    handlers = {signum: signal.getsignal(signum) for signum in SIGNALS}
+    cwd = os.getcwd()
+    directory = tempfile.mkdtemp(prefix='benchmark-')
+    logging.disable(logging.CRITICAL)
+    try:
+        os.chdir(directory)
+        receiver = cls(port, protocol=protocol, **options)
+    finally:
+        os.chdir(cwd)
+        logging.disable(logging.NOTSET)
+        for signum, handler in handlers.items():
+            signal.signal(signum, handler)
+    for handler in receiver.logger.handlers:
+        handler.close()
+    null = logging.NullHandler()
+    null.setLevel(logging.INFO)
+    receiver.logger.handlers = [null]
+    shutil.rmtree(directory, ignore_errors=True)
+    return receiver
@@ -0,0 +1,234 @@
+"""Benchmark cases for the UART ingest hot loop"""
+import importlib
+import itertools
+import json
+import os
+import tempfile
+import time
+from datetime import datetime
+
+from capture import CaptureWriter
+from framing import FrameReader
+from protocol import PROTOCOLS
+from simulator import ScannerSimulator
+from benchmarks.sinks import make_receiver
+
+N_MAC_VALUES = (1, 50, 255, 1024)
+STREAM_BYTES = 1_000_000  # Approximate size of the streams replayed per case
+ROUNDS = 5
+
+
+def measure(func, min_time, rounds=ROUNDS):
+    """
+    Call func repeatedly for at least min_time seconds, returns calls/s
+
+    The time is split into rounds and the fastest one counts, like timeit's
+    min: a slow round measures the machine, not the code.
+    """
+    best = 0.0
+    for _ in range(rounds):
+        calls = 0
+        start = time.perf_counter()
+        while True:
+            func()
+            calls += 1
+            elapsed = time.perf_counter() - start
+            if elapsed >= min_time / rounds:
+                break
+        best = max(best, calls / elapsed)
+    return best
+
+
+def make_frames(protocol, n_mac, count):
+    """Frames with exactly n_mac devices from a fully present population"""
+    simulator = ScannerSimulator(protocol.name, devices=n_mac, presence=1.0, seed=n_mac)
+    return [simulator.make_frame() for _ in range(count)]
+
+
+class Workload:
+    """Frames and receivers shared by the cases of one (protocol, n_mac)"""
+
+    def __init__(self, protocol, n_mac):
+        self.protocol = protocol
+        self.n_mac = n_mac
+        frame_length = protocol.frame_length(n_mac)
+        self.frames = make_frames(protocol, n_mac, max(4, min(2000, STREAM_BYTES // frame_length)))
+        self.stream = b''.join(self.frames)
+        self.frame = self.frames[0]
+        self.header = protocol.parse_header(self.frame)
+        self.batch = protocol.decode_devices(self.frame)
+
+        uart_mongo = importlib.import_module('uart-mongo')
+        publish = importlib.import_module('publish')
+        self.mongo_receiver = make_receiver(uart_mongo.UARTMongoReceiver, 'loop://', protocol.name)
+        self.publisher = make_receiver(publish.UARTMQTTPublisher, 'loop://', protocol.name)
+
+    def close(self):
+        self.mongo_receiver.close()
+        self.publisher.close()
+
+
+def case_sync(work):
+    """Header sync and framing of a raw stream (FrameReader)"""
+    view = memoryview(work.stream)
+
+    def run():
+        reader = FrameReader(None, work.protocol)
+        for offset in range(0, len(view), 4096):
+            reader.feed(view[offset:offset + 4096])
+            while reader.next_frame():
+                pass
+    return run, len(work.frames)
+
+
+def case_parse_header(work):
+    """_parse_header on one frame"""
+    header = work.frame[:work.protocol.header_length]
+    return (lambda: work.protocol.parse_header(header)), 1
+
+
+def case_parse_device(work):
+    """Per-record _parse_device over all devices of a frame"""
+    protocol = work.protocol
+    records = [work.frame[offset:offset + protocol.device_length]
+               for offset in range(protocol.header_length, len(work.frame), protocol.device_length)]
+
+    def run():
+        for record in records:
+            protocol.parse_device(record)
+    return run, 1
+
+
+def case_decode_devices(work):
+    """Batch NumPy decode of all devices of a frame"""
+    return (lambda: work.protocol.decode_devices(work.frame)), 1
+
+
+def case_store_buffer(work):
+    """Document building in UARTMongoReceiver._store_buffer (memory collection)"""
+    receiver = work.mongo_receiver
+    buffer_index = itertools.count()
+
+    def run():
+        # A new buffer_index each call: the same _id again would be skipped as a duplicate
+        receiver._store_buffer(dict(work.header, buffer_index=next(buffer_index)), work.batch)
+        receiver.collection.documents.clear()
+    return run, 1
+
+
+def _publish_case(payload_format):
+    def case(work):
+        publisher = work.publisher
+
+        def run():
+            publisher.payload_format = payload_format
+            publisher._publish_buffer(work.header, work.batch)
+            publisher.mqtt_client.messages.clear()
+        return run, 1
+    case.__doc__ = (f"Document building and {payload_format} encoding in "
+                    f"UARTMQTTPublisher._publish_buffer")
+    return case
+
+
+case_publish_buffer = _publish_case('json')
+case_publish_bson = _publish_case('bson')
+case_publish_frame = _publish_case('frame')
+
+
+def case_json_encode(work):
+    """json.dumps of a published buffer document"""
+    document = {
+        'timestamp': datetime.now().isoformat(),
+        'sequence': work.header['sequence'],
+        'n_adv_raw': work.header['n_adv_raw'],
+        'n_mac': work.header['n_mac'],
+        'devices': work.batch.to_documents(),
+    }
+    return (lambda: json.dumps(document)), 1
+
+
+def case_end_to_end(work):
+    """Replay of a capture into UARTMongoReceiver with a memory collection"""
+    fd, path = tempfile.mkstemp(suffix='.cap')
+    os.close(fd)
+    writer = CaptureWriter(path)
+    for offset in range(0, len(work.stream), 4096):
+        writer.write(work.stream[offset:offset + 4096])
+    writer.close()
+    uart_mongo = importlib.import_module('uart-mongo')
+
+    def run():
+        receiver = make_receiver(uart_mongo.UARTMongoReceiver,
+                                 f'replay://{path}?speed=max', work.protocol.name)
+        receiver.receive_messages()
+        receiver.close()
+    run.cleanup = lambda: os.remove(path)
+    return run, len(work.frames)
+
+
+CASES = {
+    'sync': case_sync,
+    'parse_header': case_parse_header,
+    'parse_device': case_parse_device,
+    'decode_devices': case_decode_devices,
+    'store_buffer': case_store_buffer,
+    'publish_buffer': case_publish_buffer,
+    'publish_bson': case_publish_bson,
+    'publish_frame': case_publish_frame,
+    'json_encode': case_json_encode,
+    'end_to_end': case_end_to_end,
+}
+
+
+def run_suite(protocols=None, n_mac_values=N_MAC_VALUES, cases=None, min_time=0.2,
+              progress=print):
+    """
+    Run the selected cases for every protocol and n_mac
+
+    Returns:
+        list: One dict per measurement with frames_per_s and devices_per_s
+    """
+    results = []
+    for name in protocols or list(PROTOCOLS):
+        protocol = PROTOCOLS[name]
+        for n_mac in n_mac_values:
+            if n_mac > protocol.max_devices:
+                continue
+            work = Workload(protocol, n_mac)
+            for case in cases or list(CASES):
+                run, frames_per_call = CASES[case](work)
+                frames_per_s = measure(run, min_time) * frames_per_call
+                if hasattr(run, 'cleanup'):
+                    run.cleanup()
+                result = {
+                    'case': case,
+                    'protocol': name,
+                    'n_mac': n_mac,
+                    'frames_per_s': round(frames_per_s, 1),
+                    'devices_per_s': round(frames_per_s * n_mac, 1),
+                }
+                results.append(result)
+                if progress:
+                    progress(f"{case:>15} {name:>8} n_mac={n_mac:<5} "
+                             f"{result['frames_per_s']:>12.1f} frames/s "
+                             f"{result['devices_per_s']:>14.1f} devices/s")
+            work.close()
+    return results
+
+
+def compare(results, baseline, threshold=0.2):
+    """
+    Compare results against a baseline run
+
+    Returns:
+        list: (result, baseline frames_per_s, ratio) for cases slower than
+        baseline by more than threshold
+    """
+    reference = {(r['case'], r['protocol'], r['n_mac']): r['frames_per_s']
+                 for r in baseline.get('results', [])}
+    regressions = []
+    for result in results:
+        base = reference.get((result['case'], result['protocol'], result['n_mac']))
+        if base and result['frames_per_s'] < base * (1 - threshold):
+            regressions.append((result, base, result['frames_per_s'] / base))
+    return regressions
@@ -0,0 +1,199 @@
+"""Raw UART capture files and replay.
+
+File layout: an 8-byte file magic followed by records of
+<uint64 monotonic_ns><uint32 length><length raw bytes>, one per bulk read.
+
+Receivers record with --capture FILE and replay by using
+replay://FILE[?speed=N|max] as their port, e.g.:
+    python uart-mongo.py --port "replay://field.cap?speed=max"
+"""
+import argparse
+import bisect
+import mmap
+import os
+import struct
+import time
+from urllib.parse import urlparse, parse_qs, unquote
+import serial
+
+FILE_MAGIC = b'BLECAP\x01\x00'
+RECORD_HEADER = struct.Struct('<QI')
+
+
+class EndOfCapture(serial.SerialException):
+    """Raised by ReplaySerial once every recorded byte has been read"""
+
+
+class CaptureWriter:
+    """Appends raw received bytes with monotonic timestamps"""
+
+    def __init__(self, path):
+        new_file = not os.path.exists(path) or os.path.getsize(path) == 0
+        self.path = path
+        self._file = open(path, 'ab')
+        if new_file:
+            self._file.write(FILE_MAGIC)
+        self.records = 0
+        self.bytes = 0
+
+    def write(self, data):
+        """Append one chunk of received bytes"""
+        self._file.write(RECORD_HEADER.pack(time.monotonic_ns(), len(data)))
+        self._file.write(data)
+        self.records += 1
+        self.bytes += len(data)
+
+    def close(self):
+        if not self._file.closed:
+            self._file.close()
+
+
+def read_records(data):
+    """
+    Index the records of a capture
+
+    Args:
+        data: Bytes-like capture contents (e.g. an mmap)
+
+    Returns:
+        list: (timestamp_ns, offset, length) for each complete record
+    """
+    if data[:len(FILE_MAGIC)] != FILE_MAGIC:
+        raise ValueError("Not a BLE scanner capture file")
+    records = []
+    pos = len(FILE_MAGIC)
+    while pos + RECORD_HEADER.size <= len(data):
+        timestamp, length = RECORD_HEADER.unpack_from(data, pos)
+        pos += RECORD_HEADER.size
+        if pos + length > len(data):
+            break  # Truncated last record (capture interrupted)
+        records.append((timestamp, pos, length))
+        pos += length
+    return records
+
+
+class ReplaySerial:
+    """Read-only serial port that plays back a capture file.
+
+    speed=1 reproduces the recorded timing, speed=N plays N times faster and
+    speed=None makes all data available immediately (max speed).
+    """
+
+    def __init__(self, path, speed=1.0, timeout=None):
+        self.port = path
+        self.speed = speed
+        self.timeout = timeout
+        self._file = open(path, 'rb')
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        self._records = read_records(self._map)
+
+        # Identifies the capture: replays of one file get the same buffer ids (dedup.py)
+        self.session = self._records[0][0] if self._records else None
+
+        # Release time (seconds after start) and cumulative bytes per record
+        first = self._records[0][0] if self._records else 0
+        self._release = [(ts - first) / 1e9 for ts, _, _ in self._records]
+        self._cumulative = [0]
+        for _, _, length in self._records:
+            self._cumulative.append(self._cumulative[-1] + length)
+
+        self._record = 0      # Record being read
+        self._position = 0    # Bytes already read in total
+        self._started = time.monotonic()
+        self.is_open = True
+
+    @property
+    def total_bytes(self):
+        return self._cumulative[-1]
+
+    def _released(self):
+        """Number of records available at the current time"""
+        if not self.speed:
+            return len(self._records)
+        elapsed = (time.monotonic() - self._started) * self.speed
+        return bisect.bisect_right(self._release, elapsed)
+
+    @property
+    def in_waiting(self):
+        """Released bytes not read yet; raises EndOfCapture once all were read,
+        like a real port whose device went away"""
+        if self._position >= self.total_bytes:
+            raise EndOfCapture(f"End of capture {self.port}")
+        return self._cumulative[self._released()] - self._position
+
+    def read(self, size=1):
+        """Read up to size released bytes, waiting for the first like a serial port"""
+        if self._position >= self.total_bytes:
+            raise EndOfCapture(f"End of capture {self.port}")
+
+        deadline = None if self.timeout is None else time.monotonic() + self.timeout
+        while self._released() <= self._record:
+            wait = self._release[self._record] / self.speed - (time.monotonic() - self._started)
+            if deadline is not None:
+                wait = min(wait, deadline - time.monotonic())
+                if wait <= 0:
+                    return b''
+            time.sleep(max(wait, 0))
+
+        available = self._cumulative[self._released()] - self._position
+        size = min(size, available)
+        chunks = []
+        while size:
+            _, offset, length = self._records[self._record]
+            skip = self._position - self._cumulative[self._record]
+            take = min(size, length - skip)
+            chunks.append(self._map[offset + skip:offset + skip + take])
+            self._position += take
+            size -= take
+            if skip + take == length:
+                self._record += 1
+        return b''.join(chunks)
+
+    def write(self, data):
+        """Replies (e.g. chunk ACKs) have nowhere to go during replay"""
+        return len(data)
+
+    def reset_input_buffer(self):
+        pass
+
+    def reset_output_buffer(self):
+        pass
+
+    def close(self):
+        if self.is_open:
+            self._map.close()
+            self._file.close()
+            self.is_open = False
+
+
+def open_port(port, baudrate=115200, **kwargs):
+    """
+    Open a serial port, pyserial URL or replay://FILE[?speed=N|max]
+
+    Returns:
+        Serial-compatible object
+    """
+    if port.startswith('replay://'):
+        url = urlparse(port)
+        path = unquote(url.netloc + url.path)
+        speed = parse_qs(url.query).get('speed', ['1'])[0]
+        speed = None if speed == 'max' else float(speed)
+        return ReplaySerial(path, speed=speed, timeout=kwargs.get('timeout'))
+    return serial.serial_for_url(port, baudrate, **kwargs)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='BLE scanner capture file info')
+    parser.add_argument('file', type=str, help='Capture file')
+    args = parser.parse_args()
+
+    with open(args.file, 'rb') as f:
+        data = f.read()
+    records = read_records(data)
+    total = sum(length for _, _, length in records)
+    duration = (records[-1][0] - records[0][0]) / 1e9 if records else 0
+    print(f"Records: {len(records)}")
+    print(f"Bytes: {total}")
+    print(f"Duration: {duration:.3f} s")
+    if duration:
+        print(f"Average rate: {total / duration:.0f} B/s")
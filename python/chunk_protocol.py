@@ -0,0 +1,196 @@
+import struct
+import numpy as np
+from framing import FrameReader
+from protocol import HEADER_MAGIC, PROTOCOLS
+
+# Constants from src/chunk_protocol.h
+CHUNK_SIZE = 128
+CHUNK_HEADER = struct.Struct('<BBBBHH')  # start_marker, type, sequence, n_devices, total_devices, chunk_offset
+CHUNK_CRC = struct.Struct('<H')
+CHUNK_PAYLOAD_SIZE = CHUNK_SIZE - CHUNK_HEADER.size - CHUNK_CRC.size
+START_MARKER = 0x55
+
+CHUNK_TYPE_START = 0x01
+CHUNK_TYPE_DATA = 0x02
+CHUNK_TYPE_END = 0x03
+CHUNK_TYPE_ACK = 0x04
+CHUNK_TYPE_NACK = 0x05
+
+# Chunks carry the firmware struct device_data (v3 layout)
+CHUNK_PROTOCOL = PROTOCOLS['v3']
+MAX_DEVICES_PER_CHUNK = CHUNK_PAYLOAD_SIZE // CHUNK_PROTOCOL.device_length
+
+
+def _make_crc16_table(poly=0xA001):
+    """256-entry table for the reflected CRC-16 polynomial 0x8005"""
+    table = []
+    for byte in range(256):
+        crc = byte
+        for _ in range(8):
+            crc = (crc >> 1) ^ poly if crc & 1 else crc >> 1
+        table.append(crc)
+    return tuple(table)
+
+
+CRC16_TABLE = _make_crc16_table()
+
+
+def crc16(data, crc=0xFFFF):
+    """
+    Table-driven CRC-16 matching calculate_crc16 in src/chunk_protocol.c
+
+    The firmware starts from 0xFFFF (CRC-16/MODBUS); pass crc=0 for the
+    CRC-16/ARC variant of the same polynomial.
+    """
+    table = CRC16_TABLE
+    for byte in data:
+        crc = (crc >> 8) ^ table[(crc ^ byte) & 0xFF]
+    return crc
+
+
+class ChunkReader(FrameReader):
+    """Reassembles buffers sent with send_buffer_chunked.
+
+    Every chunk is CRC-checked and answered with a single ACK or NACK byte,
+    which is what uart_wait_ack expects. The devices of a buffer are
+    collected until total_devices is reached and returned as one v3 frame,
+    so receivers decode them exactly like a raw buffer.
+    """
+
+    def __init__(self, source, read_size=4096, capture=None):
+        super().__init__(source, CHUNK_PROTOCOL, read_size=read_size, capture=capture)
+        self._reset()
+
+        # Statistics
+        self.chunks = 0
+        self.crc_failures = 0
+        self.retries = 0
+        self.acks_sent = 0
+        self.nacks_sent = 0
+        self.orphan_chunks = 0
+        self.incomplete_buffers = 0
+        self.payload_bytes = 0
+
+    def _reset(self):
+        """Forget the buffer being reassembled"""
+        self._total = None
+        self._devices = bytearray()
+        self._last_chunk = None
+
+    def _reply(self, response):
+        """Send an ACK or NACK byte back to the scanner"""
+        write = getattr(self.source, 'write', None)
+        if write is None:
+            return
+        write(bytes([response]))
+        if response == CHUNK_TYPE_ACK:
+            self.acks_sent += 1
+        else:
+            self.nacks_sent += 1
+
+    def _build_frame(self):
+        """Pack the reassembled devices as a complete v3 frame"""
+        n_mac = self._total
+        devices = bytes(self._devices[:n_mac * self.protocol.device_length])
+        n_adv_raw = int(np.frombuffer(devices, self.protocol.device_dtype)['n_adv'].sum())
+        header = {
+            'sequence': self.frames % 256,  # Chunks carry no buffer sequence
+            'n_adv_raw': n_adv_raw & 0xFFFF,
+            'n_mac': n_mac,
+        }
+        frame = self.protocol.header_struct.pack(
+            HEADER_MAGIC, header['sequence'], header['n_adv_raw'], n_mac, 0
+        ) + devices
+        self.frames += 1
+        self.payload_bytes += len(devices)
+        self._reset()
+        return header, memoryview(frame)
+
+    def next_frame(self):
+        """Process buffered chunks until a whole buffer is reassembled
+
+        Returns:
+            tuple: (header dict, memoryview of the rebuilt frame) or None if
+            more data is needed
+        """
+        device_length = self.protocol.device_length
+        while True:
+            pos = self._buffer.find(START_MARKER, self._start, self._end)
+            if pos < 0:
+                self._discard(self.buffered)
+                return None
+            if pos > self._start:
+                self.resyncs += 1
+                self._discard(pos - self._start)
+
+            if self.buffered < CHUNK_HEADER.size:
+                return None
+
+            _, chunk_type, sequence, n_devices, total_devices, _ = \
+                CHUNK_HEADER.unpack_from(self._view, pos)
+            if (chunk_type not in (CHUNK_TYPE_START, CHUNK_TYPE_DATA, CHUNK_TYPE_END)
+                    or n_devices > MAX_DEVICES_PER_CHUNK
+                    or total_devices > self.protocol.max_devices):
+                self.resyncs += 1
+                self._discard(1)
+                continue
+
+            payload_end = pos + CHUNK_HEADER.size + n_devices * device_length
+            chunk_length = payload_end + CHUNK_CRC.size - pos
+            if self.buffered < chunk_length:
+                return None
+
+            (crc,) = CHUNK_CRC.unpack_from(self._view, payload_end)
+            if crc16(self._view[pos:payload_end]) != crc:
+                # One NACK per chunk: uart_wait_ack takes every extra reply
+                # byte as the answer to a retransmission. Skip the whole chunk
+                # so its bytes are not NACKed again while resyncing.
+                self.crc_failures += 1
+                self._reply(CHUNK_TYPE_NACK)
+                self._start = pos + chunk_length
+                continue
+
+            self._start = pos + chunk_length
+            self.chunks += 1
+            self._reply(CHUNK_TYPE_ACK)
+
+            if (sequence, crc) == self._last_chunk:
+                # Our ACK was lost and the scanner sent the chunk again
+                self.retries += 1
+                continue
+
+            if chunk_type == CHUNK_TYPE_START:
+                if self._total is not None:
+                    self.incomplete_buffers += 1
+                self._reset()
+                self._total = total_devices
+            elif self._total is None or total_devices != self._total:
+                # DATA/END without its START (or from another buffer)
+                self.orphan_chunks += 1
+                continue
+
+            self._devices += self._view[pos + CHUNK_HEADER.size:payload_end]
+            self._last_chunk = (sequence, crc)
+
+            if len(self._devices) >= self._total * device_length:
+                return self._build_frame()
+            if chunk_type == CHUNK_TYPE_END:
+                # Scanner finished the buffer but devices are missing
+                self.incomplete_buffers += 1
+                self._reset()
+
+    def stats(self):
+        """Return reader counters, including effective goodput"""
+        stats = super().stats()
+        stats.update({
+            'chunks': self.chunks,
+            'crc_failures': self.crc_failures,
+            'retries': self.retries,
+            'acks_sent': self.acks_sent,
+            'nacks_sent': self.nacks_sent,
+            'orphan_chunks': self.orphan_chunks,
+            'incomplete_buffers': self.incomplete_buffers,
+            'payload_bytes': self.payload_bytes,
+            'goodput': self.payload_bytes / self.bytes_read if self.bytes_read else 0.0,
+        })
+        return stats
@@ -0,0 +1,157 @@
+"""Scanner uptime to host clock alignment.
+
+v3 headers carry k_uptime_get_32() taken in switch_buffers(), when the
+scanner closed the buffer. The host only sees the buffer after the UART
+transfer (frame bytes * 10 / baudrate, hundreds of ms for full buffers, see
+uarttime.py) plus read and queueing jitter. ClockAligner fits
+    host_time = offset + rate * uptime
+over the last buffers of one scanner and uses the fit, not the receive
+time, as each buffer's capture time.
+"""
+from collections import deque
+from sequence import UPTIME_MODULUS
+
+
+class ClockAligner:
+    """Running linear fit between one scanner's uptime and the host clock"""
+
+    # Buffers kept in the fit (about 5 minutes at the firmware's 5 s interval)
+    WINDOW = 64
+    # Samples this far (s) from the fit are outliers; OUTLIER_RESET of them in
+    # a row mean the host clock stepped (NTP, suspend) and the fit restarts
+    OUTLIER_S = 2.0
+    OUTLIER_RESET = 3
+    # Scanner crystals drift by tens of ppm; steeper fits come from host
+    # times that are not real time (e.g. a max-speed replay) and are clamped
+    MAX_DRIFT = 1e-3
+
+    def __init__(self, baudrate=None, window=WINDOW):
+        """
+        Args:
+            baudrate (int): UART baudrate, used to subtract the frame transfer time
+            window (int): Number of buffers in the fit
+        """
+        self.baudrate = baudrate
+        self.window = window
+        self.resets = 0
+        self.outliers = 0
+        self.reset()
+
+    def reset(self):
+        """Forget the fit, e.g. after a scanner reboot restarted its uptime"""
+        self.epoch = None
+        self.last_timestamp = None
+        self.uptime = None        # Unwrapped uptime of the last buffer, ms
+        self.samples = deque()    # (x, y): uptime s, host - uptime s, both rebased
+        self.origin = None        # (uptime s, host - uptime s) of the first sample
+        self.sx = self.sy = self.sxx = self.sxy = 0.0
+        self.intercept = 0.0
+        self.slope = 0.0          # Drift: host seconds gained per uptime second
+        self.envelope = 0.0       # Lowest residual in the window (least delayed buffer)
+        self._consecutive_outliers = 0
+
+    def _unwrap(self, timestamp):
+        """Extend the 32-bit uptime (wraps after ~49.7 days) within one epoch"""
+        timestamp %= UPTIME_MODULUS  # v3 sends it as int32
+        if self.last_timestamp is None:
+            self.uptime = timestamp
+        else:
+            self.uptime += (timestamp - self.last_timestamp) % UPTIME_MODULUS
+        self.last_timestamp = timestamp
+        return self.uptime / 1000
+
+    def _add(self, x, y):
+        self.samples.append((x, y))
+        self.sx += x
+        self.sy += y
+        self.sxx += x * x
+        self.sxy += x * y
+        if len(self.samples) > self.window:
+            old_x, old_y = self.samples.popleft()
+            self.sx -= old_x
+            self.sy -= old_y
+            self.sxx -= old_x * old_x
+            self.sxy -= old_x * old_y
+
+    def _fit(self):
+        n = len(self.samples)
+        denominator = n * self.sxx - self.sx * self.sx
+        if n > 1 and denominator > 1e-9:
+            slope = (n * self.sxy - self.sx * self.sy) / denominator
+            self.slope = max(-self.MAX_DRIFT, min(self.MAX_DRIFT, slope))
+        else:
+            self.slope = 0.0
+        self.intercept = (self.sy - self.slope * self.sx) / n
+        # Delays only ever add to the receive time: follow the least delayed buffer
+        self.envelope = min(y - self._predict(x) for x, y in self.samples)
+
+    def _predict(self, x):
+        return self.intercept + self.slope * x
+
+    def transfer_time(self, frame_length):
+        """Seconds the UART needs for frame_length bytes (8N1)"""
+        return frame_length * 10 / self.baudrate if self.baudrate else 0.0
+
+    def update(self, timestamp, received, epoch=0, frame_length=0):
+        """
+        Add one buffer to the fit
+
+        Args:
+            timestamp (int): Header uptime in ms (k_uptime_get_32)
+            received (float): Host time.time() when the buffer was read
+            epoch (int): Scanner epoch from SequenceTracker, the fit restarts
+                when it changes
+            frame_length (int): Frame size in bytes, for the transfer correction
+
+        Returns:
+            float: Estimated host time.time() at which the buffer was closed
+        """
+        if epoch != self.epoch:
+            if self.epoch is not None:
+                self.resets += 1
+            self.reset()
+            self.epoch = epoch
+
+        uptime = self._unwrap(timestamp)
+        host = received - self.transfer_time(frame_length)
+        if self.origin is None:
+            self.origin = (uptime, host - uptime)
+        x = uptime - self.origin[0]
+        y = host - uptime - self.origin[1]
+
+        if len(self.samples) > 1 and abs(y - self._predict(x) - self.envelope) > self.OUTLIER_S:
+            self.outliers += 1
+            self._consecutive_outliers += 1
+            if self._consecutive_outliers < self.OUTLIER_RESET:
+                return self.capture_time(timestamp)
+            # Host clock stepped: start over from this buffer
+            self.resets += 1
+            epoch = self.epoch
+            self.reset()
+            self.epoch = epoch
+            return self.update(timestamp, received, epoch, frame_length)
+
+        self._consecutive_outliers = 0
+        self._add(x, y)
+        self._fit()
+        return self.capture_time(timestamp)
+
+    def capture_time(self, timestamp):
+        """Host time.time() for an uptime (ms) of the current epoch, None before any buffer"""
+        if self.origin is None:
+            return None
+        half = UPTIME_MODULUS // 2
+        delta = (timestamp - self.last_timestamp + half) % UPTIME_MODULUS - half
+        uptime = (self.uptime + delta) / 1000
+        x = uptime - self.origin[0]
+        return uptime + self.origin[1] + self._predict(x) + self.envelope
+
+    def stats(self):
+        """Current fit for logging and monitoring"""
+        return {
+            'samples': len(self.samples),
+            'drift_ppm': round(self.slope * 1e6, 2),
+            'offset_s': round(self.origin[1] + self.intercept + self.envelope, 4) if self.origin else None,
+            'outliers': self.outliers,
+            'resets': self.resets,
+        }
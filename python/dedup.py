@@ -0,0 +1,173 @@
+"""Deterministic buffer ids and duplicate suppression.
+
+The same buffer can reach MongoDB more than once: MQTT QoS 1 redelivers
+after subscriber reconnects, the journal and spill file replay batches
+whose acknowledgement was lost, the scanner itself may resend a buffer, and
+a capture can be replayed again. Every buffer document therefore gets a
+deterministic _id:
+    ObjectId(12-byte hash of the buffer key)
+Nothing in the key depends on when the buffer arrived, so every copy has
+the same _id and a second insert fails with a duplicate key error (code
+11000) instead of storing it twice, also after a restart that empties
+RecentIds. The _id no longer follows time; queries sort on the indexed
+timestamp.
+
+The key is built from what identifies the buffer:
+    firmware header timestamp (v3): (scanner, epoch, firmware sequence,
+        firmware uptime). Stable across reader restarts and replays; the
+        epoch (reboots seen by the reader) keeps the same sequence and uptime
+        after a reboot apart when the reader saw the reboot.
+    no header timestamp (v1, v2, compact): (scanner, session, epoch,
+        buffer_index). epoch and buffer_index are counted by the reader and
+        start over with it, so the session keeps a restarted reader from
+        reusing the previous run's ids. For a replay:// port the session is
+        the capture's first record time, so replaying one capture again
+        yields the same ids; for a live port it is the process start and
+        dedup only holds within one run.
+
+RecentIds remembers the ids stored recently so known duplicates are
+dropped before they reach the database. Time-series collections cannot
+enforce a unique _id, so for --storage timeseries this window is the only
+protection.
+"""
+import hashlib
+import struct
+import threading
+from collections import OrderedDict
+
+from bson import ObjectId
+
+DUPLICATE_KEY = 11000
+# epoch, then firmware sequence and uptime or buffer_index, hashed after the prefix
+KEY = struct.Struct('>qqq')
+# Buffer ids remembered by RecentIds (about 1 h of buffers from 10 scanners
+# at the firmware's 5 s interval)
+RECENT_IDS = 8192
+
+
+def capture_sessions(ports):
+    """
+    Session of every replayed capture among a receiver's ports
+
+    Args:
+        ports (dict): scanner id -> serial port (UARTReceiver.ports())
+
+    Returns:
+        dict: scanner id -> ReplaySerial.session, for BufferIds
+    """
+    return {scanner: port.session for scanner, port in ports.items()
+            if getattr(port, 'session', None) is not None}
+
+
+class BufferIds:
+    """Deterministic _id of the buffers read by one reader"""
+
+    def __init__(self, session, sessions=None):
+        """
+        Args:
+            session (int): Reader session, e.g. the start time in ms
+            sessions (dict): scanner -> session replacing it, e.g. from
+                capture_sessions() so replays of a capture share their ids
+        """
+        self.session = session
+        self.sessions = sessions or {}
+        # (scanner, firmware) -> blake2b state with the key prefix already hashed
+        self._prefixes = {}
+
+    def _prefix(self, scanner, firmware):
+        prefix = self._prefixes.get((scanner, firmware))
+        if prefix is None:
+            session = 'firmware' if firmware else self.sessions.get(scanner, self.session)
+            prefix = hashlib.blake2b(f'{scanner}|{session}|'.encode(), digest_size=12)
+            self._prefixes[(scanner, firmware)] = prefix
+        return prefix
+
+    def __call__(self, scanner, header):
+        """ObjectId made of the 12-byte hash of the buffer key of a parsed header"""
+        epoch = header.get('epoch')
+        epoch = -1 if epoch is None else epoch
+        timestamp = header.get('timestamp')
+        if timestamp is None:
+            digest = self._prefix(scanner, False).copy()
+            digest.update(KEY.pack(epoch, header.get('buffer_index', header['sequence']), -1))
+        else:
+            digest = self._prefix(scanner, True).copy()
+            digest.update(KEY.pack(epoch, header['sequence'], timestamp))
+        return ObjectId(digest.digest())
+
+
+def split_write_errors(details):
+    """
+    Indexes of the documents rejected by an unordered insert_many
+
+    Args:
+        details (dict): BulkWriteError.details
+
+    Returns:
+        tuple: (duplicate indexes, failed indexes), as sets
+    """
+    duplicates = set()
+    failed = set()
+    for error in details.get('writeErrors', []):
+        (duplicates if error.get('code') == DUPLICATE_KEY else failed).add(error['index'])
+    return duplicates, failed
+
+
+class RecentIds:
+    """Bounded, thread-safe window of recently stored buffer ids"""
+
+    def __init__(self, maxlen=RECENT_IDS):
+        self.maxlen = maxlen
+        self._keys = OrderedDict()
+        self._lock = threading.Lock()
+        # Metrics
+        self.skipped = 0       # Documents dropped as known duplicates
+        self.rejected = 0      # Duplicates only detected by MongoDB (code 11000)
+
+    def filter(self, documents):
+        """
+        Drop documents whose _id was stored recently or repeats within documents
+
+        Documents without a deterministic _id pass through.
+
+        Returns:
+            list: Documents to insert
+        """
+        fresh = []
+        seen = set()
+        with self._lock:
+            keys = self._keys
+            for document in documents:
+                key = document.get('_id')
+                if key is None:
+                    fresh.append(document)
+                    continue
+                if key in keys or key in seen:
+                    self.skipped += 1
+                    continue
+                seen.add(key)
+                fresh.append(document)
+        return fresh
+
+    def add(self, documents):
+        """Remember the ids of documents now stored in the database"""
+        with self._lock:
+            keys = self._keys
+            for document in documents:
+                key = document.get('_id')
+                if key is None:
+                    continue
+                keys[key] = None
+                keys.move_to_end(key)
+            while len(keys) > self.maxlen:
+                keys.popitem(last=False)
+
+    def reject(self, count):
+        """Count duplicates the database rejected"""
+        with self._lock:
+            self.rejected += count
+
+    def stats(self):
+        """Duplicate counters for logging"""
+        with self._lock:
+            return {'skipped': self.skipped, 'rejected': self.rejected, 'window': len(self._keys)}
@@ -0,0 +1,242 @@
+import functools
+import sys
+import numpy as np
+from ad_decoder import decode_ad
+
+# One 42-byte device record as sent by the scanner
+DEVICE_DTYPE = np.dtype([
+    ('mac', 'u1', (6,)),      # MAC address
+    ('addr_type', 'u1'),      # Address type
+    ('adv_type', 'u1'),       # Advertisement type
+    ('rssi', 'i1'),           # RSSI value (signed)
+    ('data_len', 'u1'),       # Data length
+    ('data', 'u1', (31,)),    # Advertisement data
+    ('n_adv', 'u1'),          # Number of advertisements from this MAC
+])
+
+
+# Distinct MACs whose formatted string is kept; scanners see the same few
+# thousand devices in every buffer
+MAC_CACHE_SIZE = 8192
+
+
+@functools.lru_cache(maxsize=MAC_CACHE_SIZE)
+def format_mac(mac_int):
+    """'AA:BB:CC:DD:EE:FF' for a 48-bit MAC, interned so repeats share one string"""
+    return sys.intern(mac_int.to_bytes(6, 'big').hex(':').upper())
+
+
+def mac_to_int(mac):
+    """48-bit int of a MAC given as 6 raw bytes or an 'AA:BB:..' string"""
+    if isinstance(mac, str):
+        return int(mac.replace(':', '').replace('-', ''), 16)
+    return int.from_bytes(mac, 'big')
+
+
+class DeviceRecord:
+    """One device of a DeviceBatch.
+
+    Numeric fields are plain ints and the MAC is kept as a 48-bit int; the
+    MAC string and the advertisement bytes are only built when accessed.
+    Supports device['mac'] style access like the old per-device dicts.
+    """
+
+    __slots__ = ('mac_int', 'addr_type', 'adv_type', 'rssi', 'data_len', 'n_adv',
+                 '_batch', '_index')
+
+    def __init__(self, batch, index, mac_int, addr_type, adv_type, rssi, data_len, n_adv):
+        self._batch = batch
+        self._index = index
+        self.mac_int = mac_int
+        self.addr_type = addr_type
+        self.adv_type = adv_type
+        self.rssi = rssi
+        self.data_len = data_len
+        self.n_adv = n_adv
+
+    @property
+    def mac(self):
+        return format_mac(self.mac_int)
+
+    @property
+    def mac_bytes(self):
+        return self.mac_int.to_bytes(6, 'big')
+
+    @property
+    def data(self):
+        return self._batch.records['data'][self._index].tobytes()
+
+    @property
+    def ad(self):
+        """Decoded advertising data fields (ad_decoder.decode_ad)"""
+        return decode_ad(self.data[:self.data_len])
+
+    def __getitem__(self, key):
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            # Layout-specific columns such as v3 last_seen
+            if key in self._batch.columns:
+                return self._batch.records[key][self._index].item()
+            raise KeyError(key)
+
+    def keys(self):
+        return [name for name in self._batch.columns if name != 'mac'] + ['mac']
+
+    def to_dict(self, hex_data=False):
+        """Per-device dict in the _parse_device format"""
+        data = self.data
+        return {
+            'mac': self.mac,
+            'addr_type': self.addr_type,
+            'adv_type': self.adv_type,
+            'rssi': self.rssi,
+            'data_len': self.data_len,
+            'data': data.hex() if hex_data else data,
+            'n_adv': self.n_adv,
+        }
+
+    def __repr__(self):
+        return (f"DeviceRecord(mac={self.mac}, rssi={self.rssi}, "
+                f"n_adv={self.n_adv}, data_len={self.data_len})")
+
+
+def decode_devices(payload, n_mac, dtype=DEVICE_DTYPE):
+    """
+    Decode all device records of a buffer in a single np.frombuffer call
+
+    Args:
+        payload: Bytes-like object holding at least n_mac records
+        n_mac (int): Number of device records
+        dtype (np.dtype): Structured record layout
+
+    Returns:
+        DeviceBatch: Columnar view over the records
+    """
+    records = np.frombuffer(payload, dtype=dtype, count=n_mac)
+    # Detach from the serial read buffer, which is reused for the next frame
+    return DeviceBatch(records.copy())
+
+
+class DeviceBatch:
+    """Columnar device records of one buffer.
+
+    Columns are NumPy arrays (batch['rssi'], batch.mac_ints(), ...).
+    Iterating or indexing yields slotted DeviceRecords; dicts in the
+    _parse_device format are only built by to_dicts() / to_documents().
+    """
+
+    def __init__(self, records):
+        self.records = records
+
+    def __len__(self):
+        return len(self.records)
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            return self.records[key]
+        if isinstance(key, slice):
+            return DeviceBatch(self.records[key])
+        return self._record(key)
+
+    def __iter__(self):
+        return iter(self.device_records())
+
+    @property
+    def columns(self):
+        """Column names available in the batch"""
+        return self.records.dtype.names
+
+    def mac_ints(self):
+        """MACs as a uint64 array of 48-bit big-endian values"""
+        padded = np.zeros((len(self.records), 8), dtype=np.uint8)
+        padded[:, 2:] = self.records['mac']
+        return padded.view('>u8').ravel()
+
+    def macs(self):
+        """Formatted 'AA:BB:CC:DD:EE:FF' MAC strings (shared via format_mac)"""
+        return [format_mac(mac) for mac in self.mac_ints().tolist()]
+
+    def payloads(self):
+        """Advertisement data of each device as bytes"""
+        data = self.records['data']
+        raw = data.tobytes()
+        size = data.shape[1]
+        return [raw[i:i + size] for i in range(0, len(raw), size)]
+
+    def _record(self, index):
+        """Build the DeviceRecord for a single device"""
+        if index < 0:
+            index += len(self.records)
+        row = self.records[index]
+        return DeviceRecord(
+            self, index, int.from_bytes(row['mac'].tobytes(), 'big'),
+            int(row['addr_type']), int(row['adv_type']), int(row['rssi']),
+            int(row['data_len']), int(row['n_adv']),
+        )
+
+    def device_records(self):
+        """One DeviceRecord per device, built from whole columns"""
+        return [
+            DeviceRecord(self, index, *fields)
+            for index, fields in enumerate(zip(
+                self.mac_ints().tolist(),
+                self.records['addr_type'].tolist(),
+                self.records['adv_type'].tolist(),
+                self.records['rssi'].tolist(),
+                self.records['data_len'].tolist(),
+                self.records['n_adv'].tolist(),
+            ))
+        ]
+
+    def to_dicts(self, hex_data=False):
+        """Build per-device dicts in the _parse_device format
+
+        Args:
+            hex_data (bool): Return advertisement data as a hex string
+        """
+        payloads = self.payloads()
+        if hex_data:
+            payloads = [data.hex() for data in payloads]
+        return [
+            {
+                'mac': mac,
+                'addr_type': addr_type,
+                'adv_type': adv_type,
+                'rssi': rssi,
+                'data_len': data_len,
+                'data': data,
+                'n_adv': n_adv,
+            }
+            for mac, addr_type, adv_type, rssi, data_len, data, n_adv in zip(
+                self.macs(),
+                self.records['addr_type'].tolist(),
+                self.records['adv_type'].tolist(),
+                self.records['rssi'].tolist(),
+                self.records['data_len'].tolist(),
+                payloads,
+                self.records['n_adv'].tolist(),
+            )
+        ]
+
+    def to_documents(self, ad_fields=False):
+        """Build the per-device documents stored in MongoDB / published to MQTT
+
+        Args:
+            ad_fields (bool): Add the decoded advertising data fields
+                (local_name, company_id, service_uuids, tx_power, ...) next
+                to the raw hex data; payloads repeated within the batch are
+                decoded once
+        """
+        documents = self.to_dicts(hex_data=True)
+        if not ad_fields:
+            return documents
+        decoded = {}
+        for document, data, data_len in zip(documents, self.payloads(),
+                                            self.records['data_len'].tolist()):
+            payload = data[:data_len]
+            fields = decoded.get(payload)
+            if fields is None:
+                fields = decoded[payload] = decode_ad(payload)
+            document.update(fields)
+        return documents
@@ -0,0 +1,116 @@
+"""Compact storage encoding of buffer documents.
+
+The standard documents built by DeviceBatch.to_documents() store the
+advertising data as hex (31 bytes -> 62 characters), the MAC as a
+17-character string and repeat every long field name per device. With
+--encoding compact the receivers store instead:
+    data  -> BSON Binary trimmed to data_len; data_len is kept as 'l' since
+             it can exceed the bytes a layout carries (compact: 16)
+    mac   -> int64 (48-bit big-endian value)
+    field names -> the short names of DEVICE_FIELDS
+Buffer-level fields keep their names (they are queried and indexed) and the
+document gets 'enc': COMPACT_VERSION so readers can tell the layouts apart.
+
+expand_document() / expand_documents() turn compact documents back into the
+standard layout and pass standard documents through unchanged, so readers
+(app.py, utils.py, timeseries.py) handle both.
+"""
+from ad_decoder import decode_ad
+from device_batch import format_mac
+
+ENCODINGS = ('standard', 'compact')
+ENCODING_FIELD = 'enc'
+COMPACT_VERSION = 1
+
+# Standard device field -> compact name
+DEVICE_FIELDS = {
+    'mac': 'm',
+    'addr_type': 'at',
+    'adv_type': 'vt',
+    'rssi': 'r',
+    'data_len': 'l',
+    'data': 'd',
+    'n_adv': 'n',
+    # Decoded advertising data (ad_decoder.decode_ad)
+    'flags': 'f',
+    'local_name': 'ln',
+    'tx_power': 'tx',
+    'appearance': 'ap',
+    'company_id': 'c',
+    'service_uuids': 'u',
+    'ad_malformed': 'am',
+}
+COMPACT_FIELDS = {short: name for name, short in DEVICE_FIELDS.items()}
+DEVICES_FIELD = 'dv'
+
+
+def compact_devices(batch, ad_fields=False):
+    """
+    Compact per-device documents of a DeviceBatch
+
+    Args:
+        batch (DeviceBatch): Decoded device records of one buffer
+        ad_fields (bool): Add the decoded advertising data fields
+
+    Returns:
+        list: Device documents with short field names, int MACs and
+        trimmed binary data
+    """
+    records = batch.records
+    devices = []
+    for mac, addr_type, adv_type, rssi, data_len, data, n_adv in zip(
+            batch.mac_ints().tolist(),
+            records['addr_type'].tolist(),
+            records['adv_type'].tolist(),
+            records['rssi'].tolist(),
+            records['data_len'].tolist(),
+            batch.payloads(),
+            records['n_adv'].tolist()):
+        payload = data[:data_len]
+        device = {'m': mac, 'at': addr_type, 'vt': adv_type, 'r': rssi, 'l': data_len,
+                  'd': payload, 'n': n_adv}
+        if ad_fields:
+            for name, value in decode_ad(payload).items():
+                device[DEVICE_FIELDS[name]] = value
+        devices.append(device)
+    return devices
+
+
+def is_compact(document):
+    """Whether document uses the compact encoding"""
+    return document.get(ENCODING_FIELD) == COMPACT_VERSION
+
+
+def expand_device(device):
+    """Standard device document from a compact one"""
+    expanded = {}
+    for short, value in device.items():
+        name = COMPACT_FIELDS.get(short, short)
+        if name == 'mac':
+            value = format_mac(value)
+        elif name == 'data':
+            value = bytes(value)
+            # Documents written before 'l' existed
+            expanded.setdefault('data_len', device.get('l', len(value)))
+            value = value.hex()  # Without the zero padding after data_len
+        expanded[name] = value
+    return expanded
+
+
+def expand_document(document):
+    """
+    Standard buffer document from a compact one
+
+    Standard documents are returned unchanged.
+    """
+    if not is_compact(document):
+        return document
+    expanded = {key: value for key, value in document.items()
+                if key not in (ENCODING_FIELD, DEVICES_FIELD)}
+    expanded['devices'] = [expand_device(device) for device in document.get(DEVICES_FIELD, ())]
+    return expanded
+
+
+def expand_documents(documents):
+    """expand_document over an iterable, returns a list"""
+    return [expand_document(document) for document in documents]
@@ -0,0 +1,127 @@
+"""Read several scanners from one process.
+
+Each port keeps its own UARTReceiver (frame reader, layout detection,
+capture file); a selector waits on all of them at once and every decoded
+buffer comes back tagged with its scanner id:
+    python uart-mongo.py --port norte=/dev/ttyUSB0 sur=/dev/ttyUSB1
+"""
+import os
+import selectors
+import time
+import serial
+from protocol import DEFAULT_PROTOCOL
+from uart import UARTReceiver, parse_port_spec
+
+
+def capture_path(capture, scanner_id):
+    """Per-scanner capture file: campo.cap -> campo.ttyUSB0.cap"""
+    root, ext = os.path.splitext(capture)
+    return f"{root}.{scanner_id}{ext or '.cap'}"
+
+
+class FanInReader:
+    """Multiplexes the UART ports of several scanners.
+
+    Ports that expose a file descriptor (serial devices, ptys) are waited on
+    with selectors; the rest (replay://, loop://, Windows COM ports) are
+    polled through in_waiting every POLL_STEP seconds.
+    """
+
+    POLL_STEP = 0.005  # Wait between in_waiting polls of ports without fileno
+
+    def __init__(self, ports, baudrate=115200, protocol=DEFAULT_PROTOCOL, capture=None):
+        """
+        Args:
+            ports (list): [ID=]PORT specs, ID defaults to the port name
+            baudrate (int): Serial baudrate of every port
+            protocol (str): Wire layout name, 'auto' or 'chunked'
+            capture (str): Record each port to a capture file derived from this name
+        """
+        self.selector = selectors.DefaultSelector()
+        self.scanners = {}
+        self._polled = []
+        self.closed_ports = {}  # scanner id -> reason
+
+        try:
+            for spec in ports:
+                scanner_id, port = parse_port_spec(spec)
+                if scanner_id in self.scanners:
+                    raise ValueError(f"Duplicate scanner id: {scanner_id}")
+                receiver = UARTReceiver(
+                    port, baudrate, protocol=protocol, scanner_id=scanner_id,
+                    capture=capture_path(capture, scanner_id) if capture else None
+                )
+                self.scanners[scanner_id] = receiver
+                try:
+                    self.selector.register(receiver.serial.fileno(), selectors.EVENT_READ, receiver)
+                except (AttributeError, OSError, ValueError):
+                    self._polled.append(receiver)
+        except Exception:
+            self.close()
+            raise
+
+    def _remove(self, receiver, reason):
+        """Stop reading a scanner whose port failed or ended"""
+        self.scanners.pop(receiver.scanner_id, None)
+        if receiver in self._polled:
+            self._polled.remove(receiver)
+        else:
+            try:
+                self.selector.unregister(receiver.serial.fileno())
+            except (KeyError, OSError, ValueError):
+                pass
+        self.closed_ports[receiver.scanner_id] = reason
+        receiver.close()
+
+    def _pending(self, receiver):
+        """in_waiting of a polled port, removing it if the port failed"""
+        try:
+            return receiver.serial.in_waiting
+        except (serial.SerialException, OSError) as e:
+            self._remove(receiver, str(e))
+            return 0
+
+    def _ready(self, timeout):
+        """Receivers with pending bytes, waiting at most timeout seconds"""
+        ready = [receiver for receiver in list(self._polled) if self._pending(receiver)]
+        if ready or not self._polled:
+            wait = 0 if ready else timeout
+        else:
+            wait = min(timeout, self.POLL_STEP)
+        if self.selector.get_map():
+            ready += [key.data for key, _ in self.selector.select(wait)]
+        elif wait > 0:
+            time.sleep(wait)
+        return ready
+
+    def poll(self, timeout):
+        """
+        Read every port with pending data and decode the completed buffers
+
+        Args:
+            timeout (float): Longest wait in seconds when no port has data
+
+        Returns:
+            list: (scanner id, header, DeviceBatch) in arrival order per port
+        """
+        buffers = []
+        for receiver in self._ready(timeout):
+            try:
+                for header, devices in receiver._read_available():
+                    buffers.append((receiver.scanner_id, header, devices))
+            except (serial.SerialException, OSError) as e:
+                # Unplugged board or end of a replayed capture
+                self._remove(receiver, str(e))
+        return buffers
+
+    def stats(self):
+        """Frame reader counters per scanner id"""
+        return {
+            scanner_id: receiver.frame_reader.stats() if receiver.frame_reader else {}
+            for scanner_id, receiver in self.scanners.items()
+        }
+
+    def close(self):
+        for receiver in list(self.scanners.values()):
+            receiver.close()
+        self.selector.close()
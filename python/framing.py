@@ -0,0 +1,216 @@
+import time
+from protocol import HEADER_MAGIC, PROTOCOLS, detect_protocol
+
+
+class FrameReader:
+    """Bulk-buffered UART frame reader.
+
+    Reads whatever the port has pending into a reusable bytearray, finds the
+    0x55555555 magic with bytes.find and yields complete frames
+    (header + n_mac device records) as memoryview slices of that buffer.
+
+    A yielded frame is only valid until the next call into the reader: the
+    buffer is compacted in place, so parse or copy it before asking for more.
+
+    Without a protocol the layout is detected from the stream first
+    (see protocol.detect_protocol); no frames are returned until then.
+    """
+
+    HEADER_MAGIC = HEADER_MAGIC
+
+    def __init__(self, source, protocol=None, candidates=None, read_size=4096,
+                 detect_frames=3, capture=None):
+        """
+        Args:
+            source: Object with read(n) and in_waiting (serial.Serial or compatible)
+            protocol (Protocol): Wire layout, None to auto-detect
+            candidates (list): Layouts considered by auto-detection (default: all)
+            read_size (int): Minimum free space kept for each bulk read
+            detect_frames (int): Consecutive consistent frames needed to detect
+            capture (CaptureWriter): Records every chunk read from the source
+        """
+        self.source = source
+        self.protocol = protocol
+        self.candidates = list(candidates or PROTOCOLS.values())
+        self.read_size = read_size
+        self.detect_frames = detect_frames
+        self.capture = capture
+
+        # Room for enough of the largest frames to detect the layout plus one bulk read
+        layouts = [protocol] if protocol else self.candidates
+        max_frame = max(p.frame_length(p.max_devices) for p in layouts)
+        frames = 2 if protocol else detect_frames + 2
+        self._buffer = bytearray(frames * max_frame + read_size)
+        self._view = memoryview(self._buffer)
+        self._start = 0   # First unconsumed byte
+        self._end = 0     # One past the last buffered byte
+
+        # Statistics
+        self.bytes_read = 0
+        self.bytes_discarded = 0
+        self.frames = 0
+        self.resyncs = 0
+
+    @property
+    def buffered(self):
+        """Number of bytes received but not yet consumed"""
+        return self._end - self._start
+
+    def _discard(self, count):
+        """Drop bytes from the front of the buffer while resynchronizing"""
+        if count > 0:
+            self._start += count
+            self.bytes_discarded += count
+
+    def _compact(self):
+        """Move pending bytes to the front of the buffer"""
+        pending = self._end - self._start
+        if self._start and pending:
+            self._buffer[:pending] = bytes(self._view[self._start:self._end])
+        self._start = 0
+        self._end = pending
+
+    def feed(self, data):
+        """Append raw bytes to the buffer, returns the number of bytes accepted"""
+        if len(self._buffer) - self._end < len(data):
+            self._compact()
+        free = len(self._buffer) - self._end
+        if len(data) > free:
+            # Cannot hold everything: keep the newest bytes
+            self._discard(min(len(data) - free, self.buffered))
+            self._compact()
+            if len(data) > len(self._buffer):
+                self.bytes_discarded += len(data) - len(self._buffer)
+                data = data[-len(self._buffer):]
+        count = len(data)
+        self._buffer[self._end:self._end + count] = data
+        self._end += count
+        self.bytes_read += count
+        return count
+
+    def fill(self, timeout=None):
+        """Read everything pending on the source, waiting for at least one byte
+
+        Args:
+            timeout (float): Longest wait in seconds when nothing is pending,
+                None to use the source's own timeout
+
+        Returns:
+            int: Bytes read, 0 if the source timed out
+        """
+        if len(self._buffer) - self._end < self.read_size:
+            self._compact()
+        free = len(self._buffer) - self._end
+        pending = self.source.in_waiting
+        if pending or timeout is None:
+            data = self.source.read(max(1, min(pending, free)))
+        else:
+            data = self._read_within(timeout)
+        if not data:
+            return 0
+        if self.capture:
+            self.capture.write(data)
+        return self.feed(data)
+
+    def _read_within(self, timeout):
+        """Wait for a byte for at most timeout seconds"""
+        if timeout <= 0:
+            return b''
+        source_timeout = getattr(self.source, 'timeout', None)
+        if source_timeout is not None and source_timeout <= timeout:
+            return self.source.read(1)
+        # Shorten the source timeout to the remaining budget for this read
+        self.source.timeout = timeout
+        try:
+            return self.source.read(1)
+        finally:
+            self.source.timeout = source_timeout
+
+    def _detect(self):
+        """Try to detect the layout from the buffered bytes"""
+        pending = self._view[self._start:self._end]
+        self.protocol = detect_protocol(pending, self.candidates, self.detect_frames)
+        if self.protocol is None and len(self._buffer) - self.buffered < self.read_size:
+            # Buffer full without a consistent chain: drop the oldest half
+            self._discard(self.buffered // 2)
+        return self.protocol is not None
+
+    def next_frame(self):
+        """Extract the next complete frame from the buffered bytes
+
+        Returns:
+            tuple: (header dict, memoryview of the whole frame) or None if
+            more data is needed
+        """
+        if self.protocol is None and not self._detect():
+            return None
+        protocol = self.protocol
+        while True:
+            pos = self._buffer.find(self.HEADER_MAGIC, self._start, self._end)
+            if pos < 0:
+                # Keep a possible partial magic at the tail
+                self._discard(self.buffered - (len(self.HEADER_MAGIC) - 1))
+                return None
+            if pos > self._start:
+                self.resyncs += 1
+                self._discard(pos - self._start)
+
+            if self.buffered < protocol.header_length:
+                return None
+
+            header = protocol.parse_header(self._view[pos:pos + protocol.header_length])
+            if not header or header['n_mac'] > protocol.max_devices:
+                # False magic or corrupt header, search again one byte later
+                self.resyncs += 1
+                self._discard(1)
+                continue
+
+            frame_length = protocol.frame_length(header['n_mac'])
+            if self.buffered < frame_length:
+                return None
+
+            self._start = pos + frame_length
+            self.frames += 1
+            return header, self._view[pos:pos + frame_length]
+
+    def read_frame(self, timeout=None):
+        """Wait until a complete frame is available
+
+        Partial frames stay buffered between calls, so a frame may be
+        assembled over several calls that each ran out of time.
+
+        Args:
+            timeout (float): Time budget in seconds for the whole call, None
+                to wait as long as the source keeps returning data
+
+        Returns:
+            tuple: (header, frame) or None if the budget or the source
+            timed out first
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            frame = self.next_frame()
+            if frame:
+                return frame
+            remaining = None if deadline is None else deadline - time.monotonic()
+            if remaining is not None and remaining <= 0:
+                return None
+            if not self.fill(remaining):
+                return None
+
+    def __iter__(self):
+        """Yield frames until the source times out"""
+        while True:
+            frame = self.read_frame()
+            if frame is None:
+                return
+            yield frame
+
+    def stats(self):
+        """Return reader counters"""
+        return {
+            'bytes_read': self.bytes_read,
+            'bytes_discarded': self.bytes_discarded,
+            'frames': self.frames,
+            'resyncs': self.resyncs,
+        }
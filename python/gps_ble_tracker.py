@@ -5,7 +5,17 @@ import pynmea2
 import os
 from pymongo import MongoClient
 import logging
+import signal
 from uart import UARTReceiver
+from capture import EndOfCapture, open_port
+from protocol import protocol_choices
+from batch_writer import DEFAULT_BATCH_BYTES
+from journal import FSYNC_POLICIES
+from timeseries import STORAGE_MODES
+from encoding import COMPACT_VERSION, DEVICES_FIELD, ENCODING_FIELD, ENCODINGS, compact_devices
+from indexes import LOCATION_FIELD, geo_point
+from mongo_store import MONGO_TIMEOUTS, MongoStore
+from pipeline import OVERFLOW_POLICIES, run_reader
 from enum import Enum
 
 ## Log level
@@ -13,7 +23,9 @@ class LogLevel(str, Enum):
     INFO = "info"
     DEBUG = "debug"
 
-class CombinedTracker(UARTReceiver):
+class CombinedTracker(MongoStore, UARTReceiver):
+    SPILL_FILE = os.path.join("spill", "tracker.spill")
+
     def __init__(
         self,
         gps_port="COM26",
@@ -21,56 +33,85 @@ class CombinedTracker(UARTReceiver):
         ble_baudrate=115200,
         gps_baudrate=115200,
         mongo_uri="mongodb://localhost:27017/",
-        log_level="info"
+        log_level="info",
+        protocol="v1",
+        capture=None,
+        queue_size=1000,
+        overflow="block",
+        sink_workers=1,
+        spill_file=None,
+        batch_size=500,
+        batch_bytes=DEFAULT_BATCH_BYTES,
+        batch_latency=1.0,
+        journal=None,
+        journal_fsync="interval",
+        storage="buffers",
+        encoding="standard",
+        rollups=False,
+        device_registry=False,
+        ad_fields=False,
+        mongo_client=None
     ):
-        """Inicializa el tracker"""
+        """
+        Inicializa el tracker
+
+        Args:
+            queue_size (int): Buffers en memoria entre el hilo lector y MongoDB
+            overflow (str): Con la cola llena: 'block', 'drop-oldest' o 'spill'
+            sink_workers (int): Hilos que escriben en MongoDB
+            spill_file (str): Archivo de desbordamiento para overflow='spill'
+            batch_size (int): Documentos por insert_many
+            batch_bytes (int): Tamaño estimado que fuerza un insert_many
+            batch_latency (float): Segundos que un buffer espera a completar su lote
+            journal (str): Directorio del diario en disco; los buffers se escriben
+                ahí antes de MongoDB (sustituye a la cola en memoria)
+            journal_fsync (str): 'always', 'interval' o 'never'
+            storage (str): 'buffers' (un documento por buffer) o 'timeseries'
+                (una observación por dispositivo en la colección <colección>_ts)
+            encoding (str): 'standard' o 'compact' (datos binarios, MAC entera y
+                nombres cortos, ver encoding.py)
+            rollups (bool): Mantener resúmenes por minuto y hora (rollups.py)
+            device_registry (bool): Mantener la colección devices con un resumen
+                por MAC (registry.py)
+            ad_fields (bool): Añadir a cada dispositivo los campos decodificados
+                de sus datos AD (ad_decoder.py)
+            mongo_client: Cliente pymongo ya creado, en lugar de conectar a mongo_uri
+        """
         # Configurar logging
         self.log_level = log_level.lower()
         self._setup_logging()
         self.logger.info("Iniciando rastreador combinado GPS + BLE")
 
         # Inicializar receptor UART BLE
-        super().__init__(port=ble_port, baudrate=ble_baudrate)
+        super().__init__(port=ble_port, baudrate=ble_baudrate, protocol=protocol,
+                         capture=capture)
+
+        # Cola entre el hilo lector (BLE + GPS) y los hilos de escritura
+        self._setup_pipeline(queue_size, overflow, sink_workers, spill_file,
+                             batch_size, batch_bytes, batch_latency, journal, journal_fsync)
 
         # Configuración MongoDB
-        self.client = MongoClient(mongo_uri)
+        self.client = mongo_client or MongoClient(mongo_uri, **MONGO_TIMEOUTS)
         self.db = self.client.tracking_data
         self.collection = self.db.portfinal
+        self.encoding = encoding
+        self.ad_fields = ad_fields
+        self._open_storage(storage, rollups, device_registry)
+        self._check_server(mongo_uri)
 
         # Configuración GPS
         self.gps_port = gps_port
         self.gps_baudrate = gps_baudrate
         self.last_gps_data = None
+        self.gps_buffer = bytearray()  # Sentencia NMEA incompleta
         
         try:
-            self.gps_ser = serial.Serial(self.gps_port, self.gps_baudrate, timeout=1)
+            self.gps_ser = open_port(self.gps_port, self.gps_baudrate, timeout=self.POLL_INTERVAL)
             self.logger.info(f"GPS conectado en {self.gps_port}")
         except serial.SerialException as e:
             self.logger.error(f"Error conectando GPS: {e}")
             raise
 
-        # Formato del buffer BLE
-        self.HEADER_MAGIC = b"\x55\x55\x55\x55"
-        self.HEADER_FORMAT = {
-            "header": 4,
-            "sequence": 1,
-            "n_adv_raw": 2,
-            "n_mac": 1,
-        }
-
-        self.DEVICE_FORMAT = {
-            "mac": 6,
-            "addr_type": 1,
-            "adv_type": 1,
-            "rssi": 1,
-            "data_len": 1,
-            "data": 31,
-            "n_adv": 1,
-        }
-
-        self.HEADER_LENGTH = sum(self.HEADER_FORMAT.values())
-        self.DEVICE_LENGTH = sum(self.DEVICE_FORMAT.values())
-
     def _setup_logging(self):
         """Configura el sistema de logging"""
         # Crear directorio de logs si no existe
@@ -113,8 +154,15 @@ class CombinedTracker(UARTReceiver):
     def _parse_gps(self):
         """Parsea datos GPS"""
         try:
-            while self.gps_ser.in_waiting:  # Read all available GPS data
-                line = self.gps_ser.readline().decode('ascii', errors='replace')
+            # Lee solo lo pendiente: una sentencia a medias no bloquea el bucle
+            pending = self.gps_ser.in_waiting
+            if pending:
+                self.gps_buffer += self.gps_ser.read(pending)
+            lines = self.gps_buffer.split(b'\n')
+            self.gps_buffer = lines.pop()
+
+            for raw in reversed(lines):  # La sentencia más reciente primero
+                line = raw.decode('ascii', errors='replace').strip()
                 
                 if line.startswith("$GPRMC"):
                     msg = pynmea2.parse(line)
@@ -133,80 +181,114 @@ class CombinedTracker(UARTReceiver):
             self.logger.error(f"Error parseando GPS: {e}")
         return self.last_gps_data  # Return last known position if no new data
 
+    def _make_document(self, header, devices, gps_data):
+        """Documento MongoDB de un buffer con la posición GPS al recibirlo"""
+        timestamp = datetime.now()
+        document = {
+            '_id': self._document_id(header, self.scanner_id),
+            'timestamp': timestamp,
+            'scanner': self.scanner_id,
+            'sequence': header['sequence'],
+            'n_adv_raw': header['n_adv_raw'],
+            'n_mac': header['n_mac'],
+            **self._sequence_fields(header),
+            **self._capture_fields(header),
+        }
+        if self.encoding == 'compact':
+            document[ENCODING_FIELD] = COMPACT_VERSION
+            document[DEVICES_FIELD] = compact_devices(devices, self.ad_fields)
+        else:
+            document['devices'] = devices.to_documents(self.ad_fields)
+        document['gps_data'] = gps_data
+        # GeoJSON para el índice 2dsphere
+        location = geo_point(gps_data)
+        if location:
+            document[LOCATION_FIELD] = location
+        return document
+
     def _store_buffer(self, header, devices):
         """Almacena el buffer BLE y datos GPS en MongoDB"""
-        try:
-            # Obtener datos GPS actuales
-            gps_data = self._parse_gps() or self.last_gps_data
-
-            document = {
-                'timestamp': datetime.now(),
-                'sequence': header['sequence'],
-                'n_adv_raw': header['n_adv_raw'],
-                'n_mac': header['n_mac'],
-                'devices': [],
-                'gps_data': gps_data
-            }
-
-            for device in devices:
-                device_doc = {
-                    'mac': device['mac'],
-                    'addr_type': device['addr_type'],
-                    'adv_type': device['adv_type'],
-                    'rssi': device['rssi'],
-                    'data_len': device['data_len'],
-                    'data': device['data'].hex(),
-                    'n_adv': device['n_adv']
-                }
-                document['devices'].append(device_doc)
-            
-            result = self.collection.insert_one(document)
-            self.logger.debug(f"Buffer combinado almacenado - ID: {result.inserted_id}")
-            return True
-        except Exception as e:
-            self.logger.error(f"Error almacenando en BD: {e}")
-            return False
+        # Obtener datos GPS actuales
+        gps_data = self._parse_gps() or self.last_gps_data
+        return self._insert_documents([self._make_document(header, devices, gps_data)]) == 1
+
+    def _log_sequences(self):
+        """Registra las estadísticas de secuencia del escáner"""
+        stats = self.sequence_stats()
+        if stats:
+            self.logger.info(
+                f"Secuencia: buffers {stats['buffers']}, índice {stats['buffer_index']}, "
+                f"perdidos {stats['lost']} ({stats['loss_rate']:.2%}), "
+                f"duplicados {stats['duplicates']}, reinicios {stats['reboots']}, "
+                f"n_adv descuadrados {stats['n_adv_mismatches']}"
+            )
+        clock = self.clock_stats()
+        if clock:
+            self.logger.info(
+                f"Reloj: deriva {clock['drift_ppm']} ppm, muestras {clock['samples']}, "
+                f"atípicas {clock['outliers']}, reajustes {clock['resets']}"
+            )
+
+    def _log_metrics(self):
+        """Registra métricas de la cola y de las secuencias"""
+        self._log_pipeline()
+        self._log_sequences()
 
     def receive_messages(self, duration=None):
-        """Recibe y almacena buffers BLE con datos GPS"""
+        """Recibe y almacena buffers BLE con datos GPS
+
+        Un hilo lector atiende BLE y GPS; los hilos de escritura insertan en
+        MongoDB sin frenar la lectura UART.
+        """
         self.logger.info("=== Iniciando recepción de buffers combinados ===")
-        start_time = time.time()
-        buffers_procesados = 0
-        
-        while True:
+        deadline = time.monotonic() + duration if duration else None
+        self.pipeline = self._make_pipeline().start()
+        try:
+            run_reader(lambda: self._read_loop(deadline), self.stop,
+                       self.POLL_INTERVAL, report=self._log_metrics)
+        except KeyboardInterrupt:
+            self.logger.info("\n=== Captura interrumpida por el usuario ===")
+        finally:
+            pendientes = self.pipeline.stop()
+            self._log_metrics()
+            if pendientes and self.journal_options:
+                self.logger.warning(f"{pendientes} buffers quedan en el diario para el próximo arranque")
+            elif pendientes:
+                self.logger.warning(f"{pendientes} buffers sin almacenar al cerrar")
+            self.logger.info(f"Total de buffers procesados: {self.pipeline.stored}")
+            self.pipeline = None
+
+    def _read_loop(self, deadline):
+        """Hilo lector: lee BLE y GPS y encola los buffers combinados"""
+        while self.running:
             try:
                 # Verificar tiempo transcurrido
-                if duration and (time.time() - start_time) >= duration:
-                    self.logger.info(f"Tiempo de ejecución ({duration}s) completado")
-                    self.logger.info(f"Total de buffers procesados: {buffers_procesados}")
+                if deadline and time.monotonic() >= deadline:
+                    self.logger.info("Tiempo de ejecución completado")
                     break
 
                 # Update GPS data 
                 self._parse_gps()
 
-                # Busca la cabecera BLE
-                while True:
-                    if self.serial.read() == b'\x55':
-                        potential_header = b'\x55' + self.serial.read(3)
-                        if potential_header == self.HEADER_MAGIC:
-                            self.logger.debug("Cabecera UART encontrada")
-                            break
-
-                # Lee y parsea la cabecera
-                header_data = potential_header + self.serial.read(self.HEADER_LENGTH - 4)
-                header = self._parse_header(header_data)
-                
-                if not header:
-                    self.logger.warning("Error al parsear cabecera")
+                # Lee el siguiente buffer BLE completo (como mucho POLL_INTERVAL,
+                # así el GPS se sigue leyendo aunque el escáner no envíe nada)
+                frame = self._read_frame(self._time_left(deadline))
+                if self.last_discarded:
+                    self.logger.debug(f"Resincronización: {self.last_discarded} bytes descartados")
+                if frame is None:
+                    self._on_idle()
                     continue
-
-                # Lee todos los dispositivos
-                devices = []
-                for i in range(header['n_mac']):
-                    device_data = self.serial.read(self.DEVICE_LENGTH)
-                    device = self._parse_device(device_data)
-                    if device:
-                        devices.append(device)
+                header, data = frame
+                self.logger.debug("Cabecera UART encontrada")
+
+                # Parsea todos los dispositivos
+                devices = self._parse_devices(data)
+                self._track_sequence(header, devices)
+                if header['lost']:
+                    self.logger.warning(f"{header['lost']} buffers perdidos antes de la "
+                                        f"secuencia {header['sequence']}")
+                if header['reboot']:
+                    self.logger.warning(f"Reinicio del escáner detectado (época {header['epoch']})")
 
                 # Procesa el buffer si hay dispositivos
                 if devices:
@@ -224,7 +306,7 @@ class CombinedTracker(UARTReceiver):
                     # Log detallado en consola
                     status_msg = (
                         f"\n"
-                        f"├─ Secuencia: #{header['sequence']}\n"
+                        f"├─ Secuencia: #{header['sequence']} (buffer {header['buffer_index']})\n"
                         f"├─ Dispositivos: {len(devices)} ({', '.join(devices_summary)})\n"
                         f"├─ Anuncios raw: {header['n_adv_raw']}\n"
                         f"└─ GPS: {'✓' if gps_data else '✗'}"
@@ -239,13 +321,11 @@ class CombinedTracker(UARTReceiver):
                     
                     self.logger.info(status_msg)
                     
-                    # Almacenar en MongoDB
-                    if self._store_buffer(header, devices):
-                        buffers_procesados += 1
+                    # Encolar para MongoDB
+                    self._enqueue(self._make_document(header, devices, gps_data))
 
-            except KeyboardInterrupt:
-                self.logger.info("\n=== Captura interrumpida por el usuario ===")
-                self.logger.info(f"Total de buffers procesados: {buffers_procesados}")
+            except EndOfCapture:
+                self.logger.info("=== Fin de la captura alcanzado ===")
                 break
             except Exception as e:
                 self.logger.error(f"Error inesperado: {e}")
@@ -288,6 +368,101 @@ if __name__ == "__main__":
         default="info",
         help="Nivel de logging (default: info)"
     )
+    parser.add_argument(
+        "--protocol",
+        type=str,
+        choices=protocol_choices(),
+        default="v1",
+        help="Formato de trama UART (default: v1)"
+    )
+    parser.add_argument(
+        "--capture",
+        type=str,
+        help="Guarda los bytes UART recibidos en este archivo de captura"
+    )
+    parser.add_argument(
+        "--queue-size",
+        type=int,
+        default=1000,
+        help="Buffers en cola entre la lectura UART y MongoDB (default: 1000)"
+    )
+    parser.add_argument(
+        "--overflow",
+        type=str,
+        choices=OVERFLOW_POLICIES,
+        default="block",
+        help="Con la cola llena: esperar, descartar el más antiguo o desbordar a disco (default: block)"
+    )
+    parser.add_argument(
+        "--sink-workers",
+        type=int,
+        default=1,
+        help="Hilos de escritura en MongoDB (default: 1)"
+    )
+    parser.add_argument(
+        "--spill-file",
+        type=str,
+        help="Archivo de desbordamiento con --overflow spill (default: spill/tracker.spill)"
+    )
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=500,
+        help="Documentos por insert_many (default: 500)"
+    )
+    parser.add_argument(
+        "--batch-bytes",
+        type=int,
+        default=DEFAULT_BATCH_BYTES,
+        help=f"Tamaño estimado en bytes que fuerza un insert_many (default: {DEFAULT_BATCH_BYTES})"
+    )
+    parser.add_argument(
+        "--batch-latency",
+        type=float,
+        default=1.0,
+        help="Segundos máximos que un buffer espera a completar su lote, 0 para escribir en cuanto llega (default: 1.0)"
+    )
+    parser.add_argument(
+        "--journal",
+        type=str,
+        help="Directorio de un diario en disco: los buffers se guardan ahí y se insertan en MongoDB en segundo plano, aunque esté caído"
+    )
+    parser.add_argument(
+        "--journal-fsync",
+        type=str,
+        choices=FSYNC_POLICIES,
+        default="interval",
+        help="fsync del diario: en cada buffer, cada segundo o nunca (default: interval)"
+    )
+    parser.add_argument(
+        "--storage",
+        type=str,
+        choices=STORAGE_MODES,
+        default="buffers",
+        help="Un documento por buffer o una observación por dispositivo en una colección time-series <colección>_ts (default: buffers)"
+    )
+    parser.add_argument(
+        "--encoding",
+        type=str,
+        choices=ENCODINGS,
+        default="standard",
+        help="Codificación de los dispositivos: estándar (hex y MAC como texto) o compacta (binario, MAC entera, nombres cortos) (default: standard)"
+    )
+    parser.add_argument(
+        "--rollups",
+        action="store_true",
+        help="Mantener resúmenes por minuto y hora en <colección>_minute y <colección>_hour (buffers, advertisements, MACs únicas, RSSI, GPS)"
+    )
+    parser.add_argument(
+        "--device-registry",
+        action="store_true",
+        help="Mantener la colección devices con primera/última vez vista, advertisements, RSSI y última posición de cada MAC"
+    )
+    parser.add_argument(
+        "--ad-fields",
+        action="store_true",
+        help="Añadir a cada dispositivo los campos decodificados de sus datos AD (local_name, company_id, service_uuids, tx_power, ...)"
+    )
 
     args = parser.parse_args()
 
@@ -296,8 +471,26 @@ if __name__ == "__main__":
             gps_port=args.gps_port, 
             ble_port=args.ble_port, 
             mongo_uri=args.mongo_uri,
-            log_level=args.log_level
+            log_level=args.log_level,
+            protocol=args.protocol,
+            capture=args.capture,
+            queue_size=args.queue_size,
+            overflow=args.overflow,
+            sink_workers=args.sink_workers,
+            spill_file=args.spill_file,
+            batch_size=args.batch_size,
+            batch_bytes=args.batch_bytes,
+            batch_latency=args.batch_latency,
+            journal=args.journal,
+            journal_fsync=args.journal_fsync,
+            storage=args.storage,
+            encoding=args.encoding,
+            rollups=args.rollups,
+            device_registry=args.device_registry,
+            ad_fields=args.ad_fields
         )
+        # SIGTERM detiene la recepción en menos de POLL_INTERVAL y cierra limpio
+        signal.signal(signal.SIGTERM, lambda signum, frame: tracker.stop())
         tracker.logger.info(
             "Iniciando captura %s", 
             "indefinida" if not args.duration else f"por {args.duration} segundos"
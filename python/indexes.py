@@ -0,0 +1,258 @@
+"""Index provisioning and query plan checks for the scanner collections.
+
+The dashboard (app.py) sorts whole collections by timestamp and analyses
+(utils.py) filter on timestamp ranges; without indexes each poll is a
+collection scan plus an in-memory sort. ensure_indexes() creates the
+indexes below if they are missing and verifies them afterwards; it runs
+when the receivers connect and when app.py starts. query_plans() explains
+the hot queries so a plan that falls back to COLLSCAN or an in-memory SORT
+is reported instead of silently slowing the dashboard down.
+
+    python indexes.py --db tracking_data --collection portfinal
+"""
+import argparse
+from datetime import datetime, timedelta
+
+from pymongo import ASCENDING, DESCENDING, GEOSPHERE, MongoClient
+from pymongo.errors import OperationFailure
+
+from encoding import DEVICES_FIELD, ENCODING_FIELD, is_compact
+from timeseries import is_timeseries
+
+# GeoJSON point of the GPS position, indexed with 2dsphere
+LOCATION_FIELD = 'location'
+
+# name -> (keys, options)
+BUFFER_INDEXES = {
+    'timestamp': ([('timestamp', DESCENDING)], {}),
+    'scanner_sequence': ([('scanner', ASCENDING), ('sequence', ASCENDING)], {}),
+    'location': ([(LOCATION_FIELD, GEOSPHERE)], {}),
+}
+# MAC index by encoding (multikey over the devices array)
+MAC_INDEXES = {
+    'standard': ('devices_mac', [('devices.mac', ASCENDING)]),
+    'compact': ('dv_mac', [(f'{DEVICES_FIELD}.m', ASCENDING)]),
+}
+# Time-series collections (timeseries.py): MongoDB indexes the buckets by
+# meta and time, these serve the dashboard sort and per-device history
+TIMESERIES_INDEXES = {
+    'ts': ([('ts', DESCENDING)], {}),
+    'mac_ts': ([('meta.mac', ASCENDING), ('ts', DESCENDING)], {}),
+    'scanner_ts': ([('meta.scanner', ASCENDING), ('ts', DESCENDING)], {}),
+}
+
+# Plan stages that mean a hot query is not using an index
+SLOW_STAGES = ('COLLSCAN', 'SORT')
+
+
+def geo_point(gps_data):
+    """GeoJSON Point of a gps_data dict, None without a valid position"""
+    coordinates = (gps_data or {}).get('coordinates') or {}
+    longitude = coordinates.get('longitude')
+    latitude = coordinates.get('latitude')
+    if longitude is None or latitude is None:
+        return None
+    if not (-180 <= longitude <= 180 and -90 <= latitude <= 90):
+        return None
+    return {'type': 'Point', 'coordinates': [float(longitude), float(latitude)]}
+
+
+def detect_encoding(collection):
+    """'compact' if the newest document (by timestamp, _ids are hashes) uses
+    the compact encoding, else 'standard'"""
+    document = collection.find_one({}, {ENCODING_FIELD: 1}, sort=[('timestamp', DESCENDING)])
+    return 'compact' if document and is_compact(document) else 'standard'
+
+
+def index_specs(timeseries=False, encoding='standard'):
+    """
+    Indexes expected on a collection
+
+    Args:
+        timeseries (bool): Observation layout (timeseries.py)
+        encoding (str): Buffer encoding, selects the MAC index
+
+    Returns:
+        dict: name -> (keys, options)
+    """
+    if timeseries:
+        return dict(TIMESERIES_INDEXES)
+    name, keys = MAC_INDEXES[encoding]
+    return {**BUFFER_INDEXES, name: (keys, {})}
+
+
+def _key(keys):
+    """Comparable form of an index key, index_information() may return 1.0 for 1"""
+    return tuple((field, int(direction) if isinstance(direction, (int, float)) else direction)
+                 for field, direction in keys)
+
+
+def ensure_indexes(collection, specs):
+    """
+    Create the missing indexes and verify that all of them exist
+
+    An index with the same keys under another name counts as present.
+
+    Returns:
+        list: (name, status) with status 'exists', 'created' or 'failed: <reason>'
+    """
+    existing = {_key(info['key']) for info in collection.index_information().values()}
+    report = []
+    for name, (keys, options) in specs.items():
+        if _key(keys) in existing:
+            report.append((name, 'exists'))
+            continue
+        try:
+            collection.create_index(keys, name=name, **options)
+            report.append((name, 'created'))
+        except OperationFailure as e:
+            report.append((name, f'failed: {e.details.get("errmsg", e) if e.details else e}'))
+
+    # Verify: an index build can fail after create_index returned
+    existing = {_key(info['key']) for info in collection.index_information().values()}
+    return [(name, status if status.startswith('failed') or _key(specs[name][0]) in existing
+             else 'failed: missing after creation')
+            for name, status in report]
+
+
+def hot_queries(timeseries=False, encoding='standard'):
+    """
+    The queries the dashboard and analyses run most often
+
+    Returns:
+        dict: name -> (filter, sort, limit)
+    """
+    now = datetime.now()
+    if timeseries:
+        return {
+            'dashboard': ({}, [('ts', DESCENDING)], 0),
+            'date_range': ({'ts': {'$gte': now - timedelta(hours=1), '$lte': now}},
+                           [('ts', ASCENDING)], 0),
+            'device_history': ({'meta.mac': '00:00:00:00:00:00'}, [('ts', DESCENDING)], 0),
+        }
+    mac_filter = ({f'{DEVICES_FIELD}.m': 0} if encoding == 'compact'
+                  else {'devices.mac': '00:00:00:00:00:00'})
+    return {
+        'dashboard': ({}, [('timestamp', DESCENDING)], 0),
+        'latest': ({}, [('timestamp', DESCENDING)], 1),
+        'date_range': ({'timestamp': {'$gte': now - timedelta(hours=1), '$lte': now}},
+                       [('timestamp', ASCENDING)], 0),
+        'device_history': (mac_filter, None, 0),
+        'scanner_sequence': ({'scanner': '', 'sequence': 0}, None, 0),
+    }
+
+
+def _find(document, key):
+    """First value of key in a nested explain document (depth first)"""
+    if isinstance(document, dict):
+        if key in document:
+            return document[key]
+        values = document.values()
+    elif isinstance(document, list):
+        values = document
+    else:
+        return None
+    for value in values:
+        found = _find(value, key)
+        if found is not None:
+            return found
+    return None
+
+
+def _stages(plan):
+    """Stage names of a winning plan, outermost first, with the index of IXSCANs"""
+    stages = []
+    if isinstance(plan, dict):
+        if 'stage' in plan:
+            stage = plan['stage']
+            if plan.get('indexName'):
+                stage += f"({plan['indexName']})"
+            stages.append(stage)
+        for key in ('queryPlan', 'inputStage', 'inputStages'):
+            stages.extend(_stages(plan.get(key)))
+    elif isinstance(plan, list):
+        for item in plan:
+            stages.extend(_stages(item))
+    return stages
+
+
+def explain_query(collection, filter, sort=None, limit=0):
+    """
+    Winning plan of one find()
+
+    Uses the queryPlanner verbosity: the plans are chosen but the query is
+    not run, so explaining the unbounded dashboard scan at startup costs
+    nothing on a large collection.
+
+    Returns:
+        dict: plan (stages joined by ' > ') and slow (COLLSCAN or in-memory SORT)
+    """
+    command = {'find': collection.name, 'filter': filter}
+    if sort:
+        command['sort'] = dict(sort)
+    if limit:
+        command['limit'] = limit
+    explain = collection.database.command('explain', command, verbosity='queryPlanner')
+    stages = _stages(_find(explain, 'winningPlan'))
+    return {
+        'plan': ' > '.join(stages) or 'unknown',
+        'slow': any(stage.split('(')[0] in SLOW_STAGES for stage in stages),
+    }
+
+
+def query_plans(collection, timeseries=False, encoding='standard'):
+    """
+    Explain every hot query
+
+    Returns:
+        dict: name -> explain_query() summary, or {'error': ...}
+    """
+    plans = {}
+    for name, (filter, sort, limit) in hot_queries(timeseries, encoding).items():
+        try:
+            plans[name] = explain_query(collection, filter, sort, limit)
+        except OperationFailure as e:
+            plans[name] = {'error': str(e)}
+    return plans
+
+
+def provision(collection, timeseries=None, encoding=None):
+    """
+    ensure_indexes() and query_plans() for a buffer or time-series collection
+
+    Args:
+        collection: pymongo Collection
+        timeseries (bool): Layout, detected when None
+        encoding (str): Buffer encoding, detected from the newest document when None
+
+    Returns:
+        tuple: (ensure_indexes report, query_plans result)
+    """
+    if timeseries is None:
+        timeseries = is_timeseries(collection)
+    if encoding is None:
+        encoding = 'standard' if timeseries else detect_encoding(collection)
+    report = ensure_indexes(collection, index_specs(timeseries, encoding))
+    return report, query_plans(collection, timeseries, encoding)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Create the scanner indexes and explain the hot queries')
+    parser.add_argument('--mongo-uri', type=str, default='mongodb://localhost:27017/')
+    parser.add_argument('--db', type=str, default='tracking_data')
+    parser.add_argument('--collection', type=str, default='portfinal')
+    args = parser.parse_args()
+
+    collection = MongoClient(args.mongo_uri)[args.db][args.collection]
+    report, plans = provision(collection)
+    for name, status in report:
+        print(f"index {name:<18} {status}")
+    for name, plan in plans.items():
+        if 'error' in plan:
+            print(f"query {name:<18} error: {plan['error']}")
+            continue
+        print(f"query {name:<18} {'SLOW ' if plan['slow'] else ''}{plan['plan']}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,415 @@
+"""On-disk write-ahead journal between the UART readers and MongoDB.
+
+With --journal DIR every decoded buffer is appended to a segmented,
+append-only journal before anything talks to MongoDB; a replayer thread
+drains it with bulk inserts and checkpoints how far it got. A slow or
+unreachable database only makes the journal grow, and buffers not yet
+stored when the process stops are replayed on the next start.
+
+Layout of DIR:
+    00000000000000000001.wal   segments of <uint32 length><uint32 crc32><pickle>
+    checkpoint.json            {"segment": N, "offset": BYTES} replayed so far
+"""
+import json
+import os
+import pickle
+import struct
+import threading
+import time
+import zlib
+
+from batch_writer import DEFAULT_BATCH_BYTES, estimate_size
+
+RECORD = struct.Struct('<II')  # Payload length and CRC32 of each record
+SEGMENT_SUFFIX = '.wal'
+CHECKPOINT_FILE = 'checkpoint.json'
+SEGMENT_BYTES = 64 * 1024 * 1024
+
+# fsync policies: every append, at most every fsync_interval seconds, or
+# leave it to the OS (survives a process crash, not a power loss)
+FSYNC_POLICIES = ('always', 'interval', 'never')
+
+
+def segment_name(number):
+    return f"{number:020d}{SEGMENT_SUFFIX}"
+
+
+class Journal:
+    """Segmented append-only record log with a persisted read checkpoint.
+
+    append() may be called from any thread; read()/commit() belong to a
+    single consumer (the replayer).
+    """
+
+    def __init__(self, directory, segment_bytes=SEGMENT_BYTES, fsync='interval',
+                 fsync_interval=1.0, size=estimate_size):
+        """
+        Args:
+            directory (str): Journal directory, created if missing
+            segment_bytes (int): Size at which a new segment is started
+            fsync (str): One of FSYNC_POLICIES
+            fsync_interval (float): Seconds between fsyncs with fsync='interval'
+            size: Callable estimating the size of a record for read()'s max_bytes
+        """
+        if fsync not in FSYNC_POLICIES:
+            raise ValueError(f"Unknown fsync policy: {fsync}")
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.fsync = fsync
+        self.fsync_interval = fsync_interval
+        self.size = size
+        self._lock = threading.Lock()
+        self._last_sync = time.monotonic()
+        self._unsynced = False
+
+        # Metrics
+        self.appended = 0
+        self.replayed = 0
+        self.corrupt = 0
+        self.truncated_bytes = 0
+
+        self.checkpoint = self._load_checkpoint()
+        segments = self._segments()
+        if segments:
+            self.truncated_bytes = self._recover(segments[-1])
+        # Records left by a previous run that were never replayed
+        self.pending = self._count_pending(segments)
+
+        self.write_segment = segments[-1] if segments else max(1, self.checkpoint[0])
+        self._writer = open(self._path(self.write_segment), 'ab')
+        self._written = self._writer.tell()
+
+        self.read_segment, self.read_offset = self.checkpoint
+        if self.read_segment < (segments[0] if segments else self.write_segment):
+            self.read_segment, self.read_offset = (segments[0] if segments else self.write_segment), 0
+        self.checkpoint = (self.read_segment, self.read_offset)
+        self._reader = None
+
+    # -- files ---------------------------------------------------------------
+
+    def _path(self, number):
+        return os.path.join(self.directory, segment_name(number))
+
+    def _segments(self):
+        return sorted(int(name[:-len(SEGMENT_SUFFIX)]) for name in os.listdir(self.directory)
+                      if name.endswith(SEGMENT_SUFFIX) and name[:-len(SEGMENT_SUFFIX)].isdigit())
+
+    def _load_checkpoint(self):
+        try:
+            with open(os.path.join(self.directory, CHECKPOINT_FILE)) as f:
+                data = json.load(f)
+            return int(data['segment']), int(data['offset'])
+        except (OSError, ValueError, KeyError):
+            return 0, 0
+
+    def _save_checkpoint(self):
+        path = os.path.join(self.directory, CHECKPOINT_FILE)
+        with open(path + '.tmp', 'w') as f:
+            json.dump({'segment': self.read_segment, 'offset': self.read_offset}, f)
+            if self.fsync != 'never':
+                f.flush()
+                os.fsync(f.fileno())
+        os.replace(path + '.tmp', path)
+        self.checkpoint = (self.read_segment, self.read_offset)
+
+    @staticmethod
+    def _scan(f, start=0):
+        """Yield (offset after the record, payload) of the valid records from start"""
+        f.seek(start)
+        while True:
+            prefix = f.read(RECORD.size)
+            if len(prefix) < RECORD.size:
+                return
+            length, crc = RECORD.unpack(prefix)
+            payload = f.read(length)
+            if len(payload) < length or zlib.crc32(payload) != crc:
+                return
+            yield f.tell(), payload
+
+    def _recover(self, number):
+        """Cut a record torn by a crash off the end of the last segment"""
+        with open(self._path(number), 'r+b') as f:
+            end = 0
+            for end, _ in self._scan(f):
+                pass
+            size = f.seek(0, os.SEEK_END)
+            if size > end:
+                f.truncate(end)
+            return size - end
+
+    def _count_pending(self, segments):
+        count = 0
+        for number in segments:
+            if number < self.checkpoint[0]:
+                continue
+            start = self.checkpoint[1] if number == self.checkpoint[0] else 0
+            with open(self._path(number), 'rb') as f:
+                count += sum(1 for _ in self._scan(f, start))
+        return count
+
+    # -- producer ------------------------------------------------------------
+
+    def append(self, document):
+        """Write one document to the journal (durable per the fsync policy)"""
+        payload = pickle.dumps(document, protocol=pickle.HIGHEST_PROTOCOL)
+        record = RECORD.pack(len(payload), zlib.crc32(payload)) + payload
+        with self._lock:
+            if self._written and self._written + len(record) > self.segment_bytes:
+                self._roll()
+            self._writer.write(record)
+            self._writer.flush()
+            self._written += len(record)
+            self._unsynced = True
+            self.appended += 1
+            self.pending += 1
+            if self.fsync == 'always':
+                self._sync()
+            elif self.fsync == 'interval':
+                self._sync_due()
+
+    def _roll(self):
+        """Start the next segment"""
+        self._sync()
+        self._writer.close()
+        self.write_segment += 1
+        self._writer = open(self._path(self.write_segment), 'ab')
+        self._written = 0
+
+    def _sync(self):
+        if self._unsynced and self.fsync != 'never':
+            os.fsync(self._writer.fileno())
+        self._unsynced = False
+        self._last_sync = time.monotonic()
+
+    def _sync_due(self):
+        if self._unsynced and time.monotonic() - self._last_sync >= self.fsync_interval:
+            self._sync()
+
+    def sync_due(self):
+        """fsync appends older than fsync_interval (called by the replayer when idle)"""
+        if self.fsync == 'interval':
+            with self._lock:
+                self._sync_due()
+
+    # -- consumer ------------------------------------------------------------
+
+    def read(self, max_items=500, max_bytes=DEFAULT_BATCH_BYTES):
+        """
+        Read the next records after the last read() without committing them
+
+        Returns:
+            list: Documents in append order, empty when caught up
+        """
+        documents = []
+        size = 0
+        while len(documents) < max_items and size < max_bytes:
+            with self._lock:
+                write_segment, written = self.write_segment, self._written
+            if self._reader is None:
+                self._reader = open(self._path(self.read_segment), 'rb')
+            end = written if self.read_segment == write_segment else None
+
+            for offset, payload in self._scan(self._reader, self.read_offset):
+                if end is not None and offset > end:
+                    break
+                document = pickle.loads(payload)
+                documents.append(document)
+                size += self.size(document)
+                self.read_offset = offset
+                if len(documents) >= max_items or size >= max_bytes:
+                    return documents
+
+            if self.read_segment >= write_segment:
+                if self.read_offset < end:
+                    # Damaged record in the active segment: what follows it up
+                    # to end is lost, appends after end start on a record boundary
+                    self.corrupt += 1
+                    self.read_offset = end
+                    continue
+                break
+            if self.read_offset < os.path.getsize(self._path(self.read_segment)):
+                self.corrupt += 1  # Damaged record: the rest of this segment is lost
+            self._reader.close()
+            self._reader = None
+            self.read_segment += 1
+            self.read_offset = 0
+        if not documents:
+            with self._lock:
+                if self.read_segment == self.write_segment and self.read_offset >= self._written:
+                    self.pending = 0  # Records counted but lost to corruption
+        return documents
+
+    def rewind(self):
+        """Forget reads since the last commit (their insert failed)"""
+        self.read_segment, self.read_offset = self.checkpoint
+        if self._reader:
+            self._reader.close()
+            self._reader = None
+
+    def commit(self, count):
+        """Persist the read position and delete fully replayed segments"""
+        self._save_checkpoint()
+        self.replayed += count
+        with self._lock:
+            self.pending -= count
+        for number in self._segments():
+            if number >= self.read_segment:
+                break
+            os.remove(self._path(number))
+
+    def metrics(self):
+        with self._lock:
+            return {
+                'pending': self.pending,
+                'appended': self.appended,
+                'replayed': self.replayed,
+                'segments': self.write_segment - self.read_segment + 1,
+                'corrupt': self.corrupt,
+                'truncated_bytes': self.truncated_bytes,
+            }
+
+    def close(self):
+        with self._lock:
+            self._sync()
+            self._writer.close()
+        if self._reader:
+            self._reader.close()
+            self._reader = None
+
+
+class JournalPipeline:
+    """SinkPipeline counterpart that puts a Journal between reader and store.
+
+    put() appends to the journal and never waits for the database; one
+    replayer thread reads batches, stores them and commits the checkpoint.
+    A store call that raises (database unreachable) is retried with backoff
+    from the same position, so nothing is skipped.
+    """
+
+    RETRY_MIN = 1.0
+    RETRY_MAX = 30.0
+
+    def __init__(self, store, directory, fsync='interval', fsync_interval=1.0,
+                 segment_bytes=SEGMENT_BYTES, max_batch=500, max_bytes=DEFAULT_BATCH_BYTES,
+                 max_latency=1.0, name='journal-replayer', on_error=None):
+        """
+        Args:
+            store: Callable taking a list of documents, returns how many were
+                stored and raises when the database is unavailable
+            directory (str): Journal directory
+            fsync (str): One of FSYNC_POLICIES
+            max_batch (int): Most documents per store call
+            max_bytes (int): Estimated size that ends a batch
+            max_latency (float): Longest a buffer waits for its batch to fill
+            on_error: Called with the exception when a store call fails
+        """
+        self.store = store
+        self.journal = Journal(directory, segment_bytes, fsync, fsync_interval)
+        self.max_batch = max_batch
+        self.max_bytes = max_bytes
+        self.max_latency = max_latency
+        self.on_error = on_error
+        self._wake = threading.Event()     # Set by put() and stop()
+        self._full = threading.Event()     # Set by put() once max_batch are pending, and stop()
+        self._stopped = threading.Event()  # Set by stop(), ends retry waits
+        self._stopping = False
+        self._thread = threading.Thread(target=self._work, name=name, daemon=True)
+
+        # Metrics
+        self.stored = 0
+        self.failed = 0
+        self.flushes = 0
+        self.retries = 0
+        self.max_flush = 0
+        self.total_flush_s = 0.0
+        self.max_flush_s = 0.0
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def put(self, document, timeout=None):
+        self.journal.append(document)
+        self._wake.set()
+        if self.journal.pending >= self.max_batch:
+            self._full.set()  # End the fill wait, the batch is complete
+        return True
+
+    def _wait(self, seconds):
+        self._wake.wait(seconds)
+        self._wake.clear()
+
+    def _work(self):
+        retry = self.RETRY_MIN
+        while True:
+            pending = self.journal.pending
+            if not pending:
+                if self._stopping:
+                    return
+                self.journal.sync_due()
+                self._wait(self.journal.fsync_interval)
+                continue
+            if pending < self.max_batch and not self._stopping and self.max_latency:
+                # Let the batch fill for up to max_latency
+                self._full.wait(self.max_latency)
+            self._full.clear()
+
+            documents = self.journal.read(self.max_batch, self.max_bytes)
+            if not documents:
+                self._wait(0.05)
+                continue
+            start = time.perf_counter()
+            try:
+                stored = self.store(documents)
+            except Exception as e:
+                self.journal.rewind()
+                self.retries += 1
+                if self.on_error:
+                    self.on_error(e)
+                if self._stopping:
+                    return  # Kept in the journal for the next start
+                self._stopped.wait(retry)  # New buffers must not cut the backoff short
+                retry = min(retry * 2, self.RETRY_MAX)
+                continue
+            elapsed = time.perf_counter() - start
+            retry = self.RETRY_MIN
+
+            self.journal.commit(len(documents))
+            self.stored += stored
+            self.failed += len(documents) - stored
+            self.flushes += 1
+            self.max_flush = max(self.max_flush, len(documents))
+            self.total_flush_s += elapsed
+            self.max_flush_s = max(self.max_flush_s, elapsed)
+
+    def stop(self, timeout=5.0):
+        """
+        Let the replayer drain the journal for up to timeout seconds
+
+        Returns:
+            int: Documents left in the journal for the next start
+        """
+        self._stopping = True
+        self._wake.set()
+        self._full.set()
+        self._stopped.set()
+        self._thread.join(timeout)
+        left = self.journal.pending
+        if not self._thread.is_alive():
+            self.journal.close()
+        return left
+
+    def metrics(self):
+        metrics = self.journal.metrics()
+        metrics.update({
+            'stored': self.stored,
+            'failed': self.failed,
+            'retries': self.retries,
+            'flushes': self.flushes,
+            'avg_flush': round((self.stored + self.failed) / self.flushes, 1) if self.flushes else 0.0,
+            'max_flush': self.max_flush,
+            'avg_flush_ms': round(self.total_flush_s / self.flushes * 1000, 2) if self.flushes else 0.0,
+            'max_flush_ms': round(self.max_flush_s * 1000, 2),
+        })
+        return metrics
@@ -0,0 +1,254 @@
+"""MongoDB storage shared by the UART receivers.
+
+uart-mongo.py (UARTMongoReceiver) and gps_ble_tracker.py (CombinedTracker)
+store buffers the same way: a SinkPipeline or, with --journal, a
+JournalPipeline feeds unordered inserts of documents with deterministic
+_ids (dedup.py), into the buffer collection or its time-series counterpart,
+and the buffers actually stored update the rollups and the device registry.
+MongoStore holds that path. The receivers list it before UARTReceiver and
+provide self.logger, self.db, self.collection, self.encoding and ports().
+"""
+import os
+import time
+
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+
+from batch_writer import DEFAULT_BATCH_BYTES
+from dedup import BufferIds, RecentIds, capture_sessions, split_write_errors
+from indexes import provision
+from journal import FSYNC_POLICIES, JournalPipeline
+from pipeline import OVERFLOW_POLICIES, SinkPipeline
+from registry import DeviceRegistry
+from rollups import RollupWriter
+from timeseries import COLLECTION_SUFFIX, ObservationWriter
+
+
+# Connection options: without MongoDB, startup fails (or falls back to the
+# journal) within seconds instead of pymongo's default 30 s
+MONGO_TIMEOUTS = {
+    'serverSelectionTimeoutMS': 5000,
+    'connectTimeoutMS': 5000,
+    'socketTimeoutMS': 5000,
+}
+
+
+class MongoStore:
+    """Queue (or journal) to MongoDB, _id deduplication and summaries"""
+
+    # Default spill file with overflow='spill'
+    SPILL_FILE = os.path.join("spill", "uart_mongo.spill")
+
+    def _setup_pipeline(self, queue_size, overflow, sink_workers, spill_file,
+                        batch_size=500, batch_bytes=DEFAULT_BATCH_BYTES, batch_latency=1.0,
+                        journal=None, journal_fsync='interval'):
+        """Keep the configuration of the reader -> MongoDB queue (or journal)"""
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError(f"Unknown overflow policy: {overflow}")
+        if journal_fsync not in FSYNC_POLICIES:
+            raise ValueError(f"Unknown fsync policy: {journal_fsync}")
+        self.pipeline_options = {
+            'maxsize': queue_size,
+            'overflow': overflow,
+            'workers': sink_workers,
+            'spill_path': spill_file or self.SPILL_FILE,
+            'max_batch': batch_size,
+            'max_bytes': batch_bytes,
+            'max_latency': batch_latency,
+        }
+        self.journal_options = {
+            'directory': journal,
+            'fsync': journal_fsync,
+            'max_batch': batch_size,
+            'max_bytes': batch_bytes,
+            'max_latency': batch_latency,
+        } if journal else None
+        self.pipeline = None
+
+    def _open_storage(self, storage='buffers', rollups=False, device_registry=False):
+        """Optional writers on self.db and self.collection, and the recent _id window"""
+        # Reader session in the _ids of layouts without a firmware timestamp
+        self.buffer_ids = BufferIds(int(time.time() * 1000), capture_sessions(self.ports()))
+        self.recent_ids = RecentIds()
+        self.observations = None
+        self.rollups = None
+        self.registry = None
+        self.indexes_checked = False
+        if storage == 'timeseries':
+            self.observations = ObservationWriter(self.db, self.collection.name + COLLECTION_SUFFIX)
+        if rollups:
+            name = self.observations.name if self.observations else self.collection.name
+            self.rollups = RollupWriter(self.db, name)
+        if device_registry:
+            self.registry = DeviceRegistry(self.db)
+
+    def _check_server(self, mongo_uri):
+        """Check that MongoDB answers and provision the indexes; with --journal
+        a MongoDB that is down does not stop startup, and the indexes are
+        provisioned with the first stored batch"""
+        try:
+            self.client.server_info()
+        except Exception as e:
+            if self.journal_options:
+                self.logger.warning(f"MongoDB unavailable, writing to the journal: {e}")
+                return
+            self.logger.error(f"Error connecting to MongoDB: {e}")
+            raise
+        self.logger.info(f"Connected to MongoDB at {mongo_uri}")
+        self._provision_indexes()
+
+    def _provision_indexes(self):
+        """Create the missing indexes and log the plans of the hot queries"""
+        # Once with MongoDB available, whether it succeeds or not
+        self.indexes_checked = True
+        try:
+            if self.observations:
+                collection, timeseries = self.observations.ensure_collection(), True
+            else:
+                collection, timeseries = self.collection, False
+            report, plans = provision(collection, timeseries, self.encoding)
+        except Exception as e:
+            self.logger.warning(f"Could not check the indexes: {e}")
+            return
+        for name, status in report:
+            if status == 'created':
+                self.logger.info(f"Index {name} created on {collection.name}")
+            elif status != 'exists':
+                self.logger.warning(f"Index {name} on {collection.name}: {status}")
+        for name, plan in plans.items():
+            if 'error' in plan:
+                self.logger.warning(f"Could not explain query {name}: {plan['error']}")
+            elif plan['slow']:
+                self.logger.warning(f"Query {name} without an index: {plan['plan']}")
+            else:
+                self.logger.debug(f"Query {name}: {plan['plan']}")
+
+    def _document_id(self, header, scanner_id):
+        """Deterministic _id of a buffer: a resend or a journal replay produces
+        the same _id and MongoDB rejects it as a duplicate"""
+        return self.buffer_ids(scanner_id, header)
+
+    def _insert_documents(self, documents):
+        """Insert documents into MongoDB, returns how many were stored"""
+        try:
+            return self._write_documents(documents)
+        except Exception as e:
+            self.logger.error(f"Error storing in the database: {e}")
+            return 0
+
+    def _write_documents(self, documents):
+        """Unordered insert of the new documents; duplicates (same _id) count as
+        stored, and connection errors propagate so the journal retries the batch"""
+        fresh = self.recent_ids.filter(documents)
+        skipped = len(documents) - len(fresh)
+        if not fresh:
+            return skipped
+        stored = self._write_fresh(fresh)
+        if not self.indexes_checked:
+            # MongoDB was down at startup and answers now
+            self._provision_indexes()
+        return skipped + stored
+
+    def _write_fresh(self, fresh):
+        """Insert documents that are not in the recent _id window, returns how
+        many ended up in MongoDB"""
+        if self.observations:
+            failed = self.observations.insert_buffers(fresh)
+            if failed:
+                self.logger.error(f"{len(failed)} buffers not stored in {self.observations.name}")
+                fresh = [document for index, document in enumerate(fresh) if index not in failed]
+            # The stored ones are recorded even if others in the batch failed
+            self.recent_ids.add(fresh)
+            self._update_summaries(fresh)
+            return len(fresh)
+        duplicates = failed = set()
+        try:
+            if len(fresh) == 1:
+                result = self.collection.insert_one(fresh[0])
+                self.logger.debug(f"Buffer stored in the database - ID: {result.inserted_id}")
+            else:
+                result = self.collection.insert_many(fresh, ordered=False)
+                self.logger.debug(f"{len(result.inserted_ids)} buffers stored in the database")
+        except DuplicateKeyError:
+            duplicates = {0}
+        except BulkWriteError as e:
+            # Unordered: only the documents with an error are missing
+            duplicates, failed = split_write_errors(e.details)
+            if failed:
+                errors = [error for error in e.details.get('writeErrors', [])
+                          if error['index'] in failed]
+                self.logger.error(f"Error storing in the database: {errors[:1]}")
+        if duplicates:
+            self.recent_ids.reject(len(duplicates))
+            self.logger.debug(f"{len(duplicates)} duplicate buffers were already in the database")
+        if not (failed or duplicates):
+            self.recent_ids.add(fresh)
+            self._update_summaries(fresh)
+            return len(fresh)
+        self.recent_ids.add([document for index, document in enumerate(fresh)
+                             if index not in failed])
+        # Duplicates were added to the summaries the first time
+        self._update_summaries([document for index, document in enumerate(fresh)
+                                if index not in failed and index not in duplicates])
+        return len(fresh) - len(failed)
+
+    def _update_summaries(self, documents):
+        """Add the stored buffers to the minute and hour rollups and to the
+        device registry"""
+        # The buffers are already in MongoDB: an error here does not retry the batch
+        if self.rollups:
+            try:
+                self.rollups.update(documents)
+            except Exception as e:
+                self.logger.error(f"Error updating the rollups: {e}")
+        if self.registry:
+            try:
+                self.registry.update(documents)
+            except Exception as e:
+                self.logger.error(f"Error updating the device registry: {e}")
+
+    def _log_store_error(self, error):
+        self.logger.error(f"MongoDB unavailable, buffers wait in the journal: {error}")
+
+    def _make_pipeline(self):
+        """In-memory queue or, with --journal, on-disk journal to MongoDB"""
+        if self.journal_options:
+            return JournalPipeline(self._write_documents, name='mongo-journal',
+                                   on_error=self._log_store_error, **self.journal_options)
+        return SinkPipeline(self._insert_documents, name='mongo-sink', **self.pipeline_options)
+
+    def _enqueue(self, document):
+        """Hand a document to the writer threads (or write it without a queue)"""
+        if self.pipeline is None:
+            return self._insert_documents([document]) == 1
+        # With overflow='block', retry so stop() is still honored
+        while self.running:
+            if self.pipeline.put(document, timeout=self.POLL_INTERVAL):
+                return True
+        return False
+
+    def _log_pipeline(self):
+        """Log queue depth and lag (or what is pending in the journal)"""
+        m = self.pipeline.metrics()
+        if isinstance(self.pipeline, JournalPipeline):
+            self.logger.info(
+                f"Journal: {m['pending']} buffers pending in {m['segments']} segments, "
+                f"retries: {m['retries']}, corrupt: {m['corrupt']}, "
+                f"stored: {m['stored']}, failed: {m['failed']}"
+            )
+        else:
+            self.logger.info(
+                f"Queue: {m['depth']}/{m['maxsize']} (max {m['max_depth']}), "
+                f"on disk: {m['spill_depth']}, dropped: {m['dropped']}, "
+                f"lag: {m['last_lag_s']:.3f}s (max {m['max_lag_s']:.3f}s), "
+                f"stored: {m['stored']}, failed: {m['failed']}"
+            )
+        self.logger.info(
+            f"Writes: {m['flushes']} insert_many, {m['avg_flush']} docs on average "
+            f"(max {m['max_flush']}), {m['avg_flush_ms']:.1f} ms on average "
+            f"(max {m['max_flush_ms']:.1f} ms)"
+        )
+        d = self.recent_ids.stats()
+        self.logger.info(
+            f"Duplicates: {d['skipped']} skipped in memory, "
+            f"{d['rejected']} rejected by MongoDB"
+        )
@@ -0,0 +1,255 @@
+"""Batched and compressed MQTT messages.
+
+With --mqtt-batch-size > 1 or --compress, publish.py coalesces buffer
+payloads (mqtt_payload.py) into one message per batch, bounded by count,
+size and added latency like the MongoDB BatchWriter:
+    envelope (content 'batch')
+    | BATCH_HEADER: compression, dictionary id, count, epoch,
+                    first and last buffer_index (the sequence range)
+    | body: <uint32 length><payload> per buffer, compressed as a whole
+Buffers of a batch share a single PUBACK and broker write. Compression is
+zlib or zstd (the zstandard package) with an optional preset dictionary
+trained on advertisement payloads, which helps most on the small batches
+that tight latency bounds produce. The dictionary id (crc32) travels in
+the header so a subscriber with a different dictionary fails loudly.
+
+    python mqtt_batch.py --capture campo.cap --format frame --output adv.dict
+"""
+import argparse
+import struct
+import zlib
+from collections import Counter
+
+from capture import read_records
+from framing import FrameReader
+from mqtt_payload import (CONTENT_CODES, ENVELOPE, ENVELOPE_MAGIC, PAYLOAD_FORMATS,
+                          PAYLOAD_VERSION, decode_payload, payload_format)
+from protocol import get_protocol
+
+COMPRESSIONS = ('none', 'zlib', 'zstd')
+COMPRESSION_CODES = {name: code for code, name in enumerate(COMPRESSIONS)}
+BATCH_HEADER = struct.Struct('>BIHIqq')
+LENGTH = struct.Struct('>I')
+ZLIB_LEVEL = 6
+ZSTD_LEVEL = 3
+# zlib only looks 32 KiB back, a larger dictionary is wasted
+DICTIONARY_SIZE = 32 * 1024
+
+
+def _zstd():
+    try:
+        import zstandard
+    except ImportError:
+        raise ValueError("zstd compression needs the zstandard package (pip install zstandard)") from None
+    return zstandard
+
+
+def check_compression(compression):
+    """Raise ValueError if compression is unknown or its package is missing"""
+    if compression not in COMPRESSIONS:
+        raise ValueError(f"Unknown compression: {compression}")
+    if compression == 'zstd':
+        _zstd()
+
+
+def dictionary_id(dictionary):
+    """Id of a preset dictionary, 0 without one"""
+    return zlib.crc32(dictionary) if dictionary else 0
+
+
+def compress(data, compression, dictionary=None):
+    """Compress a batch body with 'none', 'zlib' or 'zstd'"""
+    if compression == 'none':
+        return data
+    if compression == 'zlib':
+        compressor = (zlib.compressobj(ZLIB_LEVEL, zdict=dictionary) if dictionary
+                      else zlib.compressobj(ZLIB_LEVEL))
+        return compressor.compress(data) + compressor.flush()
+    zstandard = _zstd()
+    dict_data = zstandard.ZstdCompressionDict(dictionary) if dictionary else None
+    return zstandard.ZstdCompressor(level=ZSTD_LEVEL, dict_data=dict_data).compress(data)
+
+
+def decompress(data, compression, dictionary=None):
+    """Inverse of compress()"""
+    if compression == 'none':
+        return data
+    if compression == 'zlib':
+        decompressor = zlib.decompressobj(zdict=dictionary) if dictionary else zlib.decompressobj()
+        return decompressor.decompress(data) + decompressor.flush()
+    zstandard = _zstd()
+    dict_data = zstandard.ZstdCompressionDict(dictionary) if dictionary else None
+    return zstandard.ZstdDecompressor(dict_data=dict_data).decompress(data)
+
+
+def encode_batch(payloads, compression='none', dictionary=None, epoch=0, first=-1, last=-1):
+    """
+    One message carrying several buffer payloads
+
+    Args:
+        payloads (list): Single-buffer payloads (bytes or JSON str)
+        compression (str): One of COMPRESSIONS
+        dictionary (bytes): Preset dictionary, None for none
+        epoch (int): Scanner epoch of the batch
+        first (int): buffer_index of the first buffer (-1 if unknown)
+        last (int): buffer_index of the last buffer (-1 if unknown)
+
+    Returns:
+        bytes: The message payload
+    """
+    body = b''.join(LENGTH.pack(len(payload)) + payload
+                    for payload in (p.encode() if isinstance(p, str) else p for p in payloads))
+    header = BATCH_HEADER.pack(COMPRESSION_CODES[compression], dictionary_id(dictionary),
+                               len(payloads), epoch or 0, first, last)
+    return (ENVELOPE.pack(ENVELOPE_MAGIC, CONTENT_CODES['batch'], PAYLOAD_VERSION) + header +
+            compress(body, compression, dictionary))
+
+
+def batch_info(payload):
+    """
+    Header of a batch message, readable without decompressing it
+
+    Returns:
+        dict: compression, dictionary_id, count, epoch, first, last
+    """
+    values = BATCH_HEADER.unpack_from(payload, ENVELOPE.size)
+    info = dict(zip(('compression', 'dictionary_id', 'count', 'epoch', 'first', 'last'), values))
+    if info['compression'] >= len(COMPRESSIONS):
+        raise ValueError(f"Unknown batch compression {info['compression']}")
+    info['compression'] = COMPRESSIONS[info['compression']]
+    return info
+
+
+def split_batch(payload, dictionary=None):
+    """
+    Single-buffer payloads of a batch message
+
+    Returns:
+        list: The payloads as published, in order
+    """
+    info = batch_info(payload)
+    if info['dictionary_id'] != dictionary_id(dictionary):
+        raise ValueError(f"Batch compressed with dictionary {info['dictionary_id']:08x}, "
+                         f"have {dictionary_id(dictionary):08x}")
+    body = decompress(payload[ENVELOPE.size + BATCH_HEADER.size:], info['compression'], dictionary)
+    payloads = []
+    offset = 0
+    while offset < len(body):
+        (length,) = LENGTH.unpack_from(body, offset)
+        offset += LENGTH.size
+        payloads.append(body[offset:offset + length])
+        offset += length
+    if len(payloads) != info['count'] or offset != len(body):
+        raise ValueError(f"Batch holds {len(payloads)} payloads, header says {info['count']}")
+    return payloads
+
+
+def decode_message(payload, dictionary=None):
+    """
+    Buffer documents of a message of any format, batched or not
+
+    Returns:
+        tuple: (format, list of standard buffer documents); batches report
+        the format of their payloads
+    """
+    name, version = payload_format(payload)
+    if name != 'batch':
+        name, document = decode_payload(payload)
+        return name, [document]
+    if version != PAYLOAD_VERSION:
+        raise ValueError(f"Unsupported batch payload version {version}")
+    documents = []
+    formats = set()
+    for inner in split_batch(payload, dictionary):
+        inner_format, document = decode_payload(inner)
+        formats.add(inner_format)
+        documents.append(document)
+    return '+'.join(sorted(formats)) or 'batch', documents
+
+
+def load_dictionary(path):
+    """Preset dictionary file, None without a path"""
+    if not path:
+        return None
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def advertisement_payloads(frames, protocol):
+    """Advertisement data of every device in frames, trimmed to data_len"""
+    payloads = []
+    for frame in frames:
+        batch = protocol.decode_devices(frame)
+        for data, data_len in zip(batch.payloads(), batch.records['data_len'].tolist()):
+            payloads.append(data[:data_len])
+    return payloads
+
+
+def train_dictionary(payloads, message_format='frame', compression='zlib', size=DICTIONARY_SIZE):
+    """
+    Preset dictionary from advertisement payloads
+
+    For zlib the most frequent payloads are concatenated, most frequent last
+    (closest to the data, cheapest to reference); zstd trains its own.
+
+    Args:
+        payloads (list): Advertisement data (bytes)
+        message_format (str): Format of the published payloads; JSON carries
+            the data in hex
+        compression (str): 'zlib' or 'zstd'
+        size (int): Dictionary size in bytes
+
+    Returns:
+        bytes: The dictionary
+    """
+    if message_format == 'json':
+        payloads = [payload.hex().encode() for payload in payloads]
+    if compression == 'zstd':
+        return _zstd().train_dictionary(size, payloads).as_bytes()
+    chosen = []
+    total = 0
+    for payload, _ in Counter(payload for payload in payloads if payload).most_common():
+        if total + len(payload) > size:
+            break
+        chosen.append(payload)
+        total += len(payload)
+    return b''.join(reversed(chosen))
+
+
+def capture_frames(path, protocol='auto'):
+    """Every complete frame of a capture file, with the detected layout"""
+    with open(path, 'rb') as f:
+        data = f.read()
+    reader = FrameReader(None, get_protocol(protocol))
+    frames = []
+    for _, offset, length in read_records(data):
+        reader.feed(data[offset:offset + length])
+        frame = reader.next_frame()
+        while frame:
+            frames.append(bytes(frame[1]))
+            frame = reader.next_frame()
+    return frames, reader.protocol
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Train an MQTT compression dictionary from a UART capture')
+    parser.add_argument('--capture', type=str, required=True, help='Capture file (capture.py)')
+    parser.add_argument('--protocol', type=str, default='auto')
+    parser.add_argument('--format', type=str, choices=PAYLOAD_FORMATS, default='frame',
+                        help='Payload format the dictionary is for (default: frame)')
+    parser.add_argument('--compress', type=str, choices=COMPRESSIONS[1:], default='zlib')
+    parser.add_argument('--size', type=int, default=DICTIONARY_SIZE)
+    parser.add_argument('--output', type=str, required=True)
+    args = parser.parse_args()
+
+    frames, protocol = capture_frames(args.capture, args.protocol)
+    payloads = advertisement_payloads(frames, protocol)
+    dictionary = train_dictionary(payloads, args.format, args.compress, args.size)
+    with open(args.output, 'wb') as f:
+        f.write(dictionary)
+    print(f"{len(frames)} frames, {len(payloads)} payloads -> {len(dictionary)} B dictionary "
+          f"{dictionary_id(dictionary):08x} in {args.output}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,142 @@
+"""Payload formats of the buffers published to MQTT.
+
+'json' is the original payload: the standard buffer document with the
+advertising data in hex and ISO timestamps. The binary formats skip the
+per-device dicts, hex and json.dumps on the gateway:
+    bson  -> the buffer document in the compact encoding (encoding.py):
+             int MACs, binary data, native datetimes and ObjectId
+    frame -> the validated UART frame as received, plus the fields the
+             publisher adds (_id, receive time, sequence tracking); the
+             subscriber decodes it with the frame's protocol
+MQTT 3.1.1 has no message properties, so binary payloads start with an
+envelope carrying the content type and format version:
+    ENVELOPE_MAGIC (2 bytes) | content code (1) | version (1) | BSON document
+JSON payloads have no envelope and start with '{'.
+"""
+import json
+import struct
+from datetime import datetime
+
+import bson
+from bson import ObjectId
+
+from encoding import COMPACT_VERSION, DEVICES_FIELD, ENCODING_FIELD, compact_devices, expand_document
+from protocol import get_protocol
+
+PAYLOAD_FORMATS = ('json', 'bson', 'frame')
+PAYLOAD_VERSION = 1
+CONTENT_TYPES = {
+    'json': 'application/json',
+    'bson': 'application/bson',
+    'frame': 'application/vnd.ble-scanner.frame',
+}
+ENVELOPE_MAGIC = b'BS'
+ENVELOPE = struct.Struct('>2sBB')
+# Content code of each binary format in the envelope ('batch': mqtt_batch.py)
+CONTENT_CODES = {'bson': 1, 'frame': 2, 'batch': 3}
+CODE_FORMATS = {code: name for name, code in CONTENT_CODES.items()}
+# Buffer fields a 'frame' payload carries in the frame header
+FRAME_FIELDS = ('sequence', 'n_adv_raw', 'n_mac')
+
+
+def _envelope(payload_format, document):
+    return ENVELOPE.pack(ENVELOPE_MAGIC, CONTENT_CODES[payload_format], PAYLOAD_VERSION) + \
+        bson.encode(document)
+
+
+def encode_payload(payload_format, fields, header, devices, protocol, ad_fields=False):
+    """
+    Message payload of one buffer
+
+    Args:
+        payload_format (str): One of PAYLOAD_FORMATS
+        fields (dict): Buffer fields (_id, timestamp, sequence, ...), with
+            datetime values and the _id as an ObjectId
+        header (dict): Parsed frame header
+        devices (DeviceBatch): Decoded device records
+        protocol (Protocol): Layout of the frame
+        ad_fields (bool): Add the decoded advertising data fields to the
+            devices (for 'frame', the subscriber adds them)
+
+    Returns:
+        bytes or str: The payload to publish
+    """
+    if payload_format == 'json':
+        document = {key: value.isoformat() if isinstance(value, datetime) else value
+                    for key, value in fields.items()}
+        document['_id'] = str(fields['_id'])
+        document['devices'] = devices.to_documents(ad_fields)
+        return json.dumps(document)
+    if payload_format == 'bson':
+        return _envelope('bson', {**fields, ENCODING_FIELD: COMPACT_VERSION,
+                                  DEVICES_FIELD: compact_devices(devices, ad_fields)})
+    if payload_format == 'frame':
+        fields = {key: value for key, value in fields.items() if key not in FRAME_FIELDS}
+        if ad_fields:
+            fields['ad_fields'] = True
+        return _envelope('frame', {**fields, 'protocol': protocol.name,
+                                   'frame': protocol.encode_frame(header, devices.records)})
+    raise ValueError(f"Unknown payload format '{payload_format}'")
+
+
+def payload_format(payload):
+    """
+    Format and version of a received payload
+
+    Returns:
+        tuple: (format, version); JSON payloads have version None
+    """
+    if payload[:len(ENVELOPE_MAGIC)] != ENVELOPE_MAGIC:
+        return 'json', None
+    if len(payload) < ENVELOPE.size:
+        raise ValueError("Truncated payload envelope")
+    _, code, version = ENVELOPE.unpack_from(payload)
+    if code not in CODE_FORMATS:
+        raise ValueError(f"Unknown payload content code {code}")
+    return CODE_FORMATS[code], version
+
+
+def _decode_frame(document):
+    """Standard buffer document from a 'frame' payload"""
+    protocol = get_protocol(document.pop('protocol'))
+    ad_fields = document.pop('ad_fields', False)
+    frame = bytes(document.pop('frame'))
+    header = protocol.parse_header(frame)
+    if header is None or len(frame) != protocol.frame_length(header['n_mac']):
+        raise ValueError("Invalid UART frame in payload")
+    document.update({
+        'sequence': header['sequence'],
+        'n_adv_raw': header['n_adv_raw'],
+        'n_mac': header['n_mac'],
+    })
+    document['devices'] = protocol.decode_devices(frame).to_documents(ad_fields)
+    return document
+
+
+def decode_payload(payload):
+    """
+    Standard buffer document from a payload of any format
+
+    Timestamps come back as datetime and the _id as an ObjectId, ready to be
+    inserted into MongoDB.
+
+    Returns:
+        tuple: (format, document)
+    """
+    name, version = payload_format(payload)
+    if name == 'json':
+        document = json.loads(payload.decode() if isinstance(payload, bytes) else payload)
+        document['timestamp'] = datetime.fromisoformat(document['timestamp'])
+        if 'capture_timestamp' in document:
+            document['capture_timestamp'] = datetime.fromisoformat(document['capture_timestamp'])
+        if '_id' in document:
+            document['_id'] = ObjectId(document['_id'])
+        return name, document
+    if name == 'batch':
+        raise ValueError("Batch payload, decode it with mqtt_batch.decode_message")
+    if version != PAYLOAD_VERSION:
+        raise ValueError(f"Unsupported {name} payload version {version}")
+    document = bson.decode(payload[ENVELOPE.size:])
+    if name == 'bson':
+        return name, expand_document(document)
+    return name, _decode_frame(document)
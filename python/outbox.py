@@ -0,0 +1,197 @@
+"""Disk-backed outbox between publish.py and the MQTT client.
+
+paho keeps every QoS 1 message it cannot deliver in memory, without bound,
+and loses them when the process stops. With --outbox DIR the publisher
+appends each message to a Journal (journal.py: segmented append log with a
+persisted checkpoint) instead, and one drainer thread hands them to paho in
+order, at most `window` messages in flight. The checkpoint only moves once
+every message of a window has its PUBACK, so a disconnection or a restart
+resends from the first unacknowledged message; the subscriber drops the
+resulting duplicates by _id (dedup.py). Memory stays flat however long the
+broker is away, the backlog grows on disk.
+
+Records are {'payload': message, 'queued': time.time()}; metrics() reports
+the backlog depth and the age of its oldest message.
+"""
+import threading
+import time
+
+from journal import SEGMENT_BYTES, Journal
+
+OUTBOX_WINDOW = 20
+# Longest a window waits for its PUBACKs while connected before it is resent
+ACK_TIMEOUT = 30.0
+MAX_WINDOW_BYTES = 4 * 1024 * 1024
+
+
+def record_size(record):
+    """Bytes of a queued message, for Journal.read's max_bytes"""
+    return len(record['payload'])
+
+
+class MQTTOutbox:
+    """Journal-backed, ordered QoS 1 publishing with a bounded in-flight window"""
+
+    def __init__(self, client, topic, directory, window=OUTBOX_WINDOW, fsync='interval',
+                 segment_bytes=SEGMENT_BYTES, qos=1, ack_timeout=ACK_TIMEOUT,
+                 name='mqtt-outbox'):
+        """
+        Args:
+            client: paho MQTT client; the owner forwards its connect, disconnect
+                and publish callbacks to set_connected() and acked()
+            topic (str): Topic of every message
+            directory (str): Outbox journal directory
+            window (int): Most messages published and not yet acknowledged
+            fsync (str): Journal fsync policy (journal.FSYNC_POLICIES)
+            ack_timeout (float): Seconds connected without the window's PUBACKs
+                before it is published again
+        """
+        self.client = client
+        self.topic = topic
+        self.window = window
+        self.qos = qos
+        self.ack_timeout = ack_timeout
+        self.journal = Journal(directory, segment_bytes, fsync, size=record_size)
+        self.connected = False
+        self._acked = set()
+        self._cond = threading.Condition()
+        self._stopping = False
+        self._head_queued = None  # 'queued' of the oldest message not yet acknowledged
+        self._thread = threading.Thread(target=self._work, name=name, daemon=True)
+
+        # Metrics
+        self.published = 0
+        self.acknowledged = 0
+        self.resent = 0
+        self.windows = 0
+        self.max_window = 0
+        self.last_ack = None      # time.time() of the last acknowledged window
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def put(self, payload):
+        """Append a message to the outbox (never waits for the broker)"""
+        self.journal.append({'payload': payload, 'queued': time.time()})
+        with self._cond:
+            self._cond.notify_all()
+        return True
+
+    def set_connected(self, connected):
+        """Connection state, from the client's connect/disconnect callbacks"""
+        with self._cond:
+            self.connected = connected
+            self._cond.notify_all()
+
+    def acked(self, mid):
+        """PUBACK of message mid, from the client's publish callback"""
+        with self._cond:
+            self._acked.add(mid)
+            self._cond.notify_all()
+
+    def _wait(self, timeout):
+        with self._cond:
+            self._cond.wait(timeout)
+
+    def _peek_head(self):
+        """Queue time of the oldest pending message, read without consuming it"""
+        records = self.journal.read(1)
+        self.journal.rewind()
+        self._head_queued = records[0]['queued'] if records else None
+
+    def _work(self):
+        while True:
+            if not self.journal.pending:
+                self._head_queued = None
+                if self._stopping:
+                    return
+                self.journal.sync_due()
+                self._wait(self.journal.fsync_interval)
+                continue
+            if not self.connected:
+                if self._stopping:
+                    return  # Kept on disk for the next start
+                if self._head_queued is None:
+                    self._peek_head()
+                self._wait(1.0)
+                continue
+
+            records = self.journal.read(self.window, MAX_WINDOW_BYTES)
+            if not records:
+                self._wait(0.05)
+                continue
+            self._head_queued = records[0]['queued']
+            if self._send_window(records):
+                self.journal.commit(len(records))
+                self.acknowledged += len(records)
+                self.windows += 1
+                self.max_window = max(self.max_window, len(records))
+                self.last_ack = time.time()
+                self._head_queued = None
+            else:
+                self.journal.rewind()
+                self.resent += len(records)
+                if self._stopping and not self.connected:
+                    return
+
+    def _send_window(self, records):
+        """
+        Publish records and wait for all their PUBACKs
+
+        Returns:
+            bool: True once every message is acknowledged, False to resend
+            the window (ack timeout while connected, or stopping while away)
+        """
+        with self._cond:
+            self._acked.clear()
+        mids = []
+        for record in records:
+            mids.append(self.client.publish(self.topic, record['payload'], qos=self.qos).mid)
+            self.published += 1
+        waited = 0.0
+        with self._cond:
+            while not self._acked.issuperset(mids):
+                if not self.connected and self._stopping:
+                    return False
+                if waited >= self.ack_timeout:
+                    return False
+                start = time.monotonic()
+                self._cond.wait(1.0)
+                if self.connected:
+                    # paho resends in-flight messages itself after a reconnect,
+                    # only time spent connected counts
+                    waited += time.monotonic() - start
+        return True
+
+    def stop(self, timeout=5.0):
+        """
+        Let the drainer deliver the backlog for up to timeout seconds
+
+        Returns:
+            int: Messages left in the outbox for the next start
+        """
+        self._stopping = True
+        with self._cond:
+            self._cond.notify_all()
+        self._thread.join(timeout)
+        left = self.journal.pending
+        if not self._thread.is_alive():
+            self.journal.close()
+        return left
+
+    def metrics(self):
+        """Backlog depth and age plus delivery counters"""
+        metrics = self.journal.metrics()
+        head = self._head_queued
+        metrics.update({
+            'connected': self.connected,
+            'oldest_age_s': round(time.time() - head, 1) if head and metrics['pending'] else 0.0,
+            'published': self.published,
+            'acknowledged': self.acknowledged,
+            'resent': self.resent,
+            'windows': self.windows,
+            'max_window': self.max_window,
+            'last_ack_age_s': round(time.time() - self.last_ack, 1) if self.last_ack else None,
+        })
+        return metrics
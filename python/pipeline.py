@@ -0,0 +1,329 @@
+"""Reader/sink decoupling for the receivers.
+
+A reader thread decodes UART buffers into documents and puts them in a
+bounded BufferQueue; SinkPipeline workers drain it into storage, so a slow
+database no longer stalls serial reads. When the queue is full the overflow
+policy decides what happens:
+    block        the reader waits for room (no loss, UART may overflow)
+    drop-oldest  the oldest queued document is discarded
+    spill        new documents go to an append-only spill file and are
+                 stored, in order, once the sink catches up
+"""
+import os
+import pickle
+import struct
+import threading
+import time
+from collections import deque
+from batch_writer import DEFAULT_BATCH_BYTES, BatchWriter
+
+OVERFLOW_POLICIES = ('block', 'drop-oldest', 'spill')
+
+SPILL_RECORD = struct.Struct('<I')  # Length of each pickled spill record
+
+
+class SpillFile:
+    """FIFO of pickled items in an append-only file"""
+
+    def __init__(self, path):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.path = path
+        self._file = open(path, 'a+b')
+        self._read_pos = 0
+        self.depth = self._count()  # Items left by a previous run are kept
+
+    def _count(self):
+        """Count complete records, dropping a truncated tail"""
+        self._file.seek(0)
+        count = 0
+        pos = 0
+        while True:
+            prefix = self._file.read(SPILL_RECORD.size)
+            if len(prefix) < SPILL_RECORD.size:
+                break
+            (length,) = SPILL_RECORD.unpack(prefix)
+            if len(self._file.read(length)) < length:
+                break
+            count += 1
+            pos = self._file.tell()
+        self._file.truncate(pos)
+        return count
+
+    def append(self, item):
+        data = pickle.dumps(item, protocol=pickle.HIGHEST_PROTOCOL)
+        self._file.seek(0, os.SEEK_END)
+        self._file.write(SPILL_RECORD.pack(len(data)) + data)
+        self.depth += 1
+
+    def pop(self):
+        """Read the oldest item; the file is emptied once everything was read"""
+        self._file.flush()
+        self._file.seek(self._read_pos)
+        (length,) = SPILL_RECORD.unpack(self._file.read(SPILL_RECORD.size))
+        item = pickle.loads(self._file.read(length))
+        self._read_pos = self._file.tell()
+        self.depth -= 1
+        if not self.depth:
+            self._file.truncate(0)
+            self._read_pos = 0
+        return item
+
+    def close(self):
+        self._file.close()
+
+
+class BufferQueue:
+    """Bounded FIFO with an overflow policy and depth/lag metrics"""
+
+    def __init__(self, maxsize=1000, overflow='block', spill_path=None):
+        """
+        Args:
+            maxsize (int): Documents held in memory
+            overflow (str): One of OVERFLOW_POLICIES
+            spill_path (str): Spill file, required for overflow='spill'
+        """
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError(f"Unknown overflow policy: {overflow}")
+        if overflow == 'spill' and not spill_path:
+            raise ValueError("overflow='spill' needs a spill file")
+        self.maxsize = maxsize
+        self.overflow = overflow
+        self.spill = SpillFile(spill_path) if overflow == 'spill' else None
+        self._items = deque()  # (enqueue monotonic time, item)
+        self._lock = threading.Lock()
+        self._not_empty = threading.Condition(self._lock)
+        self._not_full = threading.Condition(self._lock)
+        self.closing = False
+
+        # Metrics
+        self.enqueued = 0
+        self.dequeued = 0
+        self.dropped = 0
+        self.spilled = 0
+        self.max_depth = 0
+        self.last_lag = 0.0
+        self.max_lag = 0.0
+
+    def __len__(self):
+        with self._lock:
+            return len(self._items) + (self.spill.depth if self.spill else 0)
+
+    def put(self, item, timeout=None):
+        """
+        Queue an item, applying the overflow policy when full
+
+        Returns:
+            bool: False if the block policy ran out of time (item not queued)
+        """
+        with self._lock:
+            if self.spill and (self.spill.depth or len(self._items) >= self.maxsize):
+                # Keep order: once spilling, everything goes through the file
+                self.spill.append((time.monotonic(), item))
+                self.spilled += 1
+                self.enqueued += 1
+                self._not_empty.notify()
+                return True
+            if len(self._items) >= self.maxsize:
+                if self.overflow == 'drop-oldest':
+                    self._items.popleft()
+                    self.dropped += 1
+                elif not self._not_full.wait_for(lambda: len(self._items) < self.maxsize, timeout):
+                    return False
+            self._items.append((time.monotonic(), item))
+            self.enqueued += 1
+            self.max_depth = max(self.max_depth, len(self._items))
+            self._not_empty.notify()
+            return True
+
+    def _pending(self):
+        return bool(self._items) or bool(self.spill and self.spill.depth)
+
+    def get_many(self, max_items=1, timeout=None):
+        """
+        Wait for at least one item and take up to max_items
+
+        Returns:
+            list: Items in queue order, empty if timeout expired
+        """
+        with self._lock:
+            self._not_empty.wait_for(lambda: self._pending() or self.closing, timeout)
+            if not self._pending():
+                return []
+            entries = []
+            while len(entries) < max_items and self._items:
+                entries.append(self._items.popleft())
+            while len(entries) < max_items and self.spill and self.spill.depth:
+                entries.append(self.spill.pop())
+            self._not_full.notify(len(entries))
+
+            now = time.monotonic()
+            self.last_lag = now - entries[0][0]
+            self.max_lag = max(self.max_lag, self.last_lag)
+            self.dequeued += len(entries)
+            return [item for _, item in entries]
+
+    def shutdown(self):
+        """Stop waiting in get_many once the queue is empty"""
+        with self._lock:
+            self.closing = True
+            self._not_empty.notify_all()
+
+    def drain_to_spill(self):
+        """Move items still in memory to the spill file (used on shutdown)"""
+        if not self.spill:
+            return 0
+        with self._lock:
+            # Memory items are older than anything spilled, rewrite in order
+            pending = list(self._items)
+            while self.spill.depth:
+                pending.append(self.spill.pop())
+            self._items.clear()
+            for entry in pending:
+                self.spill.append(entry)
+            return len(pending)
+
+    def metrics(self):
+        """Queue depth, throughput counters and lag in seconds"""
+        with self._lock:
+            oldest = self._items[0][0] if self._items else None
+            return {
+                'depth': len(self._items),
+                'maxsize': self.maxsize,
+                'max_depth': self.max_depth,
+                'spill_depth': self.spill.depth if self.spill else 0,
+                'enqueued': self.enqueued,
+                'dequeued': self.dequeued,
+                'dropped': self.dropped,
+                'spilled': self.spilled,
+                'last_lag_s': round(self.last_lag, 4),
+                'max_lag_s': round(self.max_lag, 4),
+                'oldest_age_s': round(time.monotonic() - oldest, 4) if oldest else 0.0,
+            }
+
+    def close(self):
+        if self.spill:
+            self.spill.close()
+
+
+class SinkPipeline:
+    """Worker threads that drain a BufferQueue into a store callable
+
+    Each worker batches documents in its own BatchWriter, so a store call
+    gets up to max_batch documents (or max_bytes) and a document waits at
+    most max_latency seconds for its batch to fill.
+    """
+
+    def __init__(self, store, maxsize=1000, overflow='block', workers=1,
+                 spill_path=None, max_batch=100, max_bytes=DEFAULT_BATCH_BYTES,
+                 max_latency=0.0, name='sink'):
+        """
+        Args:
+            store: Callable taking a list of documents, returns how many were stored
+            maxsize (int): Documents held in memory
+            overflow (str): One of OVERFLOW_POLICIES
+            workers (int): Number of sink threads (1 keeps insertion order)
+            spill_path (str): Spill file for overflow='spill'
+            max_batch (int): Most documents handed to one store call
+            max_bytes (int): Estimated size that triggers a store call
+            max_latency (float): Longest a document waits for its batch to
+                fill, 0 stores whatever the queue holds right away
+            name (str): Thread name prefix
+        """
+        self.store = store
+        self.queue = BufferQueue(maxsize, overflow, spill_path)
+        self.max_batch = max_batch
+        self.writers = [BatchWriter(store, max_batch, max_bytes, max_latency)
+                        for _ in range(workers)]
+        self._threads = [
+            threading.Thread(target=self._work, args=(writer,), name=f"{name}-{i}", daemon=True)
+            for i, writer in enumerate(self.writers)
+        ]
+
+    @property
+    def stored(self):
+        return sum(writer.stored for writer in self.writers)
+
+    @property
+    def failed(self):
+        return sum(writer.failed for writer in self.writers)
+
+    def start(self):
+        for thread in self._threads:
+            thread.start()
+        return self
+
+    def put(self, document, timeout=None):
+        return self.queue.put(document, timeout)
+
+    def _work(self, writer):
+        while True:
+            wait = writer.time_to_flush()
+            documents = self.queue.get_many(self.max_batch - len(writer),
+                                            timeout=1.0 if wait is None else wait)
+            writer.add_many(documents)
+            if not documents and self.queue.closing:
+                writer.flush('close')
+                return
+            writer.flush_due()
+
+    def stop(self, timeout=5.0):
+        """
+        Let the workers drain the queue for up to timeout seconds
+
+        Returns:
+            int: Documents left behind (kept in the spill file when there is one)
+        """
+        self.queue.shutdown()
+        deadline = time.monotonic() + timeout
+        for thread in self._threads:
+            thread.join(max(0.0, deadline - time.monotonic()))
+        left = len(self.queue) + sum(len(writer) for writer in self.writers)
+        self.queue.drain_to_spill()
+        self.queue.close()
+        return left
+
+    def metrics(self):
+        metrics = self.queue.metrics()
+        flushes = [writer.stats() for writer in self.writers]
+        n_flushes = sum(f['flushes'] for f in flushes)
+        metrics.update({
+            'stored': self.stored,
+            'failed': self.failed,
+            'flushes': n_flushes,
+            'avg_flush': round((self.stored + self.failed) / n_flushes, 1) if n_flushes else 0.0,
+            'max_flush': max(f['max_flush'] for f in flushes),
+            'avg_flush_ms': round(sum(w.total_flush_s for w in self.writers) / n_flushes * 1000, 2)
+                            if n_flushes else 0.0,
+            'max_flush_ms': max(f['max_flush_ms'] for f in flushes),
+        })
+        return metrics
+
+
+def run_reader(read_loop, stop, poll_interval=0.05, report=None, report_interval=30.0):
+    """
+    Run read_loop in a dedicated reader thread until it returns
+
+    The calling thread only waits, so Ctrl+C and signal handlers keep working
+    there. On KeyboardInterrupt stop() is called, the reader is joined and
+    the exception re-raised.
+
+    Args:
+        read_loop: Callable run by the reader thread
+        stop: Callable that makes read_loop return within poll_interval
+        report: Called every report_interval seconds while reading
+    """
+    reader = threading.Thread(target=read_loop, name='uart-reader', daemon=True)
+    reader.start()
+    next_report = time.monotonic() + report_interval
+    try:
+        while reader.is_alive():
+            reader.join(poll_interval)
+            if report and time.monotonic() >= next_report:
+                report()
+                next_report += report_interval
+    except KeyboardInterrupt:
+        stop()
+        reader.join()
+        raise
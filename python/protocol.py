@@ -0,0 +1,214 @@
+import re
+import struct
+import numpy as np
+from device_batch import DEVICE_DTYPE, decode_devices
+
+HEADER_MAGIC = b'\x55\x55\x55\x55'
+
+# Bits of the integer struct codes used in headers
+_FIELD_BITS = {'B': 8, 'H': 16, 'I': 32, 'i': 32}
+
+# Layout used when none is given
+DEFAULT_PROTOCOL = 'v2'
+
+
+class Protocol:
+    """One UART wire layout: precompiled header struct plus device dtype"""
+
+    def __init__(self, name, description, header_format, header_fields,
+                 device_dtype, max_devices):
+        """
+        Args:
+            name (str): Registry key
+            description (str): Where the layout is used
+            header_format (str): struct format, first field is the 4-byte magic
+            header_fields (tuple): Names of the header fields after the magic
+            device_dtype (np.dtype): Structured layout of one device record
+            max_devices (int): Largest n_mac the layout can carry
+        """
+        self.name = name
+        self.description = description
+        self.header_struct = struct.Struct(header_format)
+        self.header_fields = header_fields
+        self.device_dtype = device_dtype
+        self.max_devices = max_devices
+        self.header_length = self.header_struct.size
+        self.device_length = device_dtype.itemsize
+        self._header_codes = re.findall(r'\d*[a-zA-Z]', header_format)[1:]
+
+    def __repr__(self):
+        return (f"Protocol({self.name!r}, header={self.header_length}, "
+                f"device={self.device_length})")
+
+    def parse_header(self, data):
+        """
+        Parse a buffer header
+
+        Returns:
+            dict: Header fields (always including 'n_mac'), or None if the
+            data is too short or does not start with the magic
+        """
+        if len(data) < self.header_length:
+            return None
+        values = self.header_struct.unpack_from(data)
+        if values[0] != HEADER_MAGIC:
+            return None
+        return dict(zip(self.header_fields, values[1:]))
+
+    def encode_frame(self, header, records):
+        """
+        Build a frame as the scanner sends it
+
+        Args:
+            header (dict): Header fields; integers wrap like the firmware counters
+            records (np.ndarray): Device records with this layout's device_dtype
+
+        Returns:
+            bytes: Magic, header and device records
+        """
+        values = []
+        for field, code in zip(self.header_fields, self._header_codes):
+            bits = _FIELD_BITS[code]
+            value = int(header.get(field, 0)) % (1 << bits)
+            if code.islower() and value >= 1 << (bits - 1):
+                value -= 1 << bits
+            values.append(value)
+        return self.header_struct.pack(HEADER_MAGIC, *values) + records.tobytes()
+
+    def field_bits(self, field):
+        """Width in bits of an integer header field (e.g. 8 for a uint8 sequence)"""
+        return _FIELD_BITS[self._header_codes[self.header_fields.index(field)]]
+
+    def frame_length(self, n_mac):
+        """Total bytes of a frame carrying n_mac devices"""
+        return self.header_length + n_mac * self.device_length
+
+    def parse_device(self, data):
+        """Decode a single device record into a DeviceRecord"""
+        return decode_devices(data, 1, self.device_dtype)[0]
+
+    def decode_devices(self, frame):
+        """Decode the device records of a complete frame into a DeviceBatch"""
+        n_mac = (len(frame) - self.header_length) // self.device_length
+        return decode_devices(frame[self.header_length:], n_mac, self.device_dtype)
+
+
+PROTOCOLS = {}
+
+
+def register_protocol(protocol):
+    """Add a layout to the registry"""
+    PROTOCOLS[protocol.name] = protocol
+    return protocol
+
+
+def get_protocol(name):
+    """
+    Look up a layout by name
+
+    Returns:
+        Protocol: The registered layout, or None for 'auto' (detect from stream)
+    """
+    if name == 'chunked':
+        # CRC-checked chunks (src/chunk_protocol.c) carry firmware device records
+        return PROTOCOLS['v3']
+    if name is None or name == 'auto':
+        return None
+    if isinstance(name, Protocol):
+        return name
+    try:
+        return PROTOCOLS[name]
+    except KeyError:
+        raise ValueError(f"Unknown protocol '{name}', expected one of: "
+                         f"{', '.join(PROTOCOLS)} or auto")
+
+
+def protocol_choices():
+    """Values accepted by the --protocol options of the receivers"""
+    return list(PROTOCOLS) + ['auto', 'chunked']
+
+
+def _chain_length(protocol, data, start, limit):
+    """Count consecutive frames from start whose length lands on the next magic"""
+    count = 0
+    pos = start
+    while count < limit:
+        header = protocol.parse_header(data[pos:pos + protocol.header_length])
+        if not header or header['n_mac'] > protocol.max_devices:
+            break
+        pos += protocol.frame_length(header['n_mac'])
+        if data[pos:pos + len(HEADER_MAGIC)] != HEADER_MAGIC:
+            break
+        count += 1
+    return count
+
+
+def detect_protocol(data, candidates=None, min_frames=3, max_starts=16):
+    """
+    Detect the active layout from raw stream bytes
+
+    A layout matches when min_frames consecutive frames, sized from their own
+    headers, each end exactly where the next magic starts.
+
+    Args:
+        data: Raw bytes containing at least min_frames + 1 magics
+        candidates: Protocols to test (default: all registered)
+        min_frames (int): Consecutive consistent frames required
+        max_starts (int): Magic positions tried as chain start
+
+    Returns:
+        Protocol: Matching layout, or None if no layout (or more than one) fits
+    """
+    data = bytes(data)
+    candidates = list(candidates or PROTOCOLS.values())
+
+    starts = []
+    pos = data.find(HEADER_MAGIC)
+    while pos >= 0 and len(starts) < max_starts:
+        starts.append(pos)
+        pos = data.find(HEADER_MAGIC, pos + 1)
+
+    matches = []
+    for protocol in candidates:
+        if any(_chain_length(protocol, data, start, min_frames) >= min_frames
+               for start in starts):
+            matches.append(protocol)
+    return matches[0] if len(matches) == 1 else None
+
+
+# Original tracker layout (gps_ble_tracker.py): uint8 n_mac
+register_protocol(Protocol(
+    'v1', 'gps_ble_tracker: 8-byte header, 42-byte devices',
+    '<4sBHB', ('sequence', 'n_adv_raw', 'n_mac'),
+    DEVICE_DTYPE, max_devices=255,
+))
+
+# uart.py layout: uint16 n_mac for up to 1024 devices
+register_protocol(Protocol(
+    'v2', 'uart.py: 9-byte header with uint16 n_mac, 42-byte devices',
+    '<4sBHH', ('sequence', 'n_adv_raw', 'n_mac'),
+    DEVICE_DTYPE, max_devices=1024,  # MAX_DEVICES in main.c
+))
+
+# Firmware structs (ble_scanner.h): header timestamp and per-device last_seen
+register_protocol(Protocol(
+    'v3', 'firmware buffer_header/device_data: 12-byte header, 46-byte devices',
+    '<4sBHBi', ('sequence', 'n_adv_raw', 'n_mac', 'timestamp'),
+    np.dtype(DEVICE_DTYPE.descr + [('last_seen', '<i4')]), max_devices=255,
+))
+
+# publish.py layout: uint16 sequence, 16 bytes of data and uint16 n_adv
+register_protocol(Protocol(
+    'compact', 'publish.py: 8-byte header, 32-byte devices with 16 data bytes',
+    '<4sHBB', ('sequence', 'n_adv_raw', 'n_mac'),
+    np.dtype([
+        ('mac', 'u1', (6,)),
+        ('addr_type', 'u1'),
+        ('adv_type', 'u1'),
+        ('rssi', 'i1'),
+        ('data_len', 'u1'),
+        ('data', 'u1', (16,)),
+        ('n_adv', '<u2'),
+        ('reserved', 'V4'),
+    ]), max_devices=255,
+))
@@ -2,35 +2,73 @@ import serial
 from datetime import datetime
 import time
 import argparse
-import json
 import paho.mqtt.client as mqtt
 from uart import UARTReceiver
+from dedup import BufferIds, capture_sessions
+from mqtt_payload import CONTENT_TYPES, PAYLOAD_FORMATS, encode_payload
+from mqtt_batch import COMPRESSIONS, check_compression, dictionary_id, encode_batch, load_dictionary
+from batch_writer import BatchWriter
+from journal import FSYNC_POLICIES
+from outbox import OUTBOX_WINDOW, MQTTOutbox
+from capture import EndOfCapture, open_port
+from protocol import protocol_choices
 import logging
 import os
 from enum import Enum
 import signal
 import sys
 
+# Payload bytes of a batch message; small enough for slow cellular uplinks
+MQTT_BATCH_BYTES = 256 * 1024
+# Seconds between outbox backlog reports
+OUTBOX_REPORT_INTERVAL = 30.0
+
 class LogLevel(str, Enum):
     INFO = "info"
     DEBUG = "debug"
 
 class UARTMQTTPublisher(UARTReceiver):
-    # UART Protocol Constants
-    HEADER_MAGIC = b'\x55\x55\x55\x55'
-    HEADER_LENGTH = 8
-    DEVICE_LENGTH = 32
-
     def __init__(self, port='COM3', baudrate=115200,
                  mqtt_broker="localhost", mqtt_port=1883,
                  mqtt_topic="admin/reader", mqtt_username=None, mqtt_password=None,
-                 log_level="info"):
-        """Initialize UART receiver with MQTT publisher"""
+                 log_level="info", protocol="compact", capture=None, payload_format="json",
+                 batch_size=1, batch_bytes=MQTT_BATCH_BYTES, batch_latency=5.0,
+                 compression="none", dictionary=None, outbox=None,
+                 outbox_window=OUTBOX_WINDOW, outbox_fsync="interval", ad_fields=False,
+                 mqtt_client=None):
+        """
+        Initialize UART receiver with MQTT publisher
+
+        Args:
+            payload_format (str): 'json', 'bson' or 'frame' (see mqtt_payload.py)
+            batch_size (int): Buffers per MQTT message (1 publishes each buffer
+                on its own unless compression is on, see mqtt_batch.py)
+            batch_bytes (int): Payload bytes that trigger a batch message
+            batch_latency (float): Longest a buffer waits for its batch, in seconds
+            compression (str): 'none', 'zlib' or 'zstd'
+            dictionary (str): Preset compression dictionary file (mqtt_batch.py)
+            outbox (str): Directory of the disk outbox between the publisher and
+                the broker (see outbox.py), None to hand messages to paho directly
+            outbox_window (int): Outbox messages in flight without a PUBACK
+            outbox_fsync (str): 'always', 'interval' or 'never'
+            ad_fields (bool): Add the decoded advertising data fields to every
+                device (ad_decoder.py)
+            mqtt_client: paho client to use instead of creating one
+        """
+        if payload_format not in PAYLOAD_FORMATS:
+            raise ValueError(f"Unknown payload format: {payload_format}")
+        check_compression(compression)
         # Store port and baudrate as instance variables
         self.port = port
         self.baudrate = baudrate
         self.running = True
         self.mqtt_topic = mqtt_topic
+        self.payload_format = payload_format
+        self.ad_fields = ad_fields
+        self.compression = compression
+        self.dictionary = load_dictionary(dictionary)
+        self.batcher = None
+        self.outbox = None
         
         # Add signal handlers
         signal.signal(signal.SIGTERM, self.signal_handler)
@@ -44,14 +82,29 @@ class UARTMQTTPublisher(UARTReceiver):
         # Check for crash recovery
         self._check_crash_recovery()
         
-        self.logger.info("Starting UART MQTT Publisher")
+        self.logger.info(f"Starting UART MQTT Publisher ({CONTENT_TYPES[payload_format]} payloads)")
         
         # Call parent class initialization
-        super().__init__(port, baudrate)
+        super().__init__(port, baudrate, protocol=protocol, capture=capture)
+        # Part of the ids of layouts without a firmware timestamp, whose
+        # buffer_index starts over when the publisher restarts
+        self.buffer_ids = BufferIds(int(time.time() * 1000), capture_sessions(self.ports()))
         
+        # Coalesce buffers into batch messages, flushed by count, size or age
+        if batch_size > 1 or compression != 'none':
+            self.batcher = BatchWriter(self._publish_batch, max_count=batch_size,
+                                       max_bytes=batch_bytes, max_latency=batch_latency,
+                                       size=lambda item: len(item[0]), name='mqtt-batcher').start()
+            self.logger.info(
+                f"Batching up to {batch_size} buffers / {batch_bytes} B / {batch_latency}s per message, "
+                f"compression: {compression}"
+                + (f" (dictionary {dictionary_id(self.dictionary):08x})" if self.dictionary else "")
+            )
+
         # Setup MQTT Client
         try:
-            self.mqtt_client = mqtt.Client(callback_api_version=mqtt.CallbackAPIVersion.VERSION2)
+            self.mqtt_client = mqtt_client or mqtt.Client(
+                callback_api_version=mqtt.CallbackAPIVersion.VERSION2)
             
             # Set username and password if provided
             if mqtt_username:
@@ -62,8 +115,19 @@ class UARTMQTTPublisher(UARTReceiver):
             self.mqtt_client.on_disconnect = self.on_mqtt_disconnect
             self.mqtt_client.on_publish = self.on_mqtt_publish
             
+            if outbox:
+                self.outbox = MQTTOutbox(self.mqtt_client, self.mqtt_topic, outbox,
+                                         window=outbox_window, fsync=outbox_fsync).start()
+                self.mqtt_client.max_inflight_messages_set(outbox_window)
+                self.logger.info(f"Outbox in {outbox}: {self.outbox.journal.pending} messages "
+                                 f"pending from previous runs")
+            
             self.logger.info(f"Connecting to MQTT broker at {mqtt_broker}:{mqtt_port}")
-            self.mqtt_client.connect(mqtt_broker, mqtt_port, 60)
+            if self.outbox:
+                # Start offline if needed, the outbox keeps the messages meanwhile
+                self.mqtt_client.connect_async(mqtt_broker, mqtt_port, 60)
+            else:
+                self.mqtt_client.connect(mqtt_broker, mqtt_port, 60)
             self.mqtt_client.loop_start()
             self.logger.info("MQTT client setup complete")
         except Exception as e:
@@ -120,12 +184,17 @@ class UARTMQTTPublisher(UARTReceiver):
         """Callback for when the client receives a CONNACK response from the server"""
         if reason_code == 0:
             self.logger.info("Connected to MQTT Broker successfully")
+            if self.outbox:
+                self.outbox.set_connected(True)
         else:
             self.logger.error(f"Failed to connect to MQTT Broker with code: {reason_code}")
 
     def on_mqtt_disconnect(self, client, userdata, disconnect_flags, reason_code, properties):
         """Callback for when the client disconnects from the server"""
         self.logger.warning(f"Disconnected from MQTT Broker with reason code: {reason_code}")
+        if self.outbox:
+            self.outbox.set_connected(False)
+            self.logger.info(f"Outbox keeps {self.outbox.journal.pending} messages until reconnection")
         if reason_code != 0:
             self.logger.warning("Unexpected disconnection. Attempting to reconnect...")
 
@@ -133,45 +202,80 @@ class UARTMQTTPublisher(UARTReceiver):
         """Callback for when a message is published"""
         if reason_code == 0:
             self.logger.debug(f"Message {mid} published successfully")
+            if self.outbox:
+                self.outbox.acked(mid)
         else:
             self.logger.warning(f"Message {mid} failed to publish with reason code: {reason_code}")
 
     def _publish_buffer(self, header, devices):
         """Publish the buffer to MQTT topic"""
         try:
-            document = {
-                'timestamp': datetime.now().isoformat(),
+            timestamp = datetime.now()
+            fields = {
+                # Deterministic id: QoS 1 redeliveries are dropped by the subscriber
+                '_id': self.buffer_ids(self.scanner_id, header),
+                'timestamp': timestamp,
                 'sequence': header['sequence'],
                 'n_adv_raw': header['n_adv_raw'],
                 'n_mac': header['n_mac'],
-                'devices': []
+                **self._sequence_fields(header),
+                **self._capture_fields(header),
             }
-
-            for device in devices:
-                device_doc = {
-                    'mac': device['mac'],
-                    'addr_type': device['addr_type'],
-                    'adv_type': device['adv_type'],
-                    'rssi': device['rssi'],
-                    'data_len': device['data_len'],
-                    'data': device['data'].hex(),
-                    'n_adv': device['n_adv']
-                }
-                document['devices'].append(device_doc)
             
             # Publish to MQTT
-            message = json.dumps(document)
-            result = self.mqtt_client.publish(self.mqtt_topic, message, qos=1)
-            if result.rc == mqtt.MQTT_ERR_SUCCESS:
+            message = encode_payload(self.payload_format, fields, header, devices, self.protocol,
+                                     self.ad_fields)
+            if self.batcher is not None:
+                self.batcher.add((message, header.get('epoch'), header.get('buffer_index', -1)))
+                return True
+            if self._send(message):
                 self.logger.debug(f"Buffer queued for publishing - Sequence: {header['sequence']}, MACs: {len(devices)}")
                 return True
-            else:
-                self.logger.error(f"Error queuing message for publish: {result.rc}")
-                return False
+            return False
         except Exception as e:
             self.logger.error(f"Error publishing to MQTT: {e}")
             return False
 
+    def _send(self, message):
+        """Hand a message to the outbox, or to paho without one"""
+        if self.outbox:
+            return self.outbox.put(message)
+        result = self.mqtt_client.publish(self.mqtt_topic, message, qos=1)
+        if result.rc != mqtt.MQTT_ERR_SUCCESS:
+            self.logger.error(f"Error queuing message for publish: {result.rc}")
+            return False
+        return True
+
+    def _log_outbox(self):
+        """Log the outbox backlog depth and age"""
+        m = self.outbox.metrics()
+        self.logger.info(
+            f"Outbox - {'connected' if m['connected'] else 'disconnected'}, "
+            f"pending: {m['pending']} in {m['segments']} segments, "
+            f"oldest: {m['oldest_age_s']}s, acknowledged: {m['acknowledged']}, "
+            f"resent: {m['resent']}, corrupt: {m['corrupt']}"
+        )
+
+    def _publish_batch(self, items):
+        """Publish (payload, epoch, buffer_index) items as batch messages, one per
+        epoch run so each message has a single sequence range"""
+        published = 0
+        start = 0
+        while start < len(items):
+            end = start + 1
+            while end < len(items) and items[end][1] == items[start][1]:
+                end += 1
+            run = items[start:end]
+            message = encode_batch([payload for payload, _, _ in run], self.compression,
+                                   self.dictionary, epoch=run[0][1],
+                                   first=run[0][2], last=run[-1][2])
+            if self._send(message):
+                self.logger.debug(f"Batch queued for publishing - Buffers {run[0][2]}-{run[-1][2]}, "
+                                  f"{len(message)} B")
+                published += len(run)
+            start = end
+        return published
+
     def _reset_serial(self):
         """Reset and reopen serial port"""
         try:
@@ -179,11 +283,7 @@ class UARTMQTTPublisher(UARTReceiver):
                 self.serial.close()
             
             self.logger.info(f"Attempting to reopen serial port {self.port}")
-            self.serial = serial.Serial(
-                port=self.port,
-                baudrate=self.baudrate,
-                timeout=1.0
-            )
+            self.serial = open_port(self.port, self.baudrate, timeout=self.POLL_INTERVAL)
             self.serial.reset_input_buffer()
             self.serial.reset_output_buffer()
             self.logger.info("Serial port reopened successfully")
@@ -194,67 +294,62 @@ class UARTMQTTPublisher(UARTReceiver):
 
     def signal_handler(self, signum, frame):
         """Signal handler for clean shutdown"""
-        self.running = False
+        self.stop()
         self.logger.info("Termination signal received")
         
     def receive_messages(self, duration=None):
         """Receive and publish buffers for a specific duration"""
-        start_time = time.time()
+        deadline = time.monotonic() + duration if duration else None
         processed_buffers = 0
         error_count = 0
         MAX_ERRORS = 3
         RETRY_DELAY = 7
+        next_report = time.monotonic() + OUTBOX_REPORT_INTERVAL
         
         self.logger.info("Starting buffer reception...")
         
         while self.running:
             try:
-                if duration and (time.time() - start_time) >= duration:
+                if self.outbox and time.monotonic() >= next_report:
+                    self._log_outbox()
+                    next_report += OUTBOX_REPORT_INTERVAL
+                if deadline and time.monotonic() >= deadline:
                     self.logger.info(f"Execution time ({duration}s) completed")
                     self.logger.info(f"Total buffers processed: {processed_buffers}")
                     break
 
-                # Read with timeout
-                byte = self.serial.read()
-                if not byte:  # Timeout occurred
+                # Read the next complete buffer (None after at most POLL_INTERVAL)
+                frame = self._read_frame(self._time_left(deadline))
+                if self.last_discarded:
+                    self.logger.debug(f"Resync: discarded {self.last_discarded} bytes")
+                if frame is None:
+                    self._on_idle()
                     continue
+                header, data = frame
+                self.logger.debug("UART header found")
+                error_count = 0  # Reset error count on successful read
 
-                if byte == b'\x55':
-                    potential_header = b'\x55' + self.serial.read(3)
-                    if potential_header == self.HEADER_MAGIC:
-                        self.logger.debug("UART header found")
-                        error_count = 0  # Reset error count on successful read
-                    else:
-                        continue
-
-                    header_data = potential_header + self.serial.read(self.HEADER_LENGTH - 4)
-                    header = self._parse_header(header_data)
-                    
-                    if not header:
-                        self.logger.warning("Error parsing header")
-                        continue
+                devices = self._parse_devices(data)
+                self.logger.debug(f"{len(devices)} devices parsed")
+                self._track_sequence(header, devices)
+                if header['lost']:
+                    self.logger.warning(f"{header['lost']} buffers lost before sequence {header['sequence']}")
+                if header['reboot']:
+                    self.logger.warning(f"Scanner reboot detected (epoch {header['epoch']})")
 
-                    devices = []
-                    for i in range(header['n_mac']):
-                        device_data = self.serial.read(self.DEVICE_LENGTH)
-                        if not device_data or len(device_data) != self.DEVICE_LENGTH:
-                            self.logger.warning(f"Incomplete device data received")
-                            break
-                        device = self._parse_device(device_data)
-                        if device:
-                            devices.append(device)
-                            self.logger.debug(f"Device {i+1} parsed - MAC: {device['mac']}")
-
-                    if devices:
-                        if self._publish_buffer(header, devices):
-                            processed_buffers += 1
-                            self.logger.debug(
-                                f"Buffer #{processed_buffers} processed - "
-                                f"Sequence: {header['sequence']}, "
-                                f"Devices: {len(devices)}, "
-                                f"N_ADV_RAW: {header['n_adv_raw']}"
-                            )
+                if devices:
+                    if self._publish_buffer(header, devices):
+                        processed_buffers += 1
+                        self.logger.debug(
+                            f"Buffer #{processed_buffers} processed - "
+                            f"Sequence: {header['sequence']}, "
+                            f"Devices: {len(devices)}, "
+                            f"N_ADV_RAW: {header['n_adv_raw']}"
+                        )
 
+            except EndOfCapture:
+                self.logger.info("End of capture reached")
+                break
             except serial.SerialException as e:
                 error_count += 1
                 self.logger.error(f"Serial communication error: {e}")
@@ -264,7 +359,7 @@ class UARTMQTTPublisher(UARTReceiver):
                         self.logger.error("Failed to recover serial connection. Exiting.")
                         break
                     error_count = 0
-                time.sleep(RETRY_DELAY)
+                self._wait(RETRY_DELAY)
             except KeyboardInterrupt:
                 self.logger.info("Reception interrupted by user")
                 break
@@ -274,10 +369,14 @@ class UARTMQTTPublisher(UARTReceiver):
                 if error_count >= MAX_ERRORS:
                     self.logger.error(f"Too many errors ({error_count}). Exiting.")
                     break
-                time.sleep(RETRY_DELAY)
+                self._wait(RETRY_DELAY)
                 continue
 
         self.logger.info(f"Total buffers processed: {processed_buffers}")
+        if self.sequence_tracker:
+            self.logger.info(f"Sequence stats: {self.sequence_stats()}")
+        if self.clock:
+            self.logger.info(f"Clock fit: {self.clock_stats()}")
         self.logger.info(f"Script finished: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
 
     def close(self):
@@ -287,6 +386,14 @@ class UARTMQTTPublisher(UARTReceiver):
             self.logger.info("Serial port closed")
             
             try:
+                if self.batcher is not None:
+                    self.batcher.close()  # Publish the last partial batch
+                    self.logger.info(f"Batch stats: {self.batcher.stats()}")
+                if self.outbox:
+                    left = self.outbox.stop()
+                    self._log_outbox()
+                    if left:
+                        self.logger.warning(f"{left} messages stay in the outbox for the next start")
                 self.mqtt_client.loop_stop()
                 self.mqtt_client.disconnect()
                 self.logger.info("MQTT connection closed")
@@ -297,52 +404,6 @@ class UARTMQTTPublisher(UARTReceiver):
         except Exception as e:
             self.logger.error(f"Error closing connections: {e}")
 
-    def _parse_header(self, data):
-        """Parse UART header data"""
-        try:
-            if len(data) != self.HEADER_LENGTH:
-                return None
-            
-            sequence = int.from_bytes(data[4:6], byteorder='little')
-            n_adv_raw = int.from_bytes(data[6:7], byteorder='little')
-            n_mac = int.from_bytes(data[7:8], byteorder='little')
-            
-            return {
-                'sequence': sequence,
-                'n_adv_raw': n_adv_raw,
-                'n_mac': n_mac
-            }
-        except Exception as e:
-            self.logger.error(f"Error parsing header: {e}")
-            return None
-
-    def _parse_device(self, data):
-        """Parse device data from UART"""
-        try:
-            if len(data) != self.DEVICE_LENGTH:
-                return None
-            
-            mac = ':'.join([f"{b:02X}" for b in data[0:6]])
-            addr_type = int.from_bytes(data[6:7], byteorder='little')
-            adv_type = int.from_bytes(data[7:8], byteorder='little')
-            rssi = int.from_bytes(data[8:9], byteorder='little', signed=True)
-            data_len = int.from_bytes(data[9:10], byteorder='little')
-            adv_data = data[10:26]  # 16 bytes of data
-            n_adv = int.from_bytes(data[26:28], byteorder='little')
-            
-            return {
-                'mac': mac,
-                'addr_type': addr_type,
-                'adv_type': adv_type,
-                'rssi': rssi,
-                'data_len': data_len,
-                'data': adv_data,
-                'n_adv': n_adv
-            }
-        except Exception as e:
-            self.logger.error(f"Error parsing device data: {e}")
-            return None
-
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='BLE Scanner UART MQTT Publisher')
     parser.add_argument('--port', type=str, default='/dev/ttyUSB0',
@@ -366,6 +427,37 @@ if __name__ == "__main__":
                       choices=['info', 'debug'],
                       default='info',
                       help='Logging level (default: info)')
+    parser.add_argument('--protocol', type=str,
+                      choices=protocol_choices(),
+                      default='compact',
+                      help='UART frame layout (default: compact)')
+    parser.add_argument('--capture', type=str,
+                      help='Append received UART bytes to this capture file')
+    parser.add_argument('--payload', type=str,
+                      choices=PAYLOAD_FORMATS,
+                      default='json',
+                      help='MQTT payload: json, bson (compact binary document) or '
+                           'frame (raw UART frame) (default: json)')
+    parser.add_argument('--mqtt-batch-size', type=int, default=1,
+                      help='Buffers coalesced per MQTT message (default: 1, no batching)')
+    parser.add_argument('--mqtt-batch-bytes', type=int, default=MQTT_BATCH_BYTES,
+                      help=f'Payload bytes that trigger a batch message (default: {MQTT_BATCH_BYTES})')
+    parser.add_argument('--mqtt-batch-latency', type=float, default=5.0,
+                      help='Max seconds a buffer waits for its batch (default: 5.0)')
+    parser.add_argument('--compress', type=str, choices=COMPRESSIONS, default='none',
+                      help='Batch message compression (default: none)')
+    parser.add_argument('--dictionary', type=str,
+                      help='Preset compression dictionary (python mqtt_batch.py ... --output FILE)')
+    parser.add_argument('--outbox', type=str,
+                      help='Directory of a disk outbox that keeps messages while the broker '
+                           'is unreachable and across restarts')
+    parser.add_argument('--outbox-window', type=int, default=OUTBOX_WINDOW,
+                      help=f'Outbox messages in flight without a PUBACK (default: {OUTBOX_WINDOW})')
+    parser.add_argument('--outbox-fsync', type=str, choices=FSYNC_POLICIES, default='interval',
+                      help='Outbox fsync policy (default: interval)')
+    parser.add_argument('--ad-fields', action='store_true',
+                      help='Add the decoded advertising data fields (local_name, company_id, '
+                           'service_uuids, tx_power, ...) to every device')
     
     args = parser.parse_args()
     
@@ -377,7 +469,19 @@ if __name__ == "__main__":
             mqtt_topic=args.mqtt_topic,
             mqtt_username=args.mqtt_username,
             mqtt_password=args.mqtt_password,
-            log_level=args.log_level
+            log_level=args.log_level,
+            protocol=args.protocol,
+            capture=args.capture,
+            payload_format=args.payload,
+            batch_size=args.mqtt_batch_size,
+            batch_bytes=args.mqtt_batch_bytes,
+            batch_latency=args.mqtt_batch_latency,
+            compression=args.compress,
+            dictionary=args.dictionary,
+            outbox=args.outbox,
+            outbox_window=args.outbox_window,
+            outbox_fsync=args.outbox_fsync,
+            ad_fields=args.ad_fields
         )
         publisher.logger.info("Starting capture %s", 
                           "indefinitely" if not args.duration else f"for {args.duration} seconds")
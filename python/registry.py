@@ -0,0 +1,194 @@
+"""Per-MAC device registry maintained at ingest.
+
+With --device-registry the receivers keep one document per MAC in the
+'devices' collection of their database:
+    {'_id': mac, 'first_seen', 'last_seen', 'observations', 'n_adv',
+     'rssi_min', 'rssi_max', 'rssi_ewma', 'last_position', 'last_payload_hash'}
+so "devices seen today" is an indexed query instead of an $unwind of every
+buffer. Each stored batch is coalesced per MAC in memory and written with
+one unordered bulk_write of UpdateOne(upsert=True). The updates are
+aggregation pipelines, so the EWMA can continue from the stored value:
+for k new samples, ewma = ewma * (1 - alpha)^k + sum(alpha * (1 - alpha)^(k-i) * rssi_i).
+
+    python registry.py --db tracking_data --hours 24
+"""
+import argparse
+import hashlib
+from datetime import datetime, timedelta
+
+from pymongo import ASCENDING, DESCENDING, MongoClient, UpdateOne
+
+from device_batch import format_mac
+from encoding import DEVICE_FIELDS, DEVICES_FIELD, is_compact
+from indexes import ensure_indexes, geo_point
+
+REGISTRY_COLLECTION = 'devices'
+# Weight of the newest RSSI sample in rssi_ewma
+RSSI_EWMA_ALPHA = 0.2
+REGISTRY_INDEXES = {
+    'last_seen': ([('last_seen', DESCENDING)], {}),
+    'first_seen': ([('first_seen', ASCENDING)], {}),
+}
+
+
+def payload_hash(payload):
+    """Short hash of the advertising data, to spot payload changes"""
+    return hashlib.blake2b(payload, digest_size=8).hexdigest()
+
+
+def _sightings(document):
+    """(mac, rssi, n_adv, payload) of every device, standard or compact encoding"""
+    if is_compact(document):
+        fields = [DEVICE_FIELDS[name] for name in ('mac', 'rssi', 'n_adv', 'data')]
+        return [(format_mac(device[fields[0]]), device.get(fields[1]), device.get(fields[2], 0),
+                 bytes(device.get(fields[3], b'')))
+                for device in document.get(DEVICES_FIELD, ())]
+    return [(device['mac'], device.get('rssi'), device.get('n_adv', 0),
+             bytes.fromhex(device.get('data', ''))[:device.get('data_len', 31)])
+            for device in document.get('devices', ())]
+
+
+class _Entry:
+    """Sightings of one MAC within a batch"""
+
+    __slots__ = ('first', 'last', 'count', 'n_adv', 'rssi_min', 'rssi_max',
+                 'samples', 'ewma', 'decay', 'initial', 'position', 'payload')
+
+    def __init__(self, time):
+        self.first = self.last = time
+        self.count = self.n_adv = 0
+        self.rssi_min = self.rssi_max = None
+        self.samples = 0
+        self.ewma = 0.0    # EWMA contribution of the batch's samples
+        self.decay = 1.0   # (1 - alpha)^samples, applied to the stored EWMA
+        self.initial = None  # EWMA of the batch alone, for devices not stored yet
+        self.position = None
+        self.payload = None
+
+    def add(self, time, rssi, n_adv, position, payload, alpha):
+        self.first = min(self.first, time)
+        self.count += 1
+        self.n_adv += n_adv or 0
+        if time >= self.last:
+            self.last = time
+            self.position = position or self.position
+            self.payload = payload
+        if rssi is not None:
+            self.rssi_min = rssi if self.rssi_min is None else min(self.rssi_min, rssi)
+            self.rssi_max = rssi if self.rssi_max is None else max(self.rssi_max, rssi)
+            self.ewma = self.ewma * (1 - alpha) + alpha * rssi
+            self.decay *= 1 - alpha
+            self.initial = rssi if self.samples == 0 else self.initial * (1 - alpha) + alpha * rssi
+            self.samples += 1
+
+
+def coalesce(documents, alpha=RSSI_EWMA_ALPHA):
+    """
+    Fold buffer documents into one entry per MAC
+
+    Returns:
+        dict: mac -> _Entry
+    """
+    entries = {}
+    for document in sorted(documents, key=lambda d: d.get('capture_timestamp') or d['timestamp']):
+        time = document.get('capture_timestamp') or document['timestamp']
+        position = document.get('location') or geo_point(document.get('gps_data'))
+        for mac, rssi, n_adv, payload in _sightings(document):
+            entry = entries.get(mac)
+            if entry is None:
+                entry = entries[mac] = _Entry(time)
+            entry.add(time, rssi, n_adv, position, payload, alpha)
+    return entries
+
+
+def registry_update(mac, entry):
+    """Pipeline upsert merging one coalesced entry into the MAC's document"""
+    newer = {'$gte': [entry.last, {'$ifNull': ['$last_seen', entry.last]}]}
+    fields = {
+        'first_seen': {'$min': [{'$ifNull': ['$first_seen', entry.first]}, entry.first]},
+        'last_seen': {'$max': [{'$ifNull': ['$last_seen', entry.last]}, entry.last]},
+        'observations': {'$add': [{'$ifNull': ['$observations', 0]}, entry.count]},
+        'n_adv': {'$add': [{'$ifNull': ['$n_adv', 0]}, entry.n_adv]},
+        'last_payload_hash': {'$cond': [newer, payload_hash(entry.payload or b''),
+                                        '$last_payload_hash']},
+    }
+    if entry.samples:
+        fields['rssi_min'] = {'$min': [{'$ifNull': ['$rssi_min', entry.rssi_min]}, entry.rssi_min]}
+        fields['rssi_max'] = {'$max': [{'$ifNull': ['$rssi_max', entry.rssi_max]}, entry.rssi_max]}
+        fields['rssi_ewma'] = {'$cond': [
+            {'$eq': [{'$type': '$rssi_ewma'}, 'missing']},
+            entry.initial,
+            {'$add': [{'$multiply': ['$rssi_ewma', entry.decay]}, entry.ewma]},
+        ]}
+    if entry.position:
+        fields['last_position'] = {'$cond': [newer, {'$literal': entry.position}, '$last_position']}
+    return UpdateOne({'_id': mac}, [{'$set': fields}], upsert=True)
+
+
+class DeviceRegistry:
+    """Upserts the per-MAC summaries of stored buffers"""
+
+    def __init__(self, db, name=REGISTRY_COLLECTION, alpha=RSSI_EWMA_ALPHA):
+        """
+        Args:
+            db: pymongo Database
+            name (str): Registry collection
+            alpha (float): Weight of the newest sample in rssi_ewma
+        """
+        self.collection = db[name]
+        self.alpha = alpha
+        self.indexed = False
+        self.buffers = 0
+        self.upserts = 0
+
+    def update(self, documents):
+        """
+        Add buffer documents to the registry with one unordered bulk_write
+
+        Returns:
+            int: Device documents inserted or modified
+        """
+        if not documents:
+            return 0
+        if not self.indexed:
+            ensure_indexes(self.collection, REGISTRY_INDEXES)
+            self.indexed = True
+        requests = [registry_update(mac, entry)
+                    for mac, entry in coalesce(documents, self.alpha).items()]
+        if not requests:
+            return 0
+        result = self.collection.bulk_write(requests, ordered=False)
+        changed = result.upserted_count + result.modified_count
+        self.buffers += len(documents)
+        self.upserts += changed
+        return changed
+
+
+def devices_seen(collection, since, until=None):
+    """Registry documents last seen in [since, until], most recent first"""
+    query = {'last_seen': {'$gte': since}}
+    if until:
+        query['last_seen']['$lte'] = until
+    return list(collection.find(query).sort('last_seen', DESCENDING))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Devices seen recently, from the device registry')
+    parser.add_argument('--mongo-uri', type=str, default='mongodb://localhost:27017/')
+    parser.add_argument('--db', type=str, default='tracking_data')
+    parser.add_argument('--hours', type=float, default=24.0)
+    args = parser.parse_args()
+
+    collection = MongoClient(args.mongo_uri)[args.db][REGISTRY_COLLECTION]
+    devices = devices_seen(collection, datetime.now() - timedelta(hours=args.hours))
+    for device in devices:
+        ewma = device.get('rssi_ewma')
+        rssi = f" rssi {ewma:.1f}" if ewma is not None else ""
+        print(f"{device['_id']} first {device['first_seen']:%Y-%m-%d %H:%M:%S} "
+              f"last {device['last_seen']:%Y-%m-%d %H:%M:%S} obs {device['observations']} "
+              f"n_adv {device['n_adv']}{rssi}")
+    print(f"{len(devices)} devices seen in the last {args.hours:g} h")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,285 @@
+"""Per-minute and per-hour rollups maintained at ingest.
+
+The dashboard and utils.get_temporal_analysis used to recompute unique MACs,
+advertisement totals and devices per buffer from every raw buffer. With
+--rollups the receivers also upsert, for every stored batch, one document
+per (scanner, minute) into <collection>_minute and per (scanner, hour) into
+<collection>_hour:
+    {'_id': {'scanner': ..., 'start': ...}, 'scanner': ..., 'start': ...,
+     'buffers', 'devices', 'advertisements', 'n_adv_raw',
+     'macs': [...],                               # $addToSet, unique MACs
+     'rssi_sum', 'rssi_count', 'rssi_min', 'rssi_max',
+     'lat_min', 'lat_max', 'lon_min', 'lon_max',  # GPS bounding box
+     'first', 'last',                             # capture time range
+     'received'}                                  # newest receive time
+A batch becomes one unordered bulk_write of $inc/$min/$max/$addToSet
+upserts, so readers scan O(minutes) documents instead of O(observations).
+
+    python rollups.py --db tracking_data --collection portfinal --rebuild
+"""
+import argparse
+from collections import defaultdict
+from datetime import datetime
+
+from pymongo import ASCENDING, MongoClient, UpdateOne
+
+from device_batch import format_mac
+from encoding import DEVICE_FIELDS, DEVICES_FIELD, is_compact
+from indexes import ensure_indexes, geo_point
+from timeseries import find_buffers, is_timeseries
+
+PERIODS = ('minute', 'hour')
+ROLLUP_INDEXES = {
+    'start': ([('start', ASCENDING)], {}),
+    'scanner_start': ([('scanner', ASCENDING), ('start', ASCENDING)], {}),
+}
+
+
+def period_start(timestamp, period):
+    """Start of the minute or hour containing timestamp"""
+    if period == 'minute':
+        return timestamp.replace(second=0, microsecond=0)
+    return timestamp.replace(minute=0, second=0, microsecond=0)
+
+
+def buffer_time(document):
+    """Time a buffer is rolled up under: its capture time, else its receive time"""
+    return document.get('capture_timestamp') or document['timestamp']
+
+
+def rollup_names(name):
+    """Rollup collection of each period for the collection name"""
+    return {period: f'{name}_{period}' for period in PERIODS}
+
+
+def _devices(document):
+    """(mac, rssi, n_adv) of every device, standard or compact encoding"""
+    if is_compact(document):
+        mac, rssi, n_adv = DEVICE_FIELDS['mac'], DEVICE_FIELDS['rssi'], DEVICE_FIELDS['n_adv']
+        return [(format_mac(device[mac]), device.get(rssi), device.get(n_adv, 0))
+                for device in document.get(DEVICES_FIELD, ())]
+    return [(device['mac'], device.get('rssi'), device.get('n_adv', 0))
+            for device in document.get('devices', ())]
+
+
+def _new_rollup():
+    return {'buffers': 0, 'devices': 0, 'advertisements': 0, 'n_adv_raw': 0,
+            'macs': set(), 'rssi_sum': 0, 'rssi_count': 0, 'rssi_min': None,
+            'rssi_max': None, 'lat_min': None, 'lat_max': None, 'lon_min': None,
+            'lon_max': None, 'first': None, 'last': None, 'received': None}
+
+
+def _lower(a, b):
+    return b if a is None else a if b is None else min(a, b)
+
+
+def _upper(a, b):
+    return b if a is None else a if b is None else max(a, b)
+
+
+def accumulate(documents, period):
+    """
+    Fold buffer documents into rollups of one period
+
+    Args:
+        documents: Buffer documents (standard or compact encoding)
+        period (str): 'minute' or 'hour'
+
+    Returns:
+        dict: (scanner, start) -> rollup fields
+    """
+    rollups = defaultdict(_new_rollup)
+    for document in documents:
+        time = buffer_time(document)
+        rollup = rollups[(document.get('scanner'), period_start(time, period))]
+        devices = _devices(document)
+        rollup['buffers'] += 1
+        rollup['devices'] += len(devices)
+        rollup['n_adv_raw'] += document.get('n_adv_raw') or 0
+        rollup['first'] = _lower(rollup['first'], time)
+        rollup['last'] = _upper(rollup['last'], time)
+        rollup['received'] = _upper(rollup['received'], document['timestamp'])
+        for mac, rssi, n_adv in devices:
+            rollup['macs'].add(mac)
+            rollup['advertisements'] += n_adv or 0
+            if rssi is not None:
+                rollup['rssi_sum'] += rssi
+                rollup['rssi_count'] += 1
+                rollup['rssi_min'] = _lower(rollup['rssi_min'], rssi)
+                rollup['rssi_max'] = _upper(rollup['rssi_max'], rssi)
+        point = document.get('location') or geo_point(document.get('gps_data'))
+        if point:
+            longitude, latitude = point['coordinates']
+            rollup['lat_min'] = _lower(rollup['lat_min'], latitude)
+            rollup['lat_max'] = _upper(rollup['lat_max'], latitude)
+            rollup['lon_min'] = _lower(rollup['lon_min'], longitude)
+            rollup['lon_max'] = _upper(rollup['lon_max'], longitude)
+    return rollups
+
+
+def rollup_update(scanner, start, rollup):
+    """Upsert adding one accumulated rollup to its stored document"""
+    lowest = {field: rollup[field] for field in ('rssi_min', 'lat_min', 'lon_min', 'first')
+              if rollup[field] is not None}
+    highest = {field: rollup[field] for field in ('rssi_max', 'lat_max', 'lon_max', 'last', 'received')
+               if rollup[field] is not None}
+    update = {
+        '$setOnInsert': {'scanner': scanner, 'start': start},
+        '$inc': {field: rollup[field] for field in
+                 ('buffers', 'devices', 'advertisements', 'n_adv_raw', 'rssi_sum', 'rssi_count')},
+        '$addToSet': {'macs': {'$each': sorted(rollup['macs'])}},
+    }
+    if lowest:
+        update['$min'] = lowest
+    if highest:
+        update['$max'] = highest
+    return UpdateOne({'_id': {'scanner': scanner, 'start': start}}, update, upsert=True)
+
+
+class RollupWriter:
+    """Upserts the minute and hour rollups of stored buffers"""
+
+    def __init__(self, db, name):
+        """
+        Args:
+            db: pymongo Database
+            name (str): Collection the buffers are stored in; rollups go to
+                <name>_minute and <name>_hour
+        """
+        self.collections = {period: db[rollup] for period, rollup in rollup_names(name).items()}
+        self.indexed = False
+        self.buffers = 0
+        self.upserts = 0
+
+    def update(self, documents):
+        """
+        Add buffer documents to the rollups, one bulk_write per period
+
+        Returns:
+            int: Rollup documents upserted or modified
+        """
+        if not documents:
+            return 0
+        if not self.indexed:
+            for collection in self.collections.values():
+                ensure_indexes(collection, ROLLUP_INDEXES)
+            self.indexed = True
+        changed = 0
+        for period, collection in self.collections.items():
+            requests = [rollup_update(scanner, start, rollup)
+                        for (scanner, start), rollup in accumulate(documents, period).items()]
+            result = collection.bulk_write(requests, ordered=False)
+            changed += result.upserted_count + result.modified_count
+        self.buffers += len(documents)
+        self.upserts += changed
+        return changed
+
+
+def read_rollups(collection, start=None, end=None, scanner=None):
+    """Rollup documents of one period, oldest first"""
+    query = {}
+    if start or end:
+        query['start'] = {}
+        if start:
+            query['start']['$gte'] = start
+        if end:
+            query['start']['$lte'] = end
+    if scanner is not None:
+        query['scanner'] = scanner
+    return list(collection.find(query, {'_id': 0}).sort('start', ASCENDING))
+
+
+def merge(rollups):
+    """
+    Combine rollup documents (e.g. every scanner of an hour)
+
+    Returns:
+        dict: Summed counters, union of macs (set), overall min/max, and
+        avg_devices (devices per buffer) and avg_rssi
+    """
+    total = _new_rollup()
+    for rollup in rollups:
+        for field in ('buffers', 'devices', 'advertisements', 'n_adv_raw', 'rssi_sum', 'rssi_count'):
+            total[field] += rollup.get(field, 0)
+        total['macs'].update(rollup.get('macs', ()))
+        for field in ('rssi_min', 'lat_min', 'lon_min', 'first'):
+            total[field] = _lower(total[field], rollup.get(field))
+        for field in ('rssi_max', 'lat_max', 'lon_max', 'last', 'received'):
+            total[field] = _upper(total[field], rollup.get(field))
+    total['avg_devices'] = total['devices'] / total['buffers'] if total['buffers'] else 0.0
+    total['avg_rssi'] = total['rssi_sum'] / total['rssi_count'] if total['rssi_count'] else None
+    return total
+
+
+def chart_points(collection, max_points=13):
+    """
+    Devices per buffer over time from minute rollups, in app.py's chartData shape
+
+    Returns:
+        list: {'buffer': buffers up to the point, 'devices': average devices
+        per buffer, 'timestamp': end of the point}, at most max_points
+    """
+    rollups = read_rollups(collection)
+    if not rollups:
+        return []
+    step = max(1, -(-len(rollups) // max_points))
+    points = []
+    buffers = 0
+    for i in range(0, len(rollups), step):
+        total = merge(rollups[i:i + step])
+        buffers += total['buffers']
+        points.append({
+            'buffer': buffers,
+            'devices': round(total['avg_devices'], 1),
+            'timestamp': total['last'],
+        })
+    return points
+
+
+def rebuild(db, name, batch_size=1000):
+    """
+    Recompute the rollups of an existing collection from its raw buffers
+
+    Returns:
+        int: Buffers rolled up
+    """
+    source = db[name]
+    writer = RollupWriter(db, name)
+    for collection in writer.collections.values():
+        collection.drop()
+    if is_timeseries(source):
+        documents = iter(find_buffers(source, sort=1))
+    else:
+        documents = source.find({}, {'_id': 0}).batch_size(batch_size)
+    batch = []
+    for document in documents:
+        batch.append(document)
+        if len(batch) >= batch_size:
+            writer.update(batch)
+            batch = []
+    writer.update(batch)
+    return writer.buffers
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Rebuild or show the minute/hour rollups of a collection')
+    parser.add_argument('--mongo-uri', type=str, default='mongodb://localhost:27017/')
+    parser.add_argument('--db', type=str, default='tracking_data')
+    parser.add_argument('--collection', type=str, default='portfinal')
+    parser.add_argument('--rebuild', action='store_true',
+                        help='Drop the rollups and recompute them from the raw buffers')
+    args = parser.parse_args()
+
+    db = MongoClient(args.mongo_uri)[args.db]
+    if args.rebuild:
+        start = datetime.now()
+        buffers = rebuild(db, args.collection)
+        print(f"{buffers} buffers rolled up in {(datetime.now() - start).total_seconds():.1f} s")
+    names = rollup_names(args.collection)
+    for rollup in read_rollups(db[names['hour']])[-24:]:
+        print(f"{rollup['start']:%Y-%m-%d %H:00} {rollup['scanner']}: {rollup['buffers']} buffers, "
+              f"{len(rollup['macs'])} MACs, {rollup['advertisements']} advertisements")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,161 @@
+"""Buffer sequence tracking.
+
+The firmware numbers buffers with a counter that wraps (uint8 in v1-v3,
+uint16 in compact) and restarts at 0 on reboot. SequenceTracker turns it
+into a monotonically increasing 64-bit buffer index per scanner and counts
+lost, duplicated and rebooted buffers.
+"""
+
+UPTIME_MODULUS = 1 << 32  # k_uptime_get_32() wraps after ~49.7 days
+
+
+class SequenceTracker:
+    """Extends one scanner's wrapping sequence into a buffer index"""
+
+    # Weight of each new sample in the buffer interval estimate
+    INTERVAL_ALPHA = 0.1
+    # Host arrival times are too jittery to reason about shorter intervals
+    # (e.g. max-speed replays); firmware timestamps are always used
+    MIN_HOST_INTERVAL = 0.5
+
+    def __init__(self, bits=8, n_adv_bits=16, interval=None):
+        """
+        Args:
+            bits (int): Width of the on-wire sequence counter
+            n_adv_bits (int): Width of the header n_adv_raw counter
+            interval (float): Expected seconds between buffers, estimated
+                from the stream when None
+        """
+        self.modulus = 1 << bits
+        self.n_adv_modulus = 1 << n_adv_bits
+        self.interval = interval
+
+        self.index = None          # Buffer index of the last buffer
+        self.last_sequence = None
+        self.last_timestamp = None
+        self.last_received = None
+        self.epoch = 0             # Reboots seen so far
+
+        # Metrics
+        self.buffers = 0
+        self.lost = 0
+        self.duplicates = 0
+        self.reboots = 0
+        self.gaps = 0
+        self.n_adv_mismatches = 0
+
+    def _elapsed(self, timestamp, received):
+        """Seconds since the previous buffer, preferring the firmware clock"""
+        if timestamp is not None and self.last_timestamp is not None:
+            return ((timestamp - self.last_timestamp) % UPTIME_MODULUS) / 1000
+        if received is not None and self.last_received is not None:
+            return received - self.last_received
+        return None
+
+    def _timed_interval(self, timestamp):
+        """Interval usable for timing heuristics, None when unreliable"""
+        if not self.interval:
+            return None
+        if timestamp is None and self.interval < self.MIN_HOST_INTERVAL:
+            return None
+        return self.interval
+
+    def _rebooted(self, sequence, delta, timestamp, elapsed, interval):
+        """Whether the scanner restarted between the last buffer and this one"""
+        if timestamp is not None and self.last_timestamp is not None:
+            # Uptime went backwards (modular compare survives the 32-bit wrap)
+            backwards = (self.last_timestamp - timestamp) % UPTIME_MODULUS
+            return 0 < backwards < UPTIME_MODULUS // 2
+        if delta <= 1:
+            return False
+        if interval and elapsed is not None:
+            # Not enough time has passed to lose delta - 1 buffers
+            return elapsed < (delta - 0.5) * interval
+        return sequence == 0
+
+    def update(self, sequence, timestamp=None, received=None):
+        """
+        Account for the next received buffer
+
+        Args:
+            sequence (int): On-wire sequence number
+            timestamp (int): Firmware uptime in ms from the header, if any
+            received (float): Host time.monotonic() at reception
+
+        Returns:
+            dict: buffer_index, epoch, lost (buffers missing right before this
+            one), duplicate and reboot flags
+        """
+        self.buffers += 1
+        result = {'lost': 0, 'duplicate': False, 'reboot': False}
+
+        if self.index is None:
+            self.index = sequence
+        else:
+            delta = (sequence - self.last_sequence) % self.modulus
+            elapsed = self._elapsed(timestamp, received)
+            interval = self._timed_interval(timestamp)
+            wraps = 0
+            if interval and elapsed is not None:
+                # Outages longer than a whole counter cycle
+                wraps = max(0, round((elapsed / interval - delta) / self.modulus))
+
+            if self._rebooted(sequence, delta, timestamp, elapsed, interval):
+                self.reboots += 1
+                self.epoch += 1
+                self.index += 1
+                result['reboot'] = True
+            elif delta == 0 and not wraps:
+                # Same buffer again: keep the state of the first copy
+                self.duplicates += 1
+                result.update(duplicate=True, buffer_index=self.index, epoch=self.epoch)
+                return result
+            else:
+                delta += wraps * self.modulus
+                if delta == 1 and elapsed:
+                    self.interval = elapsed if self.interval is None else (
+                        self.interval + self.INTERVAL_ALPHA * (elapsed - self.interval))
+                if delta > 1:
+                    self.gaps += 1
+                    self.lost += delta - 1
+                    result['lost'] = delta - 1
+                self.index += delta
+
+        self.last_sequence = sequence
+        self.last_timestamp = timestamp
+        self.last_received = received
+        result.update(buffer_index=self.index, epoch=self.epoch)
+        return result
+
+    def reconcile(self, n_adv_raw, n_adv_sum):
+        """
+        Compare the header advertisement total with the per-device counts
+
+        n_adv_raw also counts advertisements of devices dropped once the
+        scanner's table was full, so a positive remainder is expected then.
+
+        Returns:
+            int: n_adv_raw - n_adv_sum, taking the header counter wrap into account
+        """
+        unaccounted = (n_adv_raw - n_adv_sum) % self.n_adv_modulus
+        if unaccounted >= self.n_adv_modulus // 2:
+            unaccounted -= self.n_adv_modulus
+        if unaccounted:
+            self.n_adv_mismatches += 1
+        return unaccounted
+
+    def stats(self):
+        """Counters for logging and monitoring"""
+        expected = self.buffers - self.duplicates + self.lost
+        return {
+            'buffers': self.buffers,
+            'buffer_index': self.index,
+            'epoch': self.epoch,
+            'lost': self.lost,
+            'gaps': self.gaps,
+            'duplicates': self.duplicates,
+            'reboots': self.reboots,
+            'loss_rate': round(self.lost / expected, 6) if expected else 0.0,
+            'n_adv_mismatches': self.n_adv_mismatches,
+            'interval_s': round(self.interval, 3) if self.interval else None,
+        }
@@ -0,0 +1,214 @@
+"""Firmware simulator for host-side soak tests.
+
+Opens a pseudo-terminal pair and writes well-formed scanner frames to it.
+Point any receiver at the printed /dev/pts/N:
+    python simulator.py --protocol v2 --devices 500 --interval-ms 100
+    python uart-mongo.py --port /dev/pts/5 --protocol v2
+"""
+import argparse
+import os
+import random
+import time
+import numpy as np
+from protocol import PROTOCOLS, DEFAULT_PROTOCOL, get_protocol
+
+SAMPLING_INTERVAL_MS = 5000  # Firmware default (ble_scanner.h)
+
+# Advertising PDU types seen by the scanner
+ADV_TYPES = (0x00, 0x02, 0x03, 0x04)
+
+
+class ScannerSimulator:
+    """Generates scanner buffers for a simulated device population"""
+
+    def __init__(self, protocol=DEFAULT_PROTOCOL, devices=100, presence=0.7,
+                 mac_rotation=0.05, rssi_mean=-70.0, rssi_std=10.0,
+                 corrupt_rate=0.0, loss_rate=0.0, seed=None):
+        """
+        Args:
+            protocol (str): Layout name from protocol.PROTOCOLS
+            devices (int): Size of the device population
+            presence (float): Probability that a device is seen in a buffer
+            mac_rotation (float): Per-buffer probability that a random-address
+                device changes its MAC
+            rssi_mean (float): Mean RSSI in dBm
+            rssi_std (float): RSSI standard deviation in dBm
+            corrupt_rate (float): Probability of flipping a byte in a frame
+            loss_rate (float): Probability of dropping a span of a frame
+            seed (int): Random seed for reproducible streams
+        """
+        self.protocol = get_protocol(protocol)
+        self.presence = presence
+        self.mac_rotation = mac_rotation
+        self.rssi_mean = rssi_mean
+        self.rssi_std = rssi_std
+        self.corrupt_rate = corrupt_rate
+        self.loss_rate = loss_rate
+        self.random = random.Random(seed)
+        self.rng = np.random.default_rng(seed)
+
+        dtype = self.protocol.device_dtype
+        data_size = dtype['data'].shape[0]
+        max_devices = min(devices, self.protocol.max_devices)
+
+        # Device population: MAC, address type, PDU type and a fixed payload
+        self.population = np.zeros(devices, dtype=dtype)
+        self.population['mac'] = self.rng.integers(0, 256, (devices, 6), dtype=np.uint8)
+        self.population['addr_type'] = self.rng.integers(0, 2, devices)
+        self.population['adv_type'] = self.rng.choice(ADV_TYPES, devices)
+        self.population['data_len'] = self.rng.integers(3, data_size + 1, devices)
+        self.population['data'] = self.rng.integers(0, 256, (devices, data_size), dtype=np.uint8)
+        self.max_devices = max_devices
+
+        self.sequence = 0
+        self.uptime_ms = 0
+        self.frames = 0
+        self.corrupted = 0
+        self.lost_bytes = 0
+
+    def _rotate_macs(self):
+        """Give some random-address devices a new MAC (privacy rotation)"""
+        rotating = (self.population['addr_type'] == 1) & \
+            (self.rng.random(len(self.population)) < self.mac_rotation)
+        count = int(rotating.sum())
+        if count:
+            self.population['mac'][rotating] = self.rng.integers(0, 256, (count, 6), dtype=np.uint8)
+
+    def make_frame(self, interval_ms=SAMPLING_INTERVAL_MS):
+        """Build the next buffer as the firmware would send it"""
+        self._rotate_macs()
+        seen = np.flatnonzero(self.rng.random(len(self.population)) < self.presence)
+        seen = seen[:self.max_devices]
+
+        records = self.population[seen].copy()
+        rssi = self.rng.normal(self.rssi_mean, self.rssi_std, len(seen))
+        records['rssi'] = np.clip(np.round(rssi), -127, 0).astype(np.int8)
+        n_adv_max = np.iinfo(records['n_adv'].dtype).max
+        n_adv = self.rng.poisson(max(interval_ms / 100, 1), len(seen)) + 1
+        records['n_adv'] = np.minimum(n_adv, n_adv_max)
+
+        self.uptime_ms += interval_ms
+        if 'last_seen' in records.dtype.names:
+            records['last_seen'] = self.uptime_ms - self.rng.integers(0, max(interval_ms, 1), len(seen))
+
+        header = {
+            'sequence': self.sequence,
+            'n_adv_raw': int(n_adv.sum()),
+            'n_mac': len(seen),
+            'timestamp': self.uptime_ms,
+        }
+        self.sequence += 1
+        self.frames += 1
+        return self.protocol.encode_frame(header, records)
+
+    def impair(self, frame):
+        """Apply the configured corruption and byte loss to a frame"""
+        if self.corrupt_rate and self.random.random() < self.corrupt_rate:
+            frame = bytearray(frame)
+            frame[self.random.randrange(len(frame))] ^= 1 << self.random.randrange(8)
+            frame = bytes(frame)
+            self.corrupted += 1
+        if self.loss_rate and self.random.random() < self.loss_rate:
+            start = self.random.randrange(len(frame))
+            length = self.random.randint(1, 64)
+            self.lost_bytes += len(frame[start:start + length])
+            frame = frame[:start] + frame[start + length:]
+        return frame
+
+    def stats(self):
+        return {
+            'frames': self.frames,
+            'corrupted': self.corrupted,
+            'lost_bytes': self.lost_bytes,
+        }
+
+
+def open_pty():
+    """Open a raw pseudo-terminal pair, returns (master fd, slave path)"""
+    import tty  # Unix only
+    master, slave = os.openpty()
+    tty.setraw(slave)
+    return master, os.ttyname(slave)
+
+
+def run(simulator, master, interval_ms, count=None, baudrate=None, report_s=5.0):
+    """Write frames to the pty master until count frames or Ctrl+C"""
+    sent_bytes = 0
+    started = last_report = time.monotonic()
+    next_frame = started
+    while count is None or simulator.frames < count:
+        frame = simulator.impair(simulator.make_frame(interval_ms))
+        view = memoryview(frame)
+        while view:
+            written = os.write(master, view)
+            view = view[written:]
+        sent_bytes += len(frame)
+
+        # Pace buffers by the interval, or by the link when it is slower
+        next_frame += interval_ms / 1000
+        if baudrate:
+            next_frame = max(next_frame, time.monotonic() + len(frame) * 10 / baudrate)
+        delay = next_frame - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+
+        now = time.monotonic()
+        if now - last_report >= report_s:
+            elapsed = now - started
+            print(f"Frames: {simulator.frames} ({simulator.frames / elapsed:.1f}/s), "
+                  f"Bytes: {sent_bytes} ({sent_bytes / elapsed:.0f} B/s), "
+                  f"Corrupted: {simulator.corrupted}, Lost bytes: {simulator.lost_bytes}")
+            last_report = now
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='BLE scanner firmware simulator (pty)')
+    parser.add_argument('--protocol', type=str, choices=list(PROTOCOLS),
+                        default=DEFAULT_PROTOCOL,
+                        help=f'Frame layout (default: {DEFAULT_PROTOCOL})')
+    parser.add_argument('--devices', type=int, default=100,
+                        help='Device population size (default: 100)')
+    parser.add_argument('--presence', type=float, default=0.7,
+                        help='Probability a device appears in a buffer (default: 0.7)')
+    parser.add_argument('--mac-rotation', type=float, default=0.05,
+                        help='Per-buffer MAC randomization rate of random-address devices (default: 0.05)')
+    parser.add_argument('--rssi-mean', type=float, default=-70.0,
+                        help='Mean RSSI in dBm (default: -70)')
+    parser.add_argument('--rssi-std', type=float, default=10.0,
+                        help='RSSI standard deviation in dBm (default: 10)')
+    parser.add_argument('--interval-ms', type=float, default=SAMPLING_INTERVAL_MS,
+                        help=f'Buffer interval in ms, 0 for as fast as possible (default: {SAMPLING_INTERVAL_MS})')
+    parser.add_argument('--baudrate', type=int,
+                        help='Limit throughput to this UART baudrate (default: unlimited)')
+    parser.add_argument('--corrupt-rate', type=float, default=0.0,
+                        help='Probability of a flipped byte per frame (default: 0)')
+    parser.add_argument('--loss-rate', type=float, default=0.0,
+                        help='Probability of lost bytes per frame (default: 0)')
+    parser.add_argument('--count', type=int,
+                        help='Number of buffers to send (default: unlimited)')
+    parser.add_argument('--seed', type=int,
+                        help='Random seed')
+
+    args = parser.parse_args()
+
+    simulator = ScannerSimulator(
+        protocol=args.protocol,
+        devices=args.devices,
+        presence=args.presence,
+        mac_rotation=args.mac_rotation,
+        rssi_mean=args.rssi_mean,
+        rssi_std=args.rssi_std,
+        corrupt_rate=args.corrupt_rate,
+        loss_rate=args.loss_rate,
+        seed=args.seed
+    )
+    master, slave_path = open_pty()
+    print(f"Simulated scanner on {slave_path} ({simulator.protocol.name})")
+    print(f"Example: python uart-mongo.py --port {slave_path} --protocol {args.protocol}")
+    try:
+        run(simulator, master, args.interval_ms, count=args.count, baudrate=args.baudrate)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        print(f"Simulator stopped: {simulator.stats()}")
+        os.close(master)
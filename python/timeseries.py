@@ -0,0 +1,255 @@
+"""Per-device observations in a MongoDB time-series collection.
+
+The default layout stores one document per buffer with a nested devices
+array. With --storage timeseries every device of a buffer becomes its own
+observation document:
+    {'ts': capture time, 'meta': {'scanner': ..., 'mac': ...},
+     'received': host receive time, 'sequence': ..., 'rssi': ..., 'n_adv': ...,
+     'data': <binary>, decoded AD fields, 'gps_data': ...}
+in a time-series collection (timeField 'ts', metaField 'meta'), so a MAC's
+history or RSSI over time is an indexed range scan instead of an $unwind
+over whole buffers.
+
+The read helpers (find_buffers, count_buffers, latest_buffer) return the
+buffer layout for either kind of collection, so app.py and utils.py work
+on both.
+"""
+from collections import OrderedDict
+
+from pymongo.errors import BulkWriteError, CollectionInvalid
+
+from encoding import expand_document, expand_documents
+
+TIME_FIELD = 'ts'
+META_FIELD = 'meta'
+# Scanners close a buffer every few seconds
+GRANULARITY = 'seconds'
+# Suffix of the time-series collection written next to a buffer collection
+COLLECTION_SUFFIX = '_ts'
+
+# --storage choices of the receivers
+STORAGE_MODES = ('buffers', 'timeseries')
+
+# Buffer fields repeated on every observation of the buffer
+BUFFER_FIELDS = ('sequence', 'n_adv_raw', 'n_mac', 'buffer_index', 'gps_data', 'location')
+
+
+def ensure_timeseries_collection(db, name, granularity=GRANULARITY):
+    """
+    Create the time-series collection if needed
+
+    Returns:
+        Collection: The collection
+
+    Raises:
+        ValueError: If name exists as a regular collection
+    """
+    try:
+        return db.create_collection(name, timeseries={
+            'timeField': TIME_FIELD,
+            'metaField': META_FIELD,
+            'granularity': granularity,
+        })
+    except CollectionInvalid:
+        # Already there: make sure it is a time-series collection
+        if not is_timeseries(db[name]):
+            raise ValueError(f"{name} exists and is not a time-series collection")
+        return db[name]
+
+
+def is_timeseries(collection):
+    """Whether collection is a time-series collection (observation layout)"""
+    for info in collection.database.list_collections(filter={'name': collection.name}):
+        return info.get('type') == 'timeseries'
+    return False
+
+
+def observations_from_buffer(document):
+    """
+    Split a buffer document into one observation per device
+
+    Args:
+        document (dict): Buffer in the layout built by the receivers
+            (standard or compact encoding)
+
+    Returns:
+        list: Observation documents for the time-series collection
+    """
+    document = expand_document(document)
+    received = document['timestamp']
+    ts = document.get('capture_timestamp') or received
+    scanner = document.get('scanner')
+    shared = {field: document[field] for field in BUFFER_FIELDS if field in document}
+    observations = []
+    for device in document.get('devices', ()):
+        observation = {
+            TIME_FIELD: ts,
+            META_FIELD: {'scanner': scanner, 'mac': device['mac']},
+            'received': received,
+            **shared,
+        }
+        for key, value in device.items():
+            if key == 'mac':
+                continue
+            if key == 'data' and isinstance(value, str):
+                value = bytes.fromhex(value)
+            observation[key] = value
+        observations.append(observation)
+    return observations
+
+
+def buffers_from_observations(observations):
+    """
+    Group observations back into buffer documents (inverse of observations_from_buffer)
+
+    Args:
+        observations: Iterable of observation documents, in any order
+
+    Returns:
+        list: Buffer documents in order of first appearance
+    """
+    buffers = OrderedDict()
+    for observation in observations:
+        meta = observation.get(META_FIELD, {})
+        key = (meta.get('scanner'), observation.get('received'), observation.get('sequence'))
+        buffer = buffers.get(key)
+        if buffer is None:
+            buffer = {
+                'timestamp': observation.get('received', observation[TIME_FIELD]),
+                'capture_timestamp': observation[TIME_FIELD],
+                **{field: observation[field] for field in BUFFER_FIELDS if field in observation},
+                'devices': [],
+            }
+            if meta.get('scanner') is not None:
+                buffer['scanner'] = meta['scanner']
+            buffers[key] = buffer
+        device = {'mac': meta.get('mac')}
+        for key_, value in observation.items():
+            if key_ in (TIME_FIELD, META_FIELD, '_id', 'received') or key_ in BUFFER_FIELDS:
+                continue
+            device[key_] = value.hex() if key_ == 'data' and isinstance(value, bytes) else value
+        buffer['devices'].append(device)
+    return list(buffers.values())
+
+
+class ObservationWriter:
+    """Stores buffer documents as observations in a time-series collection"""
+
+    def __init__(self, db, name, granularity=GRANULARITY):
+        """
+        Args:
+            db: pymongo Database
+            name (str): Time-series collection, created on the first write
+            granularity (str): 'seconds', 'minutes' or 'hours'
+        """
+        self.db = db
+        self.name = name
+        self.granularity = granularity
+        self.collection = None
+
+    def ensure_collection(self):
+        """Create the time-series collection if needed and return it"""
+        if self.collection is None:
+            self.collection = ensure_timeseries_collection(self.db, self.name, self.granularity)
+        return self.collection
+
+    def insert(self, documents):
+        """
+        Insert the observations of buffer documents with one unordered insert_many
+
+        Connection errors propagate (the journal retries them).
+
+        Returns:
+            int: Buffers whose observations were all stored
+        """
+        return len(documents) - len(self.insert_buffers(documents))
+
+    def insert_buffers(self, documents):
+        """
+        insert() that tells which buffers failed
+
+        Returns:
+            set: Indexes in documents of the buffers with an observation that
+            was not stored; the others are complete
+        """
+        self.ensure_collection()
+        observations = []
+        owners = []  # Buffer index of each observation
+        for index, document in enumerate(documents):
+            expanded = observations_from_buffer(document)
+            observations.extend(expanded)
+            owners.extend([index] * len(expanded))
+        if not observations:
+            return set()
+        try:
+            self.collection.insert_many(observations, ordered=False)
+            return set()
+        except BulkWriteError as e:
+            # Unordered: only the observations with an error are missing
+            return {owners[error['index']] for error in e.details.get('writeErrors', [])}
+
+
+def find_buffers(collection, start=None, end=None, sort=-1, limit=0):
+    """
+    Buffer documents of either layout, optionally within [start, end]
+
+    Args:
+        collection: Buffer or time-series collection
+        start (datetime): Earliest timestamp (time field for observations)
+        end (datetime): Latest timestamp
+        sort (int): 1 oldest first, -1 newest first
+        limit (int): Most buffers returned, 0 for all
+
+    Returns:
+        list: Buffer documents without _id, in the standard encoding
+    """
+    timeseries = is_timeseries(collection)
+    field = TIME_FIELD if timeseries else 'timestamp'
+    query = {}
+    if start or end:
+        query[field] = {}
+        if start:
+            query[field]['$gte'] = start
+        if end:
+            query[field]['$lte'] = end
+    if not timeseries:
+        return expand_documents(collection.find(query, {'_id': 0}).sort(field, sort).limit(limit))
+
+    cursor = collection.find(query, {'_id': 0}).sort([(field, sort), ('received', sort)])
+    if not limit:
+        return buffers_from_observations(cursor)
+    # Read observations until limit buffers are complete
+    buffers = []
+    batch = []
+    last_key = None
+    for observation in cursor:
+        key = (observation[META_FIELD].get('scanner'), observation.get('received'),
+               observation.get('sequence'))
+        if key != last_key and batch:
+            buffers.extend(buffers_from_observations(batch))
+            batch = []
+            if len(buffers) >= limit:
+                break
+        batch.append(observation)
+        last_key = key
+    else:
+        buffers.extend(buffers_from_observations(batch))
+    return buffers[:limit]
+
+
+def count_buffers(collection):
+    """Number of buffers stored in either layout"""
+    if not is_timeseries(collection):
+        return collection.count_documents({})
+    result = list(collection.aggregate([
+        {'$group': {'_id': {'scanner': f'${META_FIELD}.scanner', 'received': '$received',
+                            'sequence': '$sequence'}}},
+        {'$count': 'buffers'},
+    ]))
+    return result[0]['buffers'] if result else 0
+
+
+def latest_buffer(collection):
+    """Most recent buffer, None if the collection is empty"""
+    buffers = find_buffers(collection, sort=-1, limit=1)
+    return buffers[0] if buffers else None
@@ -3,43 +3,88 @@ from datetime import datetime
 import time
 import argparse
 from pymongo import MongoClient
-from uart import UARTReceiver
+from uart import UARTReceiver, parse_port_spec
+from capture import EndOfCapture
+from fan_in import FanInReader
+from batch_writer import DEFAULT_BATCH_BYTES
+from journal import FSYNC_POLICIES
+from timeseries import STORAGE_MODES
+from encoding import COMPACT_VERSION, DEVICES_FIELD, ENCODING_FIELD, ENCODINGS, compact_devices
+from mongo_store import MONGO_TIMEOUTS, MongoStore
+from pipeline import OVERFLOW_POLICIES, run_reader
+from protocol import DEFAULT_PROTOCOL, protocol_choices
 from icecream import ic
 import logging
 import os
+import signal
 from enum import Enum
 
 class LogLevel(str, Enum):
     INFO = "info"
     DEBUG = "debug"
 
-class UARTMongoReceiver(UARTReceiver):
+class UARTMongoReceiver(MongoStore, UARTReceiver):
     def __init__(self, port='/dev/ttyUSB0', baudrate=115200, 
                  mongo_uri="mongodb://0.0.0.0:27017/",
-                 log_level="info"):
-        """Inicializa el receptor UART con MongoDB"""
+                 log_level="info", protocol=DEFAULT_PROTOCOL, capture=None,
+                 scanner_id=None, queue_size=1000, overflow='block',
+                 sink_workers=1, spill_file=None, batch_size=500,
+                 batch_bytes=DEFAULT_BATCH_BYTES, batch_latency=1.0,
+                 journal=None, journal_fsync='interval', storage='buffers',
+                 encoding='standard', rollups=False, device_registry=False,
+                 ad_fields=False, mongo_client=None):
+        """
+        Inicializa el receptor UART con MongoDB
+
+        Args:
+            queue_size (int): Buffers en memoria entre el hilo lector y MongoDB
+            overflow (str): Con la cola llena: 'block', 'drop-oldest' o 'spill'
+            sink_workers (int): Hilos que escriben en MongoDB
+            spill_file (str): Archivo de desbordamiento para overflow='spill'
+            batch_size (int): Documentos por insert_many
+            batch_bytes (int): Tamaño estimado que fuerza un insert_many
+            batch_latency (float): Segundos que un buffer espera a completar su lote
+            journal (str): Directorio del diario en disco; los buffers se escriben
+                ahí antes de MongoDB (sustituye a la cola en memoria)
+            journal_fsync (str): 'always', 'interval' o 'never'
+            storage (str): 'buffers' (un documento por buffer) o 'timeseries'
+                (una observación por dispositivo en la colección <colección>_ts)
+            encoding (str): 'standard' o 'compact' (datos binarios, MAC entera y
+                nombres cortos, ver encoding.py)
+            rollups (bool): Mantener resúmenes por minuto y hora (rollups.py)
+            device_registry (bool): Mantener la colección devices con un resumen
+                por MAC (registry.py)
+            ad_fields (bool): Añadir a cada dispositivo los campos decodificados
+                de sus datos AD (ad_decoder.py)
+            mongo_client: Cliente pymongo ya creado, en lugar de conectar a mongo_uri
+        """
         self.log_level = log_level.lower()
+        self.storage = storage
+        self.encoding = encoding
+        self.use_rollups = rollups
+        self.use_registry = device_registry
+        self.ad_fields = ad_fields
         # Configurar logging primero
         self._setup_logging()
         self.logger.info("Iniciando receptor UART con MongoDB")
         
-        super().__init__(port, baudrate)
-        
-        # Conexión a MongoDB
+        super().__init__(port, baudrate, protocol=protocol, capture=capture,
+                         scanner_id=scanner_id)
+        self._setup_pipeline(queue_size, overflow, sink_workers, spill_file,
+                             batch_size, batch_bytes, batch_latency, journal, journal_fsync)
+        self._connect_mongo(mongo_uri, mongo_client)
+
+    def _connect_mongo(self, mongo_uri, mongo_client=None):
+        """Abre la conexión a MongoDB y selecciona la colección"""
         try:
-            # Add MongoDB connection options for better network handling
-            self.client = MongoClient(mongo_uri, 
-                                    serverSelectionTimeoutMS=5000,  # 5 second timeout
-                                    connectTimeoutMS=5000,
-                                    socketTimeoutMS=5000)
-            # Test the connection
-            self.client.server_info()
-            self.db = self.client.ble_scanner
-            self.collection = self.db.test3
-            self.logger.info(f"Conexión a MongoDB establecida en {mongo_uri}")
+            self.client = mongo_client or MongoClient(mongo_uri, **MONGO_TIMEOUTS)
         except Exception as e:
             self.logger.error(f"Error conectando a MongoDB: {e}")
             raise
+        self.db = self.client.ble_scanner
+        self.collection = self.db.test3
+        self._open_storage(self.storage, self.use_rollups, self.use_registry)
+        self._check_server(mongo_uri)
 
     def _setup_logging(self):
         """Configura el sistema de logging"""
@@ -73,94 +118,132 @@ class UARTMongoReceiver(UARTReceiver):
         self.logger.addHandler(file_handler)
         self.logger.addHandler(console_handler)
 
+    def _make_document(self, header, devices, scanner_id):
+        """Documento MongoDB de un buffer"""
+        timestamp = datetime.now()
+        document = {
+            '_id': self._document_id(header, scanner_id),
+            'timestamp': timestamp,
+            'scanner': scanner_id,
+            'sequence': header['sequence'],
+            'n_adv_raw': header['n_adv_raw'],
+            'n_mac': header['n_mac'],
+            **self._sequence_fields(header),
+            **self._capture_fields(header),
+        }
+        if self.encoding == 'compact':
+            document[ENCODING_FIELD] = COMPACT_VERSION
+            document[DEVICES_FIELD] = compact_devices(devices, self.ad_fields)
+        else:
+            document['devices'] = devices.to_documents(self.ad_fields)
+        return document
+
     def _store_buffer(self, header, devices):
         """Almacena el buffer completo en MongoDB"""
-        try:
-            document = {
-                'timestamp': datetime.now(),
-                'sequence': header['sequence'],
-                'n_adv_raw': header['n_adv_raw'],
-                'n_mac': header['n_mac'],
-                'devices': []
-            }
-
-            for device in devices:
-                device_doc = {
-                    'mac': device['mac'],
-                    'addr_type': device['addr_type'],
-                    'adv_type': device['adv_type'],
-                    'rssi': device['rssi'],
-                    'data_len': device['data_len'],
-                    'data': device['data'].hex(),
-                    'n_adv': device['n_adv']
-                }
-                document['devices'].append(device_doc)
-            
-            result = self.collection.insert_one(document)
-            self.logger.debug(f"Buffer almacenado en BD - ID: {result.inserted_id}")
+        document = self._make_document(header, devices, self.scanner_id)
+        if self._insert_documents([document]):
             self.logger.debug(f"Datos del buffer - Secuencia: {header['sequence']}, MACs: {len(devices)}")
             return True
-        except Exception as e:
-            self.logger.error(f"Error almacenando en BD: {e}")
-            return False
+        return False
+
+    def _log_sequence_events(self, scanner_id, header):
+        """Avisa de buffers perdidos y reinicios del escáner"""
+        if header.get('lost'):
+            self.logger.warning(f"Escáner {scanner_id}: {header['lost']} buffers perdidos "
+                                f"antes de la secuencia {header['sequence']}")
+        if header.get('reboot'):
+            self.logger.warning(f"Escáner {scanner_id}: reinicio detectado "
+                                f"(época {header['epoch']})")
+
+    def _log_sequences(self):
+        """Registra las estadísticas de secuencia del escáner"""
+        self._log_sequence_stats(self.scanner_id, self.sequence_stats(), self.clock_stats())
+
+    def _log_sequence_stats(self, scanner_id, stats, clock=None):
+        if stats:
+            self.logger.info(
+                f"Secuencia {scanner_id}: buffers {stats['buffers']}, "
+                f"índice {stats['buffer_index']}, perdidos {stats['lost']} "
+                f"({stats['loss_rate']:.2%}), duplicados {stats['duplicates']}, "
+                f"reinicios {stats['reboots']}, n_adv descuadrados {stats['n_adv_mismatches']}"
+            )
+        if clock:
+            self.logger.info(
+                f"Reloj {scanner_id}: deriva {clock['drift_ppm']} ppm, "
+                f"muestras {clock['samples']}, atípicas {clock['outliers']}, "
+                f"reajustes {clock['resets']}"
+            )
+
+    def _log_metrics(self):
+        """Registra métricas de la cola y de las secuencias"""
+        self._log_pipeline()
+        self._log_sequences()
 
     def receive_messages(self, duration=None):
-        """Recibe y almacena buffers durante un tiempo específico"""
+        """Recibe y almacena buffers durante un tiempo específico
+
+        Un hilo lector decodifica los buffers y los encola; los hilos de
+        escritura los insertan en MongoDB sin frenar la lectura UART.
+        """
         self.logger.info("Iniciando recepción de buffers...")
-        start_time = time.time()
-        buffers_procesados = 0
-        
-        while True:
+        deadline = time.monotonic() + duration if duration else None
+        self.pipeline = self._make_pipeline().start()
+        try:
+            run_reader(lambda: self._read_loop(deadline), self.stop,
+                       self.POLL_INTERVAL, report=self._log_metrics)
+        except KeyboardInterrupt:
+            self.logger.info(f"Recepción interrumpida por el usuario")
+        finally:
+            pendientes = self.pipeline.stop()
+            self._log_metrics()
+            if pendientes and self.journal_options:
+                self.logger.warning(f"{pendientes} buffers quedan en el diario para el próximo arranque")
+            elif pendientes:
+                self.logger.warning(f"{pendientes} buffers sin almacenar al cerrar")
+            self.logger.info(f"Total de buffers procesados: {self.pipeline.stored}")
+            self.pipeline = None
+
+    def _read_loop(self, deadline):
+        """Hilo lector: lee buffers del puerto serie y los encola"""
+        while self.running:
             try:
                 # Verificar tiempo transcurrido
-                if duration and (time.time() - start_time) >= duration:
-                    self.logger.info(f"Tiempo de ejecución ({duration}s) completado")
-                    self.logger.info(f"Total de buffers procesados: {buffers_procesados}")
+                if deadline and time.monotonic() >= deadline:
+                    self.logger.info("Tiempo de ejecución completado")
                     break
 
-                # Busca la cabecera
-                while True:
-                    if self.serial.read() == b'\x55':
-                        potential_header = b'\x55' + self.serial.read(3)
-                        if potential_header == self.HEADER_MAGIC:
-                            self.logger.debug("Cabecera UART encontrada")
-                            break
-
-                # Lee y parsea la cabecera
-                header_data = potential_header + self.serial.read(self.HEADER_LENGTH - 4)
-                header = self._parse_header(header_data)
-                
-                if not header:
-                    self.logger.warning("Error al parsear cabecera")
+                # Lee el siguiente buffer completo (como mucho POLL_INTERVAL)
+                frame = self._read_frame(self._time_left(deadline))
+                if self.last_discarded:
+                    self.logger.debug(f"Resincronización: {self.last_discarded} bytes descartados")
+                if frame is None:
+                    self._on_idle()
                     continue
+                header, data = frame
+                self.logger.debug("Cabecera UART encontrada")
 
-                # Lee todos los dispositivos
-                devices = []
-                for i in range(header['n_mac']):
-                    device_data = self.serial.read(self.DEVICE_LENGTH)
-                    device = self._parse_device(device_data)
-                    if device:
-                        devices.append(device)
-                        self.logger.debug(f"Dispositivo {i+1} parseado - MAC: {device['mac']}")
+                # Parsea todos los dispositivos
+                devices = self._parse_devices(data)
+                self.logger.debug(f"{len(devices)} dispositivos parseados")
+                self._track_sequence(header, devices)
+                self._log_sequence_events(self.scanner_id, header)
 
-                # Almacena el buffer completo
+                # Encola el buffer completo
                 if devices:
-                    if self._store_buffer(header, devices):
-                        buffers_procesados += 1
-                        self.logger.debug(
-                            f"Buffer #{buffers_procesados} procesado - "
-                            f"Secuencia: {header['sequence']}, "
-                            f"Dispositivos: {len(devices)}, "
-                            f"N_ADV_RAW: {header['n_adv_raw']}"
-                        )
+                    self._enqueue(self._make_document(header, devices, self.scanner_id))
+                    self.logger.debug(
+                        f"Buffer encolado - "
+                        f"Secuencia: {header['sequence']}, "
+                        f"Dispositivos: {len(devices)}, "
+                        f"N_ADV_RAW: {header['n_adv_raw']}"
+                    )
 
+            except EndOfCapture:
+                self.logger.info("Fin de la captura alcanzado")
+                break
             except serial.SerialException as e:
                 self.logger.error(f"Error de comunicación serial: {e}")
                 break
-            except KeyboardInterrupt:
-                self.logger.info(f"Recepción interrumpida por el usuario")
-                self.logger.info(f"Total de buffers procesados: {buffers_procesados}")
-                break
             except Exception as e:
                 self.logger.error(f"Error inesperado: {e}")
                 continue
@@ -175,10 +258,102 @@ class UARTMongoReceiver(UARTReceiver):
         except Exception as e:
             self.logger.error(f"Error al cerrar conexiones: {e}")
 
+
+class UARTMongoFanInReceiver(UARTMongoReceiver):
+    """Varios escáneres en un solo proceso con una única conexión MongoDB"""
+
+    def __init__(self, ports, baudrate=115200,
+                 mongo_uri="mongodb://0.0.0.0:27017/",
+                 log_level="info", protocol=DEFAULT_PROTOCOL, capture=None,
+                 queue_size=1000, overflow='block', sink_workers=1, spill_file=None,
+                 batch_size=500, batch_bytes=DEFAULT_BATCH_BYTES, batch_latency=1.0,
+                 journal=None, journal_fsync='interval', storage='buffers',
+                 encoding='standard', rollups=False, device_registry=False,
+                 ad_fields=False, mongo_client=None):
+        """
+        Inicializa el receptor multipuerto
+
+        Args:
+            ports (list): Puertos [ID=]PUERTO, el ID etiqueta los buffers de cada escáner
+        """
+        self.log_level = log_level.lower()
+        self.storage = storage
+        self.encoding = encoding
+        self.use_rollups = rollups
+        self.use_registry = device_registry
+        self.ad_fields = ad_fields
+        self._setup_logging()
+        self.logger.info(f"Iniciando receptor multipuerto con MongoDB ({len(ports)} puertos)")
+
+        self.fan_in = FanInReader(ports, baudrate, protocol=protocol, capture=capture)
+        self.running = True
+        for scanner_id, receiver in self.fan_in.scanners.items():
+            self.logger.info(f"Escáner {scanner_id} en {receiver.serial.port}")
+        try:
+            self._setup_pipeline(queue_size, overflow, sink_workers, spill_file,
+                                 batch_size, batch_bytes, batch_latency, journal, journal_fsync)
+            self._connect_mongo(mongo_uri, mongo_client)
+        except Exception:
+            self.fan_in.close()
+            raise
+
+    def ports(self):
+        """ID de escáner -> puerto serie de cada escáner"""
+        return {scanner_id: receiver.serial for scanner_id, receiver in self.fan_in.scanners.items()}
+
+    def _log_sequences(self):
+        """Registra las estadísticas de secuencia de cada escáner"""
+        for scanner_id, receiver in self.fan_in.scanners.items():
+            self._log_sequence_stats(scanner_id, receiver.sequence_stats(),
+                                     receiver.clock_stats())
+
+    def _read_loop(self, deadline):
+        """Hilo lector: lee todos los puertos y encola sus buffers"""
+        while self.running:
+            try:
+                if deadline and time.monotonic() >= deadline:
+                    self.logger.info("Tiempo de ejecución completado")
+                    break
+                if not self.fan_in.scanners:
+                    self.logger.info("No quedan puertos abiertos")
+                    break
+
+                buffers = self.fan_in.poll(self._time_left(deadline))
+                for scanner_id, reason in self.fan_in.closed_ports.items():
+                    self.logger.warning(f"Escáner {scanner_id} desconectado: {reason}")
+                self.fan_in.closed_ports.clear()
+                if not buffers:
+                    self._on_idle()
+                    continue
+
+                for scanner_id, header, devices in buffers:
+                    self._log_sequence_events(scanner_id, header)
+                    self.logger.debug(
+                        f"Escáner {scanner_id} - Secuencia: {header['sequence']}, "
+                        f"Dispositivos: {len(devices)}, N_ADV_RAW: {header['n_adv_raw']}"
+                    )
+                    if devices:
+                        self._enqueue(self._make_document(header, devices, scanner_id))
+
+            except Exception as e:
+                self.logger.error(f"Error inesperado: {e}")
+                continue
+
+    def close(self):
+        """Cierra las conexiones"""
+        try:
+            self.fan_in.close()
+            self.logger.info("Puertos serie cerrados")
+            self.client.close()
+            self.logger.info("Conexión MongoDB cerrada")
+        except Exception as e:
+            self.logger.error(f"Error al cerrar conexiones: {e}")
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Receptor BLE Scanner UART MongoDB')
-    parser.add_argument('--port', type=str, default='/dev/ttyUSB0',  # Changed default port
-                      help='Puerto serial (default: /dev/ttyUSB0)')
+    parser.add_argument('--port', type=str, nargs='+', default=['/dev/ttyUSB0'],  # Changed default port
+                      help='Puerto serial, o varios [ID=]PUERTO para leer varios escáneres '
+                           'en un solo proceso (default: /dev/ttyUSB0)')
     parser.add_argument('--duration', type=int,
                       help='Duración de la captura en segundos')
     parser.add_argument('--mongo-uri', type=str, 
@@ -188,15 +363,111 @@ if __name__ == "__main__":
                       choices=['info', 'debug'],
                       default='info',
                       help='Nivel de logging (default: info)')
+    parser.add_argument('--protocol', type=str,
+                      choices=protocol_choices(),
+                      default=DEFAULT_PROTOCOL,
+                      help=f'Formato de trama UART (default: {DEFAULT_PROTOCOL})')
+    parser.add_argument('--capture', type=str,
+                      help='Guarda los bytes UART recibidos en este archivo de captura')
+    parser.add_argument('--queue-size', type=int, default=1000,
+                      help='Buffers en cola entre la lectura UART y MongoDB (default: 1000)')
+    parser.add_argument('--overflow', type=str,
+                      choices=OVERFLOW_POLICIES,
+                      default='block',
+                      help='Con la cola llena: esperar, descartar el más antiguo o '
+                           'desbordar a disco (default: block)')
+    parser.add_argument('--sink-workers', type=int, default=1,
+                      help='Hilos de escritura en MongoDB (default: 1)')
+    parser.add_argument('--spill-file', type=str,
+                      help='Archivo de desbordamiento con --overflow spill '
+                           '(default: spill/uart_mongo.spill)')
+    parser.add_argument('--batch-size', type=int, default=500,
+                      help='Documentos por insert_many (default: 500)')
+    parser.add_argument('--batch-bytes', type=int, default=DEFAULT_BATCH_BYTES,
+                      help=f'Tamaño estimado en bytes que fuerza un insert_many '
+                           f'(default: {DEFAULT_BATCH_BYTES})')
+    parser.add_argument('--batch-latency', type=float, default=1.0,
+                      help='Segundos máximos que un buffer espera a completar su lote, '
+                           '0 para escribir en cuanto llega (default: 1.0)')
+    parser.add_argument('--journal', type=str,
+                      help='Directorio de un diario en disco: los buffers se guardan ahí '
+                           'y se insertan en MongoDB en segundo plano, aunque esté caído')
+    parser.add_argument('--journal-fsync', type=str,
+                      choices=FSYNC_POLICIES,
+                      default='interval',
+                      help='fsync del diario: en cada buffer, cada segundo o nunca '
+                           '(default: interval)')
+    parser.add_argument('--storage', type=str,
+                      choices=STORAGE_MODES,
+                      default='buffers',
+                      help='Un documento por buffer o una observación por dispositivo en '
+                           'una colección time-series <colección>_ts (default: buffers)')
+    parser.add_argument('--encoding', type=str,
+                      choices=ENCODINGS,
+                      default='standard',
+                      help='Codificación de los dispositivos: estándar (hex y MAC como texto) '
+                           'o compacta (binario, MAC entera, nombres cortos) (default: standard)')
+    parser.add_argument('--rollups', action='store_true',
+                      help='Mantener resúmenes por minuto y hora en <colección>_minute y '
+                           '<colección>_hour (buffers, advertisements, MACs únicas, RSSI, GPS)')
+    parser.add_argument('--device-registry', action='store_true',
+                      help='Mantener la colección devices con primera/última vez vista, '
+                           'advertisements, RSSI y última posición de cada MAC')
+    parser.add_argument('--ad-fields', action='store_true',
+                      help='Añadir a cada dispositivo los campos decodificados de sus datos AD '
+                           '(local_name, company_id, service_uuids, tx_power, ...)')
     
     args = parser.parse_args()
     
     try:
-        receiver = UARTMongoReceiver(
-            port=args.port,
-            mongo_uri=args.mongo_uri,
-            log_level=args.log_level
-        )
+        if len(args.port) > 1:
+            receiver = UARTMongoFanInReceiver(
+                ports=args.port,
+                mongo_uri=args.mongo_uri,
+                log_level=args.log_level,
+                protocol=args.protocol,
+                capture=args.capture,
+                queue_size=args.queue_size,
+                overflow=args.overflow,
+                sink_workers=args.sink_workers,
+                spill_file=args.spill_file,
+                batch_size=args.batch_size,
+                batch_bytes=args.batch_bytes,
+                batch_latency=args.batch_latency,
+                journal=args.journal,
+                journal_fsync=args.journal_fsync,
+                storage=args.storage,
+                encoding=args.encoding,
+                rollups=args.rollups,
+                device_registry=args.device_registry,
+                ad_fields=args.ad_fields
+            )
+        else:
+            scanner_id, port = parse_port_spec(args.port[0])
+            receiver = UARTMongoReceiver(
+                port=port,
+                mongo_uri=args.mongo_uri,
+                log_level=args.log_level,
+                protocol=args.protocol,
+                capture=args.capture,
+                scanner_id=scanner_id,
+                queue_size=args.queue_size,
+                overflow=args.overflow,
+                sink_workers=args.sink_workers,
+                spill_file=args.spill_file,
+                batch_size=args.batch_size,
+                batch_bytes=args.batch_bytes,
+                batch_latency=args.batch_latency,
+                journal=args.journal,
+                journal_fsync=args.journal_fsync,
+                storage=args.storage,
+                encoding=args.encoding,
+                rollups=args.rollups,
+                device_registry=args.device_registry,
+                ad_fields=args.ad_fields
+            )
+        # SIGTERM detiene la recepción en menos de POLL_INTERVAL y cierra limpio
+        signal.signal(signal.SIGTERM, lambda signum, frame: receiver.stop())
         receiver.logger.info("Iniciando captura %s", 
                            "indefinida" if not args.duration else f"por {args.duration} segundos")
         receiver.receive_messages(duration=args.duration)
@@ -1,170 +1,295 @@
+import os
+import re
 import serial
-import struct
+import time
 from datetime import datetime
+from urllib.parse import urlparse
+from capture import CaptureWriter, EndOfCapture, open_port
+from framing import FrameReader
+from chunk_protocol import ChunkReader
+from protocol import HEADER_MAGIC, DEFAULT_PROTOCOL, get_protocol
+from sequence import SequenceTracker
+from clock_sync import ClockAligner
+
+# Header keys added by UARTReceiver._track_sequence and stored with each buffer
+SEQUENCE_FIELDS = ('buffer_index', 'epoch', 'lost', 'duplicate', 'reboot',
+                   'n_adv_sum', 'n_adv_unaccounted')
+
+def scanner_id_from_port(port):
+    """Default scanner id for a port: /dev/ttyUSB0 -> ttyUSB0, replay://a/b.cap -> b"""
+    url = urlparse(port)
+    if url.scheme and '://' in port:
+        name = os.path.basename(url.netloc + url.path) or url.scheme
+    else:
+        name = os.path.basename(port.rstrip('/\\'))
+    return os.path.splitext(name)[0] or port
+
+
+def parse_port_spec(spec):
+    """
+    Split an [ID=]PORT argument
+
+    Returns:
+        tuple: (scanner id, port)
+    """
+    match = re.match(r'^([\w.-]+)=(.+)$', spec)
+    if match:
+        return match.group(1), match.group(2)
+    return scanner_id_from_port(spec), spec
+
 
 class UARTReceiver:
-    def __init__(self, port='COM21', baudrate=115200):
-        """Initialize UART receiver with updated buffer format"""
-        self.serial = serial.Serial(port, baudrate)
+    # Longest a single read may block; bounds shutdown and duration latency
+    POLL_INTERVAL = 0.05
+
+    def __init__(self, port='COM21', baudrate=115200, protocol=DEFAULT_PROTOCOL,
+                 capture=None, scanner_id=None):
+        """
+        Initialize UART receiver
+
+        Args:
+            port (str): Serial port, pyserial URL (e.g. loop://) or
+                replay://FILE[?speed=N|max] to play back a capture
+            baudrate (int): Serial baudrate
+            protocol (str): Wire layout name from protocol.PROTOCOLS, 'auto'
+                to detect it from the stream or 'chunked' for the CRC16 chunk
+                protocol with ACK/NACK replies
+            capture (str): Append all received bytes to this capture file
+            scanner_id (str): Tag for this scanner's buffers (default: from port)
+        """
+        self.scanner_id = scanner_id or scanner_id_from_port(port)
+        self.baudrate = baudrate
+        self.serial = open_port(port, baudrate, timeout=self.POLL_INTERVAL)
+        self.capture = CaptureWriter(capture) if capture else None
         self.sequence = 0
-        
-        # Header format constants
-        self.HEADER_MAGIC = b'\x55\x55\x55\x55'
-        self.HEADER_FORMAT = {
-            'header': 4,       # Magic bytes
-            'sequence': 1,     # Sequence number
-            'n_adv_raw': 2,    # Total advertisements counter (now uint16_t)
-            'n_mac': 2,        # Number of unique MACs (now uint16_t)
-        }
-        
-        # Device data format
-        self.DEVICE_FORMAT = {
-            'mac': 6,         # MAC address
-            'addr_type': 1,   # Address type
-            'adv_type': 1,    # Advertisement type
-            'rssi': 1,        # RSSI value
-            'data_len': 1,    # Data length
-            'data': 31,       # Advertisement data
-            'n_adv': 1,       # Number of advertisements from this MAC
-        }
-        
-        self.HEADER_LENGTH = sum(self.HEADER_FORMAT.values())  # Now 9 bytes
-        self.DEVICE_LENGTH = sum(self.DEVICE_FORMAT.values())  # Still 42 bytes
-        self.MAX_DEVICES = 1024  # Updated to match main.c
+        self.HEADER_MAGIC = HEADER_MAGIC
+        self.protocol = get_protocol(protocol)
+        self.chunked = protocol == 'chunked'
+
+        # Bulk frame reader, created on first read
+        self.frame_reader = None
+        self.last_discarded = 0
+
+        # Buffer index, loss and reboot accounting, created once the layout is known
+        self.sequence_tracker = None
+        # Uptime to host clock fit, for layouts with a header timestamp
+        self.clock = None
+
+        # Cleared by stop() to end receive_messages
+        self.running = True
+
+    @property
+    def HEADER_LENGTH(self):
+        return self.protocol.header_length
+
+    @property
+    def DEVICE_LENGTH(self):
+        return self.protocol.device_length
+
+    @property
+    def MAX_DEVICES(self):
+        return self.protocol.max_devices
 
     def _check_header(self, data):
         """Verify message header"""
         return data[:4] == self.HEADER_MAGIC
 
     def _parse_header(self, data):
-        """Parse buffer header with new format"""
-        try:
-            offset = 0
-            header = {}
-            
-            # Verify magic header
-            if not self._check_header(data):
-                return None
-            offset += 4
-
-            # Parse sequence number (1 byte)
-            header['sequence'] = data[offset]
-            offset += 1
-
-            # Parse n_adv_raw (2 bytes, uint16_t)
-            header['n_adv_raw'] = struct.unpack('<H', data[offset:offset+2])[0]
-            offset += 2
-
-            # Parse n_mac (2 bytes, uint16_t)
-            header['n_mac'] = struct.unpack('<H', data[offset:offset+2])[0]
-            
-            return header
-
-        except Exception as e:
-            print(f"Error parsing header: {e}")
-            return None
+        """Parse buffer header with the active protocol"""
+        return self.protocol.parse_header(data)
 
     def _parse_device(self, data):
-        """Parse device data (format unchanged but validation updated)"""
-        try:
-            if len(data) != self.DEVICE_LENGTH:
-                print(f"Invalid device data length: {len(data)} != {self.DEVICE_LENGTH}")
-                return None
-                
-            offset = 0
-            device = {}
-            
-            # Parse MAC address
-            device['mac'] = ':'.join(f'{b:02X}' for b in data[offset:offset+6])
-            offset += 6
-
-            # Parse address type
-            device['addr_type'] = data[offset]
-            offset += 1
-
-            # Parse advertisement type
-            device['adv_type'] = data[offset]
-            offset += 1
-
-            # Parse RSSI (signed byte)
-            rssi_byte = data[offset]
-            device['rssi'] = -(256 - rssi_byte) if rssi_byte > 127 else -rssi_byte
-            offset += 1
-
-            # Parse data length
-            device['data_len'] = data[offset]
-            offset += 1
-
-            # Parse advertisement data
-            device['data'] = data[offset:offset+31]
-            offset += 31
-
-            # Parse number of advertisements
-            device['n_adv'] = data[offset]
-            
-            return device
-
-        except Exception as e:
-            print(f"Error parsing device data: {e}")
+        """Parse a single device record into a DeviceRecord"""
+        if len(data) != self.DEVICE_LENGTH:
+            print(f"Invalid device data length: {len(data)} != {self.DEVICE_LENGTH}")
             return None
+        return self.protocol.parse_device(data)
+
+    def _get_frame_reader(self):
+        """Return the frame reader for the current serial port and layout"""
+        if self.frame_reader is None or self.frame_reader.source is not self.serial:
+            if self.chunked:
+                self.frame_reader = ChunkReader(self.serial, capture=self.capture)
+            else:
+                self.frame_reader = FrameReader(self.serial, self.protocol, capture=self.capture)
+        return self.frame_reader
 
-    def _check_sequence(self, received_seq):
-        """Verify message sequence with improved logging"""
-        if received_seq != (self.sequence + 1) % 256:
-            print(f"Sequence mismatch! Expected: {(self.sequence + 1) % 256}, "
-                  f"Received: {received_seq}")
-        self.sequence = received_seq
+    def _read_frame(self, timeout=None):
+        """Read the next complete buffer from the serial port
+
+        Args:
+            timeout (float): Time budget in seconds, None for POLL_INTERVAL.
+                Bytes of an incomplete buffer are kept for the next call.
+
+        Returns:
+            tuple: (header, frame) where frame is a memoryview valid until the
+            next read, or None if the budget ran out. Bytes skipped while
+            resynchronizing are left in self.last_discarded.
+        """
+        reader = self._get_frame_reader()
+        discarded = reader.bytes_discarded
+        frame = reader.read_frame(self.POLL_INTERVAL if timeout is None else timeout)
+        self.last_discarded = reader.bytes_discarded - discarded
+        # Adopt an auto-detected layout
+        self.protocol = reader.protocol
+        return frame
+
+    def _time_left(self, deadline):
+        """Read budget until deadline (time.monotonic), at most POLL_INTERVAL"""
+        if deadline is None:
+            return self.POLL_INTERVAL
+        return max(0.0, min(self.POLL_INTERVAL, deadline - time.monotonic()))
+
+    def _wait(self, seconds):
+        """Sleep in POLL_INTERVAL steps, returning early once stopped"""
+        deadline = time.monotonic() + seconds
+        while self.running:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            time.sleep(min(self.POLL_INTERVAL, remaining))
+
+    def _on_idle(self):
+        """Called when a read ends without a buffer; time-based sink work goes here"""
+
+    def stop(self):
+        """Ask receive_messages to return (safe from signal handlers and threads)"""
+        self.running = False
+
+    def ports(self):
+        """Scanner id -> serial port of every scanner read by this receiver"""
+        return {self.scanner_id: self.serial}
+
+    def _read_available(self):
+        """Read what the port has pending and decode every completed buffer
+
+        Meant for ports reported readable by a selector: it does not wait
+        when bytes are pending.
+
+        Returns:
+            list: (header, DeviceBatch) for each buffer completed by this read
+        """
+        reader = self._get_frame_reader()
+        discarded = reader.bytes_discarded
+        reader.fill()
+        buffers = []
+        frame = reader.next_frame()
+        while frame:
+            self.protocol = reader.protocol
+            header, data = frame
+            devices = self._parse_devices(data)
+            buffers.append((self._track_sequence(header, devices), devices))
+            frame = reader.next_frame()
+        self.last_discarded = reader.bytes_discarded - discarded
+        return buffers
+
+    def _parse_devices(self, frame):
+        """Decode every device record of a frame at once
+
+        Returns:
+            DeviceBatch: Columnar arrays, dict records are built on demand
+        """
+        return self.protocol.decode_devices(frame)
+
+    def _track_sequence(self, header, devices):
+        """Add buffer index, loss/duplicate/reboot flags and n_adv reconciliation
+
+        The SEQUENCE_FIELDS keys are added to header in place, plus
+        capture_time when the layout carries the firmware uptime.
+
+        Returns:
+            dict: The updated header
+        """
+        if self.sequence_tracker is None:
+            self.sequence_tracker = SequenceTracker(
+                self.protocol.field_bits('sequence'),
+                self.protocol.field_bits('n_adv_raw'),
+            )
+        tracker = self.sequence_tracker
+        header.update(tracker.update(header['sequence'], header.get('timestamp'),
+                                     time.monotonic()))
+        if header.get('timestamp') is not None:
+            header['capture_time'] = self._align_clock(header)
+        n_adv_sum = int(devices['n_adv'].sum())
+        header['n_adv_sum'] = n_adv_sum
+        header['n_adv_unaccounted'] = tracker.reconcile(header['n_adv_raw'], n_adv_sum)
+        self.sequence = header['sequence']
+        return header
+
+    def _align_clock(self, header):
+        """Host time.time() at which the scanner closed the buffer (header timestamp)"""
+        if self.clock is None:
+            self.clock = ClockAligner(self.baudrate)
+        if header['duplicate']:
+            return self.clock.capture_time(header['timestamp'])
+        return self.clock.update(header['timestamp'], time.time(), header['epoch'],
+                                 self.protocol.frame_length(header['n_mac']))
+
+    def _capture_fields(self, header):
+        """capture_timestamp for stored documents, when the layout has a timestamp"""
+        if header.get('capture_time') is None:
+            return {}
+        return {'capture_timestamp': datetime.fromtimestamp(header['capture_time'])}
+
+    def _sequence_fields(self, header):
+        """SEQUENCE_FIELDS present in header, for stored documents"""
+        return {field: header[field] for field in SEQUENCE_FIELDS if field in header}
+
+    def sequence_stats(self):
+        """Sequence tracker counters (lost, duplicates, reboots, ...)"""
+        return self.sequence_tracker.stats() if self.sequence_tracker else {}
+
+    def clock_stats(self):
+        """Clock fit (drift, offset, ...), empty without header timestamps"""
+        return self.clock.stats() if self.clock else {}
 
     def receive_messages(self, duration=None):
         """Receive and process messages with support for larger buffers"""
         print("Starting message reception...")
-        start_time = datetime.now()
-        
-        while True:
+        deadline = time.monotonic() + duration if duration else None
+
+        while self.running:
             try:
                 # Check duration if specified
-                if duration and (datetime.now() - start_time).total_seconds() >= duration:
+                if deadline and time.monotonic() >= deadline:
                     print(f"Duration {duration}s reached. Stopping.")
                     break
 
-                # Search for header
-                while True:
-                    if self.serial.read() == b'\x55':
-                        potential_header = b'\x55' + self.serial.read(3)
-                        if potential_header == self.HEADER_MAGIC:
-                            break
-
-                # Read and parse header
-                header_data = potential_header + self.serial.read(self.HEADER_LENGTH - 4)
-                header = self._parse_header(header_data)
-                
-                if not header:
+                frame = self._read_frame(self._time_left(deadline))
+                if self.last_discarded:
+                    print(f"Resync: discarded {self.last_discarded} bytes")
+                if frame is None:
+                    self._on_idle()
                     continue
+                header, data = frame
+                devices = self._parse_devices(data)
+                self._track_sequence(header, devices)
+                if header['lost']:
+                    print(f"Sequence gap: {header['lost']} buffers lost before {header['sequence']}")
+                if header['reboot']:
+                    print("Scanner reboot detected")
 
                 print("\n=== Buffer Received ===")
                 print(f"Timestamp: {datetime.now().strftime('%Y-%m-%d %H:%M:%S.%f')[:-3]}")
-                print(f"Sequence: {header['sequence']}")
+                if 'capture_time' in header:
+                    captured = datetime.fromtimestamp(header['capture_time'])
+                    print(f"Captured: {captured.strftime('%Y-%m-%d %H:%M:%S.%f')[:-3]}")
+                print(f"Sequence: {header['sequence']} (buffer {header['buffer_index']})")
                 print(f"Total Advertisements: {header['n_adv_raw']}")
                 print(f"Number of MACs: {header['n_mac']}")
                 print("====================\n")
 
-                # Validate n_mac
-                if header['n_mac'] > self.MAX_DEVICES:
-                    print(f"Warning: n_mac ({header['n_mac']}) exceeds MAX_DEVICES ({self.MAX_DEVICES})")
-                    continue
-
-                # Read and parse each device
-                for i in range(header['n_mac']):
-                    device_data = self.serial.read(self.DEVICE_LENGTH)
-                    device = self._parse_device(device_data)
-                    
-                    if device:
-                        print(f"Device {i+1}:")
-                        print(f"  MAC: {device['mac']}")
-                        print(f"  RSSI: {device['rssi']} dBm")
-                        print(f"  Advertisements: {device['n_adv']}")
-                        print("--------------------")
+                # Parse each device
+                for i, device in enumerate(devices):
+                    print(f"Device {i+1}:")
+                    print(f"  MAC: {device['mac']}")
+                    print(f"  RSSI: {device['rssi']} dBm")
+                    print(f"  Advertisements: {device['n_adv']}")
+                    print("--------------------")
 
+            except EndOfCapture:
+                print("End of capture reached. Stopping.")
+                break
             except serial.SerialException as e:
                 print(f"Serial communication error: {e}")
                 break
@@ -179,10 +304,12 @@ class UARTReceiver:
         """Close serial connection"""
         if self.serial.is_open:
             self.serial.close()
+        if self.capture:
+            self.capture.close()
 
 if __name__ == "__main__":
     try:
-        receiver = UARTReceiver(port='COM21')  
+        receiver = UARTReceiver(port='COM21')
         receiver.receive_messages()
     except Exception as e:
         print(f"Error: {e}")
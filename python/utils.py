@@ -4,6 +4,9 @@ from datetime import datetime, timedelta
 import matplotlib.pyplot as plt
 import seaborn as sns
 import numpy as np
+from encoding import expand_documents
+from rollups import merge, read_rollups
+from timeseries import find_buffers
 
 def connect_mongodb(uri="mongodb://localhost:27017/", db_name="ble_scanner", collection_name="adv_buffer1"):
     """
@@ -22,20 +25,19 @@ def connect_mongodb(uri="mongodb://localhost:27017/", db_name="ble_scanner", col
     return db[collection_name]
 
 def query_data_by_date(collection, start_date, end_date):
-    query = {
-        "timestamp": {
-            "$gte": start_date,
-            "$lte": end_date
-        }
-    }
-    return list(collection.find(query))
+    """
+    Buffers between start_date and end_date, from a buffer collection or
+    a time-series observation collection (see timeseries.py)
+    """
+    return find_buffers(collection, start_date, end_date, sort=1)
 
 def process_buffer_data(data):
     """
     Process buffer data and create a normalized DataFrame
+    (standard or compact encoding)
     """
     records = []
-    for buffer in data:
+    for buffer in expand_documents(data):
         base_info = {
             'timestamp': buffer['timestamp'],
             'sequence': buffer['sequence'],
@@ -69,6 +71,31 @@ def get_temporal_analysis(df):
     }
     return temporal_stats
 
+def get_rollup_temporal_analysis(collection):
+    """
+    get_temporal_analysis from the hour rollups of a collection (rollups.py),
+    without reading the raw buffers
+
+    Args:
+        collection: Hour rollup collection, e.g. db.portfinal_hour
+    """
+    rollups = read_rollups(collection)
+    totals = merge(rollups)
+    hourly = {}
+    daily = {}
+    for rollup in rollups:
+        hourly.setdefault(rollup['start'].hour, set()).update(rollup['macs'])
+        daily.setdefault(rollup['start'].date(), set()).update(rollup['macs'])
+    span = (totals['last'] - totals['first']).total_seconds() / 3600 if rollups else 0.0
+    return {
+        'total_intervals': totals['buffers'],
+        'time_span': span,
+        'avg_devices_per_interval': totals['avg_devices'],
+        'total_unique_devices': len(totals['macs']),
+        'hourly_pattern': {hour: len(macs) for hour, macs in sorted(hourly.items())},
+        'daily_pattern': {day: len(macs) for day, macs in sorted(daily.items())}
+    }
+
 def get_device_analysis(df):
     """
     Perform device-specific analysis
@@ -253,11 +280,21 @@ def analyze_buffer_stats(data, df):
     
     # Calculate additional sequence statistics
     sequence_gaps = []
-    prev_seq = sequences[0]
-    for seq in sequences[1:]:
-        if seq - prev_seq > 1:
-            sequence_gaps.append((prev_seq, seq, seq-prev_seq-1))
-        prev_seq = seq
+    if all('buffer_index' in buffer for buffer in data):
+        # Stored by the receivers' sequence tracker: no need to rescan the
+        # wrapping sequence numbers
+        for buffer in data:
+            if buffer.get('lost'):
+                index = buffer['buffer_index']
+                sequence_gaps.append((index - buffer['lost'] - 1, index, buffer['lost']))
+        stats['reboots'] = sum(1 for buffer in data if buffer.get('reboot'))
+        stats['duplicates'] = sum(1 for buffer in data if buffer.get('duplicate'))
+    else:
+        prev_seq = sequences[0]
+        for seq in sequences[1:]:
+            if seq - prev_seq > 1:
+                sequence_gaps.append((prev_seq, seq, seq-prev_seq-1))
+            prev_seq = seq
     
     if sequence_gaps:
         stats['sequence_gaps'] = sequence_gaps